@@ -4,46 +4,55 @@
     - qweqwe
 """
 
+from django import forms
 from django.contrib import admin
 from django.db import transaction
 
 from djtalks.djforum.models import Forum, Topic, Post
+from djtalks.djforum import versions
+from djtalks.djforum import writes
+
+
+class ForumAdminForm(forms.ModelForm):
+    class Meta:
+        model = Forum
+
+    def clean_parent(self):
+        parent = self.cleaned_data['parent']
+        if parent and self.instance.id and self.instance.id in parent.lineage:
+            raise forms.ValidationError("Forum can't be moved into itself or its subforums")
+        return parent
+
 
 class ForumAdmin(admin.ModelAdmin):
-    #TODO: comments
+    form = ForumAdminForm
+    # these fields are maintained by the forum itself
+    readonly_fields = ('path', 'depth', 'has_subforums', 'post_count', 'topic_count',
+                       'last_post', 'updated')
+
     @transaction.commit_on_success
     def save_model(self, request, obj, form, change):
         """
         :type obj: :class:`djtalks.djforum.models.Forum`
         """
-        # if this forum has parent, then we should populate certain fields
-        if obj.parent:
-            parent = obj.parent
-            obj.depth = parent.depth + 1
-            obj.path  = (parent.path or '') + "{}.".format(parent.id)
-            #TODO: change path of all descendants
-            if change:
-                previous_obj = Forum.objects.get(pk=obj.id)
-                previous_parent = previous_obj.parent
-                # if previous parent existed and we are moving the forum to a new parent
-                if previous_parent and parent.id != previous_parent.id:
-                    # we should check if previous parent has subforums, and if
-                    # it is not then we should update its has_subforums
-                    if not previous_parent.children.count():
-                        previous_parent.has_subforums = False
-                        previous_parent.save()
-                #FIXME: dummy shim
-                descendants = previous_obj.descendants()
-                print previous_obj, descendants, len(descendants)
-                for descendant in descendants:
-                    descendant.depth  = obj.depth + 1
-                    descendant.path   = (obj.path or '') + "{}.".format(obj.id)
-                    descendant.save()
-                    print descendant, descendant.depth, descendant.path
-
-            if not parent.has_subforums:
-                parent.has_subforums = True
-                parent.save()
-        obj.save()
-
-admin.site.register(Forum, ForumAdmin)
\ No newline at end of file
+        if not change:
+            Forum.objects.insert(obj, obj.parent)
+        else:
+            previous = Forum.objects.get(pk=obj.id)
+            if previous.parent_id != obj.parent_id:
+                # the whole subtree is moved with its position fields
+                Forum.objects.move(previous, obj.parent)
+            # counters, the last post and the position of the forum may have
+            # changed since the form was loaded, so only the edited fields
+            # are written instead of the whole row
+            fields = [name for name in form.changed_data if name != 'parent']
+            if fields:
+                Forum.objects.filter(pk=obj.id)\
+                             .update(**dict((name, getattr(obj, name)) for name in fields))
+        writes.after_commit(versions.bump, 'tree', 'forums')
+
+    @transaction.commit_on_success
+    def delete_model(self, request, obj):
+        Forum.objects.delete_subtree(obj)
+
+admin.site.register(Forum, ForumAdmin)
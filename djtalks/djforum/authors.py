@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors:
+    - qweqwe
+
+Batch loading of post authors. Authors of a page of posts, their profiles
+and avatar hashes are fetched with two queries whatever the size of the
+page, instead of a SELECT (and maybe an INSERT) per author done by
+`user.forum_profile` while the template is rendered:
+
+    paginator = KeysetPaginator(topic.posts.all(), ('created', 'id'),
+                                POSTS_PER_PAGE, prepare=authors.load)
+"""
+from django.contrib.auth.models import User
+from django.db import transaction, IntegrityError
+from django.db.models import Count
+
+from djtalks.djforum import avatars
+from djtalks.djforum import fragments
+from djtalks.djforum import writes
+from djtalks.djforum.models import Post, Profile
+
+
+def load(posts):
+    """
+    Sets `author` of every post and `forum_profile` of every author.
+    Missing profiles are created with a single bulk INSERT.
+    """
+    ids = set(post.author_id for post in posts)
+    if not ids:
+        return
+    # cached pages show the post counts and avatars of the authors
+    fragments.record(*[fragments.profile_version(user_id) for user_id in ids])
+    users = User.objects.in_bulk(ids)
+    profiles = dict((profile.user_id, profile)
+                    for profile in Profile.objects.filter(user__in=ids))
+    missing = [user_id for user_id in users if user_id not in profiles]
+    if missing:
+        profiles.update(create_profiles([users[user_id] for user_id in missing]))
+    for user in users.values():
+        profiles[user.id].user = user
+        setattr(user, User.forum_profile.cache_name, profiles[user.id])
+    for post in posts:
+        post.author = users[post.author_id]
+
+
+def create_profiles(users):
+    """
+    Returns {user id: profile} of the created profiles, counting posts of
+    the users the way `Profile.update_post_count` does
+    """
+    ids = [user.id for user in users]
+    counts = dict(Post.objects.filter(author__in=ids).values_list('author')
+                              .annotate(Count('id')).order_by())
+    profiles = [Profile(user_id=user.id, post_count=counts.get(user.id, 0),
+                        avatar_hash=avatars.email_hash(user.email))
+                for user in users]
+
+    def insert():
+        with transaction.commit_on_success():
+            sid = transaction.savepoint()
+            try:
+                # bulk_create sends no pre_save, so the hashes are computed above
+                Profile.objects.bulk_create(profiles)
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                # a concurrent request has created some of them
+                transaction.savepoint_rollback(sid)
+                for profile in profiles:
+                    Profile.objects.get_or_create(user_id=profile.user_id, defaults=dict(
+                        post_count=profile.post_count, avatar_hash=profile.avatar_hash))
+    writes.run(insert)
+    return dict((profile.user_id, profile)
+                for profile in Profile.objects.filter(user__in=ids))
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors:
+    - qweqwe
+
+Gravatar URLs. The hash of the email is computed once, when the profile is
+created or the email changes, and stored in `Profile.avatar_hash`. Hashes
+of emails without a loaded profile and built URLs are memoized, a topic
+page shows the same few authors over and over:
+
+    {% load gravatar %}
+    <img src="{% avatar_url post.author 80 %}">
+"""
+import hashlib
+import threading
+import urllib
+from collections import OrderedDict
+from functools import wraps
+
+from django.conf import settings
+
+BASE_URL = getattr(settings, 'DJFORUM_GRAVATAR_URL', 'http://www.gravatar.com/avatar/')
+#: image shown to users without a gravatar
+DEFAULT = getattr(settings, 'DJFORUM_GRAVATAR_DEFAULT', 'mm')
+SIZE = 48
+#: number of hashes and of URLs remembered by every process
+MEMO_SIZE = getattr(settings, 'DJFORUM_GRAVATAR_MEMO_SIZE', 1024)
+
+
+def memoize(size):
+    """
+    Remembers results of the last `size` distinct calls of the function
+    """
+    def decorator(func):
+        memo, lock = OrderedDict(), threading.Lock()
+
+        @wraps(func)
+        def wrapper(*args):
+            with lock:
+                if args in memo:
+                    # moved to the end, the least recently used are evicted first
+                    memo[args] = memo.pop(args)
+                    return memo[args]
+            result = func(*args)
+            with lock:
+                memo[args] = result
+                if len(memo) > size:
+                    memo.popitem(last=False)
+            return result
+        wrapper.memo = memo
+        return wrapper
+    return decorator
+
+
+@memoize(MEMO_SIZE)
+def email_hash(email):
+    return hashlib.md5(email.strip().lower().encode('utf-8')).hexdigest()
+
+
+@memoize(MEMO_SIZE)
+def url(hash, size=SIZE, default=DEFAULT):
+    return BASE_URL + hash + '?' + urllib.urlencode([('d', default), ('s', size)])
+
+
+def user_hash(user):
+    """
+    Takes the hash from the profile if it has been loaded with the user,
+    never queries the database
+    """
+    from django.contrib.auth.models import User
+    profile = getattr(user, User.forum_profile.cache_name, None)
+    if profile is not None and profile.avatar_hash:
+        return profile.avatar_hash
+    return email_hash(user.email)
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors:
+    - qweqwe
+
+Validators for conditional GET of the board pages. They are computed
+from `updated` of the forum or topic and the cache versions of the
+fragments shown on the page, before topics or posts are loaded, so a
+client that already has the page gets 304 for one indexed lookup:
+
+    @condition(etag_func=conditional.topic_etag,
+               last_modified_func=conditional.topic_last_modified)
+    def topic(request, topic_id): ...
+
+Pages of posts also show the post counts and avatars of their authors, so
+topic ETags include the profile versions of everyone who posted in the
+topic. The list of authors is cached until the topic changes.
+
+ETags include the viewer: the forums visible to them and what the page
+layout shows about them (the unread messages and, on forum pages, the
+unread topics). Last-Modified can't express that, so it's sent to
+anonymous users only, which is what crawlers are.
+"""
+import hashlib
+from functools import wraps
+
+from django.core.cache import cache
+
+from djtalks.djforum import fragments
+from djtalks.djforum import inbox
+from djtalks.djforum import tracking
+from djtalks.djforum import versions
+from djtalks.djforum.models import Forum, Topic, Post
+from djtalks.djforum.permissions import get_permissions
+from djtalks.djforum.tree import forum_tree
+
+
+AUTHORS_KEY = 'djforum:topic-authors:{}:{}'
+
+
+def viewer(request):
+    user = request.user
+    parts = [get_permissions(request).key]
+    if user.is_authenticated():
+        parts.extend([user.id, inbox.summary(user.id).unread])
+    return parts
+
+
+def make_etag(request, *parts):
+    parts = viewer(request) + list(parts)
+    return hashlib.md5(':'.join(str(part) for part in parts)).hexdigest()
+
+
+def lookup(request, model, pk):
+    """
+    Returns (forum_id, updated) of the forum or topic, or None if it doesn't
+    exist or isn't visible to the user. The row is fetched once per request.
+    """
+    if not hasattr(request, '_forum_validators'):
+        request._forum_validators = {}
+    cache = request._forum_validators
+    if (model, pk) not in cache:
+        field = 'id' if model is Forum else 'forum_id'
+        row = model.objects.filter(pk=pk).values_list(field, 'updated')[:1]
+        if row and not get_permissions(request).can_view(row[0][0]):
+            row = []
+        cache[model, pk] = row[0] if row else None
+    return cache[model, pk]
+
+
+def safe_only(func):
+    """
+    Validators are only computed for GET and HEAD requests, forms are
+    posted to the same views
+    """
+    @wraps(func)
+    def wrapper(request, *args, **kwargs):
+        if request.method in ('GET', 'HEAD'):
+            return func(request, *args, **kwargs)
+    return wrapper
+
+
+def anonymous_only(func):
+    @wraps(func)
+    def wrapper(request, *args, **kwargs):
+        if not request.user.is_authenticated():
+            return func(request, *args, **kwargs)
+    return wrapper
+
+
+@safe_only
+def index_etag(request):
+    return make_etag(request, *versions.get('forums', 'tree'))
+
+
+@safe_only
+@anonymous_only
+def index_last_modified(request):
+    # the tree is cached and the view needs it anyway, posts update the
+    # whole lineage, so the root forums are the latest ones
+    updated = [forum.updated for forum in forum_tree(get_permissions(request))
+               if forum.updated]
+    return max(updated) if updated else None
+
+
+@safe_only
+def forum_etag(request, forum_id):
+    row = lookup(request, Forum, forum_id)
+    if row:
+        return make_etag(request, row[1], tracking.key(tracking.get_marker(request, forum_id)),
+                         *versions.get(fragments.forum_version(forum_id), 'forums', 'tree'))
+
+
+@safe_only
+@anonymous_only
+def forum_last_modified(request, forum_id):
+    row = lookup(request, Forum, forum_id)
+    return row[1] if row else None
+
+
+def topic_authors(topic_id, topic_version):
+    """
+    Returns the profile version names of the authors of the topic
+    """
+    key = AUTHORS_KEY.format(topic_id, topic_version)
+    names = cache.get(key)
+    if names is None:
+        authors = Post.objects.filter(topic=topic_id).order_by().distinct()\
+                              .values_list('author_id', flat=True)
+        names = [fragments.profile_version(user_id) for user_id in sorted(authors)]
+        cache.set(key, names, fragments.TIMEOUT)
+    return names
+
+
+@safe_only
+def topic_etag(request, topic_id):
+    row = lookup(request, Topic, topic_id)
+    if row:
+        topic_version = versions.get(fragments.topic_version(topic_id))[0]
+        return make_etag(request, row[1], topic_version,
+                         *versions.get(*topic_authors(topic_id, topic_version)))
+
+
+@safe_only
+@anonymous_only
+def topic_last_modified(request, topic_id):
+    row = lookup(request, Topic, topic_id)
+    return row[1] if row else None
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors:
+    - qweqwe
+"""
+from django.utils.functional import SimpleLazyObject
+
+from djtalks.djforum import inbox
+
+
+def inbox_summary(request):
+    """
+    Adds `inbox_summary` of the current user, it's fetched only if the
+    template uses it
+    """
+    if not request.user.is_authenticated():
+        return {}
+    user_id = request.user.id
+    return dict(inbox_summary=SimpleLazyObject(lambda: inbox.summary(user_id)))
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors:
+    - qweqwe
+
+Change feed of topics. The sequence of a topic is the id of its latest
+post, kept in the cache and bumped when a post is committed, so clients
+watching a topic wait on cache lookups and only query the database when
+there is something new for them:
+
+    posts = feed.wait(topic.id, after=cursor)
+
+The cache may be evicted or, with the local memory backend, not shared by
+the processes, so the database is checked once more when the wait times
+out. Waiting holds no database connection, but it holds the worker:
+serve the updates with green threads (e.g. `gunicorn -k gevent`) to keep
+thousands of watchers cheap.
+"""
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.db.models import Max
+
+#: seconds a long-poll request waits for new posts
+TIMEOUT = getattr(settings, 'DJFORUM_FEED_TIMEOUT', 25)
+#: seconds an event stream is kept open, the client reconnects after that
+STREAM_TIMEOUT = getattr(settings, 'DJFORUM_FEED_STREAM_TIMEOUT', 5 * 60)
+POLL_INTERVAL = getattr(settings, 'DJFORUM_FEED_POLL_INTERVAL', 0.5)
+#: most posts returned at once, the client asks again for the rest
+LIMIT = 50
+
+KEY = 'djforum:feed:topic:{}'
+KEY_TIMEOUT = 24 * 60 * 60
+
+
+def post_added(topic_id, post_id):
+    """
+    Bumps the sequence of the topic, should be called once the post is
+    committed
+    """
+    key = KEY.format(topic_id)
+    if not cache.add(key, post_id, KEY_TIMEOUT) and (cache.get(key) or 0) < post_id:
+        cache.set(key, post_id, KEY_TIMEOUT)
+
+
+def sequence(topic_id):
+    key = KEY.format(topic_id)
+    value = cache.get(key)
+    if value is None:
+        from djtalks.djforum.models import Post
+        value = Post.objects.filter(topic=topic_id).aggregate(Max('id'))['id__max'] or 0
+        cache.add(key, value, KEY_TIMEOUT)
+    return value
+
+
+def new_posts(topic_id, after):
+    from djtalks.djforum.models import Post
+    return list(Post.objects.filter(topic=topic_id, id__gt=after).order_by('id')[:LIMIT])
+
+
+def release():
+    """
+    Closes the database connections, so that waiting clients don't hold them
+    """
+    for connection in connections.all():
+        connection.close()
+
+
+def wait(topic_id, after, timeout=None):
+    """
+    Returns posts of the topic made after the post with id `after`, waits
+    for them up to `timeout` seconds. Returns an empty list on timeout.
+    """
+    deadline = time.time() + (TIMEOUT if timeout is None else timeout)
+    release()
+    while time.time() < deadline:
+        if sequence(topic_id) > after:
+            posts = new_posts(topic_id, after)
+            if posts:
+                return posts
+            release()
+        time.sleep(POLL_INTERVAL)
+    return new_posts(topic_id, after)
+
+
+def stream(topic_id, after, render, timeout=None):
+    """
+    Yields Server-Sent Events with new posts of the topic as they come,
+    `render` turns a list of posts into the data of the event. The event
+    id is the cursor, browsers send it back in Last-Event-ID when they
+    reconnect.
+    """
+    deadline = time.time() + (STREAM_TIMEOUT if timeout is None else timeout)
+    yield 'retry: {}\n\n'.format(int(POLL_INTERVAL * 1000))
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        posts = wait(topic_id, after, min(TIMEOUT, remaining))
+        if posts:
+            after = posts[-1].id
+            yield 'id: {}\nevent: posts\ndata: {}\n\n'.format(after, json.dumps(render(posts)))
+        else:
+            # keeps proxies from closing the idle connection
+            yield ': keepalive\n\n'
@@ -11,7 +11,7 @@ from django.utils.translation import ugettext_lazy as _
 from django.db.models import Q
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
-from djtalks.djforum.models import PrivateMessage
+from djtalks.djforum.models import Post, PrivateMessage
 
 class ModelMultipleCommaField(forms.ModelMultipleChoiceField):
     widget = forms.TextInput
@@ -64,9 +64,21 @@ class AddTopicForm(Form):
     message = forms.CharField(label=_('Message'), widget=forms.Textarea())
 
 class AddPostForm(Form):
+
+    def __init__(self, *args, **kwargs):
+        topic = kwargs.pop('topic')
+        super(AddPostForm, self).__init__(*args, **kwargs)
+        self.fields['reply_to'].queryset = Post.objects.filter(topic=topic)
+
+    reply_to = forms.ModelChoiceField(Post.objects, label=_('Reply to'),
+                                      widget=forms.HiddenInput(), required=False)
     message = forms.CharField(label=_('Message'), widget=forms.Textarea())
 
 
+class SearchForm(forms.Form):
+    q = forms.CharField(label=_('Search'), max_length=255)
+
+
 class NewMessageForm(Form):
 
     def __init__(self, *args, **kwargs):
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors:
+    - qweqwe
+
+Cache of rendered template fragments. Keys of fragments include versions
+of the objects they show, e.g. the row of the forum on the index page
+includes the version of that forum, and the page of posts includes the
+version of the topic. Hooks of the models bump the versions, so a new post
+invalidates only its topic pages and the rows of its forum and ancestors.
+
+A fragment may also show data of other objects, e.g. the post counts of
+the authors on a page of posts. Code loading such data calls
+:func:`record` with their version names while the fragment is being
+rendered, the versions are stored with the fragment and checked on a hit.
+"""
+import hashlib
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.encoding import smart_str
+
+from djtalks.djforum import versions
+
+KEY = 'djforum:fragment:{}:{}'
+TIMEOUT = getattr(settings, 'DJFORUM_FRAGMENT_CACHE_TIMEOUT', 10 * 60)
+
+#: dependencies of the fragments being rendered by the thread
+local = threading.local()
+
+
+def forum_version(forum_id):
+    return 'forum:{}'.format(forum_id)
+
+
+def topic_version(topic_id):
+    return 'topic:{}'.format(topic_id)
+
+
+def profile_version(user_id):
+    return 'profile:{}'.format(user_id)
+
+
+def version_names(obj):
+    """
+    Names of the versions the fragment showing the object depends on
+    """
+    # import here, models use this module to invalidate fragments
+    from djtalks.djforum.models import Forum, Topic
+    if isinstance(obj, Forum):
+        # rows of forums also list their subforums
+        return [forum_version(obj.id), 'tree']
+    if isinstance(obj, Topic):
+        return [topic_version(obj.id)]
+    raise TypeError('no versions for {!r}'.format(obj))
+
+
+def make_key(name, obj, vary_on=()):
+    parts = [name] + versions.get(*version_names(obj)) + list(vary_on)
+    digest = hashlib.md5(':'.join(smart_str(part) for part in parts)).hexdigest()
+    return KEY.format(name, digest)
+
+
+def get(key):
+    """
+    Returns the cached content, unless the versions it was recorded to
+    depend on have changed since
+    """
+    cached = cache.get(key)
+    if cached is None:
+        return None
+    depends, content = cached
+    names = sorted(depends)
+    if names and versions.get(*names) != [depends[name] for name in names]:
+        return None
+    return content
+
+
+def set(key, content, depends=None):
+    cache.set(key, (depends or {}, content), TIMEOUT)
+
+
+@contextmanager
+def recording():
+    """
+    Collects {version name: version} passed to :func:`record` in the block
+    """
+    stack = local.__dict__.setdefault('stack', [])
+    depends = {}
+    stack.append(depends)
+    try:
+        yield depends
+    finally:
+        stack.pop()
+
+
+def record(*names):
+    """
+    Makes the fragments being rendered depend on the versions, it should be
+    called before the data they stand for is read
+    """
+    stack = getattr(local, 'stack', None)
+    if not stack or not names:
+        return
+    current = dict(zip(names, versions.get(*names)))
+    # enclosing fragments include the content of the inner ones
+    for depends in stack:
+        for name, version in current.items():
+            depends.setdefault(name, version)
+
+
+def forums_changed(forum_ids):
+    versions.bump(*[forum_version(forum_id) for forum_id in forum_ids])
+
+
+def topic_changed(topic_id):
+    versions.bump(topic_version(topic_id))
+
+
+def profile_changed(user_id):
+    versions.bump(profile_version(user_id))
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors:
+    - qweqwe
+
+Per-user inbox summary: the number of unread private messages, and the
+list of the user's conversations shown by the inbox page. Both are
+computed once and kept in the cache. The unread count is then updated
+incrementally when messages are delivered or read, so showing "you have
+N unread" on every page costs a cache lookup. The conversation list is
+dropped when a message is delivered and is rebuilt by the next inbox page.
+"""
+from django.conf import settings
+from django.core.cache import cache
+
+from django.db.models import Max
+
+from djtalks.djforum.models import Inbox, PrivateMessage
+
+INBOX_CACHE_TIMEOUT = getattr(settings, 'DJFORUM_INBOX_CACHE_TIMEOUT', 24 * 60 * 60)
+
+UNREAD_KEY = 'djforum:inbox:unread:{}'
+CONVERSATIONS_KEY = 'djforum:inbox:conversations:{}'
+
+
+class InboxSummary(object):
+    def __init__(self, unread):
+        self.unread = unread
+
+
+def summary(user_id):
+    key = UNREAD_KEY.format(user_id)
+    unread = cache.get(key)
+    if unread is None:
+        unread = Inbox.objects.filter(recipient=user_id, is_read=False).count()
+        cache.set(key, unread, INBOX_CACHE_TIMEOUT)
+    return InboxSummary(unread)
+
+
+def load_conversations(user_id):
+    messages = PrivateMessage.objects.filter(recipients=user_id) | \
+               PrivateMessage.objects.filter(sender=user_id)
+    return list(messages.values('conversation_id').annotate(last_id=Max('id'))
+                        .order_by('-last_id'))
+
+
+def conversations(user_id):
+    """
+    Returns values of conversations the user has taken part in with
+    `last_id` of their latest messages, the latest conversation first
+    """
+    key = CONVERSATIONS_KEY.format(user_id)
+    values = cache.get(key)
+    if values is None:
+        values = load_conversations(user_id)
+        cache.set(key, values, INBOX_CACHE_TIMEOUT)
+    return values
+
+
+def add_unread(user_id, delta):
+    try:
+        cache.incr(UNREAD_KEY.format(user_id), delta)
+    except ValueError:
+        # the summary isn't cached, it will be computed on the next request
+        pass
+
+
+def delivered(message, recipients):
+    """
+    Should be called when the message has been delivered to the recipients
+    """
+    for recipient in recipients:
+        add_unread(recipient.id, 1)
+    # the conversation moves to the top of the list, or is a new one
+    cache.delete_many([CONVERSATIONS_KEY.format(user_id) for user_id
+                       in set([message.sender_id] + [r.id for r in recipients])])
+
+
+def marked_read(user_id, count):
+    """
+    Should be called when `count` messages of the user have been marked read
+    """
+    if count:
+        add_unread(user_id, -count)
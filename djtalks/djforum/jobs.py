@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors:
+    - qweqwe
+
+Deferred side effects of writes, e.g. the counter updates of a new post.
+Tasks are registered under a name and deferred with JSON serializable
+arguments:
+
+    jobs.register('djforum.count_post', Post.count)
+    jobs.defer('djforum.count_post', post.id)
+
+What happens to a deferred task depends on DJFORUM_JOBS_MODE:
+
+``'immediate'``
+    the task runs in the request, after the view has committed (see
+    :func:`djtalks.djforum.writes.after_commit`)
+``'worker'``
+    the task is stored in the `Job` table in the transaction that defers it,
+    so it's queued if and only if the write commits, and is run by
+    `manage.py runjobs`
+``'thread'``
+    as ``'worker'``, but a pool of DJFORUM_JOBS_THREADS threads of the web
+    process runs the jobs as soon as they are queued. The worker command
+    still picks up what a process left behind when it exited.
+
+A job is deleted in the same transaction the task runs in, so the changes
+made by the task are applied exactly once. Failed jobs are retried with
+exponential backoff, after DJFORUM_JOBS_MAX_ATTEMPTS attempts they are
+marked as failed and kept for inspection.
+"""
+import atexit
+import json
+import logging
+import threading
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from djtalks.djforum import writes
+
+MODE = getattr(settings, 'DJFORUM_JOBS_MODE', 'immediate')
+THREADS = getattr(settings, 'DJFORUM_JOBS_THREADS', 2)
+MAX_ATTEMPTS = getattr(settings, 'DJFORUM_JOBS_MAX_ATTEMPTS', 5)
+#: seconds a claimed job is reserved for the worker that claimed it
+LEASE = 60
+#: delay before the first retry, it doubles with every next one
+RETRY_DELAY = 10
+#: seconds idle workers wait before looking for new jobs
+POLL_INTERVAL = 1
+
+logger = logging.getLogger(__name__)
+
+#: task name -> function
+tasks = {}
+
+
+def register(name, func):
+    tasks[name] = func
+
+
+def defer(name, *args):
+    if name not in tasks:
+        raise KeyError("Unknown task {}".format(name))
+    if MODE == 'immediate':
+        writes.after_commit(tasks[name], *args)
+        return
+    from djtalks.djforum.models import Job
+    Job.objects.create(name=name, args=json.dumps(args))
+    if MODE == 'thread':
+        writes.after_commit(get_pool().wake)
+
+
+def cancel(name, *args):
+    """
+    Drops the deferred task if it hasn't run yet, returns True if it was
+    pending. Deleting a row whose counting job is still queued must not
+    subtract it from the counters.
+    """
+    if MODE == 'immediate':
+        return writes.cancel(tasks[name], *args)
+    from djtalks.djforum.models import Job
+    # a DELETE rather than a lookup, a worker that is running the job
+    # deletes the row in its own transaction, so only one of them succeeds
+    cursor = connection.cursor()
+    cursor.execute('DELETE FROM {} WHERE name = %s AND args = %s'
+                   .format(connection.ops.quote_name(Job._meta.db_table)),
+                   [name, json.dumps(args)])
+    return cursor.rowcount > 0
+
+
+def claim(limit=10):
+    """
+    Reserves up to `limit` due jobs for LEASE seconds. Jobs are claimed one
+    by one with a conditional UPDATE, so concurrent workers never run the
+    same job, and jobs of a worker that died are claimed again once the
+    lease expires.
+    """
+    from djtalks.djforum.models import Job
+    now = timezone.now()
+    due = Job.objects.filter(failed=False, run_after__lte=now)\
+                     .exclude(locked_until__gt=now).order_by('run_after', 'id')
+    claimed = []
+    with transaction.commit_on_success():
+        for job in due[:limit]:
+            updated = Job.objects.filter(pk=job.pk, attempts=job.attempts)\
+                                 .update(locked_until=now + timedelta(seconds=LEASE),
+                                         attempts=job.attempts + 1)
+            if updated:
+                job.attempts += 1
+                claimed.append(job)
+    return claimed
+
+
+def perform(job):
+    """
+    Runs the task of the claimed job and deletes the job, or schedules the
+    next attempt. Returns True if the task has succeeded.
+    """
+    from djtalks.djforum.models import Job
+
+    def execute():
+        tasks[job.name](*json.loads(job.args))
+        Job.objects.filter(pk=job.pk).delete()
+
+    try:
+        writes.run(writes.apply, execute, (), {})
+        return True
+    except Exception:
+        logger.exception("Job %s %s(%s) failed", job.pk, job.name, job.args)
+        delay = timedelta(seconds=RETRY_DELAY * 2 ** (job.attempts - 1))
+        with transaction.commit_on_success():
+            Job.objects.filter(pk=job.pk)\
+                       .update(locked_until=None, failed=job.attempts >= MAX_ATTEMPTS,
+                               run_after=timezone.now() + delay,
+                               error=traceback.format_exc())
+        return False
+
+
+def work(limit=10):
+    """
+    Runs the due jobs, returns the number of jobs that were run
+    """
+    claimed = writes.run(claim, limit)
+    for job in claimed:
+        perform(job)
+    return len(claimed)
+
+
+class Pool(object):
+    """
+    Threads running jobs in the background, woken up when jobs are queued
+    """
+    def __init__(self, threads=THREADS):
+        self.size = threads
+        self.event = threading.Event()
+        self.stopped = False
+        self.threads = []
+
+    def start(self):
+        for number in range(self.size):
+            thread = threading.Thread(target=self.loop, name='djforum-jobs-{}'.format(number))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def wake(self):
+        self.event.set()
+
+    def stop(self):
+        self.stopped = True
+        self.event.set()
+        for thread in self.threads:
+            thread.join()
+
+    def loop(self):
+        try:
+            while not self.stopped:
+                try:
+                    ran = work()
+                except Exception:
+                    logger.exception("Can't claim jobs")
+                    ran = 0
+                if not ran:
+                    self.event.wait(POLL_INTERVAL)
+                    self.event.clear()
+        finally:
+            # every thread has its own connection
+            connection.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Starts the pool of the process on the first call, it's stopped when the
+    process exits
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = Pool().start()
+            atexit.register(_pool.stop)
+    return _pool
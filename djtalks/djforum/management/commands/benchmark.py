@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors:
+    - qweqwe
+"""
+import json
+import os
+import subprocess
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test.client import Client
+from django.test.testcases import (disable_transaction_methods, restore_transaction_methods,
+                                   nop)
+
+from djtalks.djforum import ratelimit
+from djtalks.djforum import viewcounts
+from djtalks.djforum.models import Forum, Topic, Post, PrivateMessage
+from djtalks.djforum.permissions import ForumPermissions
+
+
+@contextmanager
+def rolled_back():
+    """
+    Runs the block in a transaction that is rolled back at the end, even
+    though the views commit their own transactions, the way TestCase does
+    """
+    if transaction.commit is nop:
+        # already running inside of a TestCase
+        yield
+        return
+    transaction.enter_transaction_management()
+    transaction.managed(True)
+    disable_transaction_methods()
+    try:
+        yield
+    finally:
+        restore_transaction_methods()
+        transaction.rollback()
+        transaction.leave_transaction_management()
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(__file__),
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+
+class Command(NoArgsCommand):
+    help = ("Measures wall time and SQL queries of the hot views through the test "
+            "client and writes the results as JSON. Writes are rolled back, but "
+            "the cache is cleared, so run it against a benchmark database, e.g. "
+            "one filled by the generate command.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--repeat', type='int', default=10,
+                    help="Number of warm runs of every scenario"),
+        make_option('--username', default=None,
+                    help="User to log in as, the first generated user by default"),
+        make_option('--password', default='password'),
+        make_option('--output', default=None,
+                    help="File to write the JSON results to instead of stdout"),
+    )
+
+    def handle_noargs(self, **options):
+        user = self.get_user(options['username'])
+        # the debug toolbar is shown to INTERNAL_IPS, keep it out of the timings
+        self.client = Client(REMOTE_ADDR='192.0.2.1')
+        if not self.client.login(username=user.username, password=options['password']):
+            raise CommandError("Can't log in as {}".format(user.username))
+        scenarios = self.scenarios(user)
+
+        results = {}
+        debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        try:
+            # the post scenarios submit more often than the limits allow
+            with rolled_back(), ratelimit.disabled():
+                for name, method, url, data in scenarios:
+                    results[name] = self.run(method, url, data, options['repeat'])
+                    self.stderr.write("{}: {median_ms:.1f} ms, {queries} queries\n"
+                                      .format(name, **results[name]))
+        finally:
+            connection.use_debug_cursor = debug_cursor
+            viewcounts.counter.take()
+            cache.clear()
+
+        report = dict(revision=git_revision(), created=datetime.utcnow().isoformat(),
+                      repeat=options['repeat'], dataset=self.dataset(), scenarios=results)
+        output = open(options['output'], 'w') if options['output'] else self.stdout
+        json.dump(report, output, indent=2, sort_keys=True)
+        output.write('\n')
+        if options['output']:
+            output.close()
+
+    def get_user(self, username):
+        users = User.objects.all()
+        if username:
+            users = users.filter(username=username)
+        else:
+            users = users.filter(username__startswith='user').order_by('id')
+        users = list(users[:1])
+        if not users:
+            raise CommandError("No user to log in as, run generate first")
+        return users[0]
+
+    def scenarios(self, user):
+        """
+        Picks the busiest forum and topic the user can see and returns
+        (name, method, url, data) of every scenario
+        """
+        permissions = ForumPermissions.for_user(user.id)
+        forums = Topic.objects.values_list('forum').annotate(topics=Count('id'))\
+                              .order_by('-topics')
+        forum_id = next((forum_id for forum_id, _ in forums.iterator()
+                         if permissions.can_view(forum_id)), None)
+        if forum_id is None:
+            raise CommandError("{} can't see any topics".format(user.username))
+        topics = Topic.objects.filter(forum__in=[forum_id for forum_id, _ in
+                                                 Forum.objects.values_list('id', 'path')
+                                                 if permissions.can_view(forum_id)])
+        topic_id = topics.order_by('-post_count').values_list('id', flat=True)[0]
+        recipient = User.objects.filter(username__startswith='user').exclude(pk=user.pk)\
+                                .order_by('id')[:1]
+        forum, topic = '/forum/{}/'.format(forum_id), '/topic/{}/'.format(topic_id)
+        scenarios = [
+            ('index', 'get', '/', None),
+            ('forum', 'get', forum, None),
+            ('forum_last_page', 'get', forum + '?page=last', None),
+            ('topic', 'get', topic, None),
+            ('topic_last_page', 'get', topic + '?page=last', None),
+            ('inbox', 'get', '/inbox/', None),
+            ('post', 'post', topic, dict(message='[b]benchmark[/b] reply')),
+        ]
+        if recipient:
+            scenarios.append(('new_pm', 'post', '/inbox/new/',
+                              dict(recipients=recipient[0].username, subject='benchmark',
+                                   message='benchmark message')))
+        return scenarios
+
+    def request(self, method, url, data):
+        start = time.time()
+        response = getattr(self.client, method)(url, data or {})
+        elapsed = (time.time() - start) * 1000
+        if response.status_code not in (200, 302):
+            raise CommandError("{} {} returned {}".format(method.upper(), url,
+                                                          response.status_code))
+        # queries are reset when every request starts
+        return elapsed, len(connection.queries)
+
+    def run(self, method, url, data, repeat):
+        """
+        The first run is made with an empty cache, the rest of the runs
+        measure the steady state
+        """
+        cache.clear()
+        cold_ms, cold_queries = self.request(method, url, data)
+        runs = [self.request(method, url, data) for _ in range(repeat)]
+        times = [elapsed for elapsed, _ in runs]
+        return dict(method=method.upper(), url=url, cold_ms=round(cold_ms, 3),
+                    cold_queries=cold_queries, median_ms=round(median(times), 3),
+                    min_ms=round(min(times), 3), max_ms=round(max(times), 3),
+                    queries=median([queries for _, queries in runs]))
+
+    def dataset(self):
+        return dict((model._meta.db_table, model.objects.count())
+                    for model in (User, Forum, Topic, Post, PrivateMessage))
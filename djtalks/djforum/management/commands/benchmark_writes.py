@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors:
+    - qweqwe
+"""
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection
+from django.test.client import Client
+
+from djtalks.djforum import ratelimit
+from djtalks.djforum import sqlite
+from djtalks.djforum import writes
+from djtalks.djforum.management.commands.benchmark import Command as Benchmark
+
+#: (name, pragmas, deferred counters, retries) of the compared setups
+MODES = (
+    ('baseline', {'journal_mode': 'DELETE'}, False, 0),
+    ('production', sqlite.PRAGMAS or {'journal_mode': 'WAL', 'synchronous': 'NORMAL',
+                                      'busy_timeout': 5000}, True, writes.RETRIES),
+)
+
+
+def worker(path, mode, username, password, url, posts, results):
+    """
+    Posts replies to the topic from a separate process with its own
+    connection to the copy of the database
+    """
+    name, pragmas, defer, retries = mode
+    connection.close()
+    connection.settings_dict['NAME'] = path
+    sqlite.PRAGMAS, writes.DEFER, writes.RETRIES = pragmas, defer, retries
+    ratelimit.LIMITS = {}
+    client = Client(REMOTE_ADDR='192.0.2.1')
+    done = errors = 0
+    try:
+        if not client.login(username=username, password=password):
+            raise CommandError("Can't log in as {}".format(username))
+        for number in range(posts):
+            try:
+                response = client.post(url, dict(message='concurrent reply {}'.format(number)))
+                if response.status_code in (200, 302):
+                    done += 1
+                else:
+                    errors += 1
+            except Exception:
+                errors += 1
+    finally:
+        results.put((done, errors))
+
+
+class Command(NoArgsCommand):
+    help = ("Measures write throughput of several processes posting to the same "
+            "topic, with the default SQLite setup and with the production one "
+            "(WAL, DJFORUM_SQLITE_PRAGMAS, deferred counters and retries). Runs "
+            "on copies of the database, e.g. one filled by the generate command.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--workers', type='int', default=8,
+                    help="Number of processes posting at the same time"),
+        make_option('--posts', type='int', default=50,
+                    help="Number of posts made by every process"),
+        make_option('--username', default=None,
+                    help="User to post as, the first generated user by default"),
+        make_option('--password', default='password'),
+        make_option('--output', default=None,
+                    help="File to write the JSON results to instead of stdout"),
+    )
+
+    def handle_noargs(self, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError("Only SQLite databases are benchmarked")
+        benchmark = Benchmark()
+        user = benchmark.get_user(options['username'])
+        url = next(url for name, _, url, _ in benchmark.scenarios(user) if name == 'post')
+        # the copy must have everything, including pages still in the WAL
+        connection.cursor().execute('PRAGMA wal_checkpoint')
+        source = settings.DATABASES['default']['NAME']
+        connection.close()
+
+        results = {}
+        directory = tempfile.mkdtemp()
+        try:
+            for mode in MODES:
+                path = os.path.join(directory, mode[0] + '.sqlite')
+                shutil.copyfile(source, path)
+                results[mode[0]] = self.run(path, mode, user.username, options, url)
+                self.stderr.write("{}: {posts_per_second:.1f} posts/s, {errors} errors\n"
+                                  .format(mode[0], **results[mode[0]]))
+        finally:
+            shutil.rmtree(directory)
+
+        report = dict(workers=options['workers'], posts=options['posts'], url=url,
+                      modes=results)
+        output = open(options['output'], 'w') if options['output'] else self.stdout
+        json.dump(report, output, indent=2, sort_keys=True)
+        output.write('\n')
+        if options['output']:
+            output.close()
+
+    def run(self, path, mode, username, options, url):
+        queue = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=worker,
+                                             args=(path, mode, username, options['password'],
+                                                   url, options['posts'], queue))
+                     for _ in range(options['workers'])]
+        start = time.time()
+        for process in processes:
+            process.start()
+        counts = [queue.get() for _ in processes]
+        for process in processes:
+            process.join()
+        seconds = time.time() - start
+        done = sum(done for done, _ in counts)
+        return dict(posts=done, errors=sum(errors for _, errors in counts),
+                    seconds=round(seconds, 3), posts_per_second=round(done / seconds, 1))
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors:
+    - qweqwe
+"""
+import json
+from optparse import make_option
+
+from django.contrib.auth.models import User, Group
+from django.core.management.base import NoArgsCommand
+from object_permissions.registration import permission_map
+
+from djtalks.djforum.models import Forum, Topic, Post, PrivateMessage, Inbox
+from djtalks.djforum.utils import queryset_chunks
+
+PERMISSION_FIELDS = ('id', 'user_id', 'group_id', 'obj_id', 'view', 'edit', 'destroy')
+
+#: fields of every dumped model, in the order models are dumped
+FIELDS = (
+    ('user', User, ('id', 'username', 'first_name', 'last_name', 'email', 'password',
+                    'is_staff', 'is_active', 'is_superuser', 'last_login', 'date_joined')),
+    ('group', Group, ('id', 'name')),
+    ('membership', User.groups.through, ('id', 'user_id', 'group_id')),
+    ('forum', Forum, ('id', 'name', 'description', 'updated', 'parent_id', 'path',
+                      'depth', 'is_category')),
+    ('forum_permission', permission_map[Forum], PERMISSION_FIELDS),
+    ('topic', Topic, ('id', 'forum_id', 'subject', 'created', 'author_id', 'views')),
+    ('topic_permission', permission_map[Topic], PERMISSION_FIELDS),
+    ('post', Post, ('id', 'topic_id', 'author_id', 'created', 'updated', 'updated_by_id',
+                    'message', 'user_ip', 'reply_to_id', 'path', 'depth')),
+    ('pm', PrivateMessage, ('id', 'sender_id', 'conversation_id', 'parent_id', 'depth',
+                            'subject', 'message')),
+)
+
+
+def encode(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+class Command(NoArgsCommand):
+    help = ("Dumps users, groups, forums, topics, posts, private messages and the "
+            "forum and topic permissions as JSON Lines, one object per line, for "
+            "loadboard. Denormalized fields are left out.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--output', default=None,
+                    help="File to write to instead of stdout"),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=1000,
+                    help="Number of rows fetched at once"),
+    )
+
+    def handle_noargs(self, **options):
+        output = open(options['output'], 'w') if options['output'] else self.stdout
+        try:
+            for name, model, fields in FIELDS:
+                rows = model.objects.values_list(*fields)
+                for chunk in queryset_chunks(rows, options['chunk_size']):
+                    recipients = self.recipients(chunk) if model is PrivateMessage else {}
+                    for row in chunk:
+                        obj = dict((field, encode(value)) for field, value in zip(fields, row))
+                        obj['model'] = name
+                        if model is PrivateMessage:
+                            obj['recipients'] = recipients.get(row[0], [])
+                        output.write(json.dumps(obj))
+                        output.write('\n')
+        finally:
+            if options['output']:
+                output.close()
+
+    def recipients(self, chunk):
+        """
+        Returns [recipient_id, is_read] pairs of every message in the chunk
+        """
+        recipients = {}
+        rows = Inbox.objects.filter(message__in=[row[0] for row in chunk])\
+                            .values_list('message', 'recipient', 'is_read').order_by('id')
+        for message_id, recipient_id, is_read in rows:
+            recipients.setdefault(message_id, []).append([recipient_id, is_read])
+        return recipients
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors:
+    - qweqwe
+"""
+import random
+from itertools import islice
+from collections import defaultdict
+from datetime import timedelta
+from optparse import make_option
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User, Group
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+from object_permissions.registration import permission_map
+
+from djtalks.djforum import avatars
+from djtalks.djforum import markup
+from djtalks.djforum import versions
+from djtalks.djforum.models import (Forum, Topic, Post, Profile, PrivateMessage,
+                                    Inbox, random64bit)
+from djtalks.djforum.utils import bulk_insert, explicit_timestamps
+
+#: password of all generated users
+PASSWORD = 'password'
+WORDS = ('forum topic post reply thread board django python query index cache '
+         'page tree path user message database update select insert delete '
+         'benchmark latency server client request response template').split()
+#: posts are committed in transactions of this many rows
+COMMIT_EVERY = 20000
+#: share of posts that reply to an earlier post of their topic
+REPLY_SHARE = 0.25
+
+
+def next_id(model):
+    return (model.objects.aggregate(Max('id'))['id__max'] or 0) + 1
+
+
+class Command(NoArgsCommand):
+    help = ("Fills the database with a large synthetic board: a deep tree of forums, "
+            "topics with a skewed number of posts, users with permissions and "
+            "private conversations. Denormalized counters are filled in as well.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--forums', type='int', default=1000,
+                    help="Number of forums"),
+        make_option('--depth', type='int', default=8,
+                    help="Maximum depth of the forum tree"),
+        make_option('--users', type='int', default=1000,
+                    help="Number of users"),
+        make_option('--topics', type='int', default=20000,
+                    help="Number of topics"),
+        make_option('--posts', type='int', default=1000000,
+                    help="Number of posts, at least one per topic"),
+        make_option('--conversations', type='int', default=2000,
+                    help="Number of private conversations"),
+        make_option('--seed', type='int', default=0,
+                    help="Seed of the random generator, the same seed gives the same board"),
+    )
+
+    @transaction.commit_manually
+    def handle_noargs(self, **options):
+        self.random = random.Random(options['seed'])
+        self.now = timezone.now()
+        self.messages = self.make_messages()
+        try:
+            users = self.create_users(options['users'])
+            forums = self.plan_forums(options['forums'], options['depth'])
+            topics = self.plan_topics(forums, users, options['topics'],
+                                      max(options['posts'], options['topics']))
+            with explicit_timestamps(Forum, Topic, Post):
+                self.create_forums(forums, topics)
+                bulk_insert(Topic, (Topic(**topic) for topic in topics))
+                transaction.commit()
+                post_counts = self.create_posts(topics, users)
+            self.create_profiles(post_counts)
+            self.grant(forums, users)
+            self.create_conversations(users, options['conversations'])
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+        # rows were inserted without signals, so nothing has been invalidated
+        versions.bump('forums', 'tree', 'permissions')
+        self.stdout.write("{} forums, {} topics, {} posts, {} users generated, "
+                          "run reindex to make them searchable\n".format(
+                          len(forums), len(topics), sum(post_counts.values()), len(users)))
+
+    def make_messages(self):
+        """
+        Returns a pool of (message, html) pairs, rendering every post
+        separately would make generation CPU bound
+        """
+        messages = []
+        for i in range(200):
+            words = [self.random.choice(WORDS) for _ in range(self.random.randint(5, 80))]
+            if i % 3 == 0:
+                words.insert(0, '[b]{}[/b]'.format(words.pop(0)))
+            message = ' '.join(words)
+            messages.append((message, markup.render(message)))
+        return messages
+
+    def create_users(self, count):
+        first = next_id(User)
+        password = make_password(PASSWORD)
+        bulk_insert(User, (User(id=first + i, username='user{}'.format(first + i),
+                                email='user{}@example.com'.format(first + i),
+                                password=password, date_joined=self.now)
+                           for i in range(count)))
+        return range(first, first + count)
+
+    def plan_forums(self, count, depth):
+        """
+        Builds the tree in memory. Parents are picked mostly among the recently
+        added forums, so branches grow deep instead of wide.
+        """
+        first = next_id(Forum)
+        roots = max(1, min(10, count // 100))
+        forums, eligible = [], []
+        for i in range(count):
+            forum = dict(id=first + i, name=' '.join(self.random.sample(WORDS, 2)),
+                         parent_id=None, path='', depth=0)
+            if i >= roots and eligible:
+                parent = eligible[int(len(eligible) * self.random.random() ** 0.3)]
+                forum.update(parent_id=parent['id'], path='{}{}.'.format(parent['path'],
+                                                                         parent['id']),
+                             depth=parent['depth'] + 1)
+            forums.append(forum)
+            if forum['depth'] < depth - 1:
+                eligible.append(forum)
+        parents = set(forum['parent_id'] for forum in forums)
+        for forum in forums:
+            forum['has_subforums'] = forum['id'] in parents
+        return forums
+
+    def plan_topics(self, forums, users, count, posts):
+        """
+        Spreads topics over forums and posts over topics with heavy tails: a few
+        forums and topics get most of the traffic, like on a real board
+        """
+        first_topic, first_post = next_id(Topic), next_id(Post)
+        weights = [self.random.paretovariate(1.2) for _ in range(count)]
+        scale = (posts - count) / sum(weights)
+        start = self.now - timedelta(days=365)
+        topics = []
+        for i, weight in enumerate(weights):
+            created = start + timedelta(seconds=365 * 24 * 60 * 60 * i // count)
+            post_count = 1 + int(weight * scale)
+            topics.append(dict(
+                id=first_topic + i, subject=' '.join(self.random.sample(WORDS, 4)),
+                forum_id=forums[int(len(forums) * self.random.random() ** 2)]['id'],
+                author_id=self.random.choice(users), created=created,
+                post_count=post_count, views=post_count * self.random.randint(1, 20),
+                last_post_id=first_post + post_count - 1,
+                updated=created + timedelta(minutes=post_count - 1)))
+            first_post += post_count
+        return topics
+
+    def create_forums(self, forums, topics):
+        """
+        Inserts forums with their counters and last posts, topics are added
+        to the forum they are in and all its ancestors
+        """
+        by_id = dict((forum['id'], forum) for forum in forums)
+        for forum in forums:
+            forum.update(post_count=0, topic_count=0, last_post_id=None, updated=None)
+        for topic in topics:
+            forum = by_id[topic['forum_id']]
+            for forum_id in Forum.path_to_lineage(forum['path'], forum['id']):
+                ancestor = by_id[forum_id]
+                ancestor['post_count'] += topic['post_count']
+                ancestor['topic_count'] += 1
+                if ancestor['updated'] is None or ancestor['updated'] < topic['updated']:
+                    ancestor.update(last_post_id=topic['last_post_id'],
+                                    updated=topic['updated'])
+        for forum in forums:
+            forum['updated'] = forum['updated'] or self.now
+        bulk_insert(Forum, (Forum(**forum) for forum in forums))
+
+    def create_posts(self, topics, users):
+        """
+        Streams posts in, only the current chunk and the threads of the current
+        topic are kept in memory. REPLY_SHARE of the posts reply to an earlier
+        post of their topic. Returns the number of posts of every user.
+        """
+        counts = defaultdict(int)
+
+        def posts():
+            for topic in topics:
+                first = topic['last_post_id'] - topic['post_count'] + 1
+                # (id, path, depth) of the posts of the topic
+                thread = []
+                for i in range(topic['post_count']):
+                    author_id = self.random.choice(users)
+                    counts[author_id] += 1
+                    message, html = self.random.choice(self.messages)
+                    reply_to = None
+                    if thread and self.random.random() < REPLY_SHARE:
+                        reply_to, parent_path, parent_depth = self.random.choice(thread)
+                        path, depth = Post.place(first + i, parent_path, parent_depth)
+                    else:
+                        path, depth = Post.place(first + i)
+                    thread.append((first + i, path, depth))
+                    yield Post(id=first + i, topic_id=topic['id'], author_id=author_id,
+                               created=topic['created'] + timedelta(minutes=i),
+                               message=message, body_html=html,
+                               body_version=markup.RENDERER_VERSION,
+                               reply_to_id=reply_to, path=path, depth=depth)
+
+        total, stream = 0, posts()
+        while True:
+            inserted = bulk_insert(Post, islice(stream, COMMIT_EVERY))
+            transaction.commit()
+            total += inserted
+            if inserted < COMMIT_EVERY:
+                break
+            self.stdout.write("{} posts inserted\n".format(total))
+        return counts
+
+    def create_profiles(self, post_counts):
+        emails = User.objects.filter(username__startswith='user').values_list('id', 'email')
+        bulk_insert(Profile, (Profile(user_id=user_id, post_count=post_counts[user_id],
+                                      avatar_hash=avatars.email_hash(email))
+                              for user_id, email in emails.iterator()
+                              if user_id in post_counts))
+
+    def grant(self, forums, users):
+        """
+        Members see every root forum except the last one, which is visible
+        to one user out of ten only. Anonymous users see the first root.
+        """
+        roots = [forum['id'] for forum in forums if forum['parent_id'] is None]
+        members, _ = Group.objects.get_or_create(name=settings.REGISTRATION_DEFAULT_GROUP_NAME)
+        anonymous, _ = User.objects.get_or_create(pk=settings.ANONYMOUS_USER_ID,
+                                                  defaults=dict(username='anonymous'))
+        bulk_insert(User.groups.through, (User.groups.through(user_id=user_id,
+                                                              group_id=members.id)
+                                          for user_id in users))
+        Permissions = permission_map[Forum]
+        public, private = (roots[:-1], roots[-1:]) if len(roots) > 1 else (roots, [])
+        grants = [Permissions(group=members, obj_id=forum_id, view=True)
+                  for forum_id in public]
+        grants.append(Permissions(user=anonymous, obj_id=roots[0], view=True))
+        grants.extend(Permissions(user_id=user_id, obj_id=forum_id, view=True)
+                      for user_id in users[::10] for forum_id in private)
+        bulk_insert(Permissions, grants)
+
+    def create_conversations(self, users, count):
+        """
+        Conversations of 2-4 users, every message is a reply to one of the
+        previous messages and is delivered to everyone but its sender
+        """
+        if len(users) < 2:
+            return
+        message_id = next_id(PrivateMessage)
+        messages, deliveries = [], []
+        for _ in range(count):
+            members = self.random.sample(users, min(len(users), self.random.randint(2, 4)))
+            conversation_id = random64bit()
+            subject = ' '.join(self.random.sample(WORDS, 3))
+            thread = []
+            for i in range(self.random.randint(1, 10)):
+                parent = self.random.choice(thread) if thread else None
+                sender = self.random.choice(members)
+                message = PrivateMessage(
+                    id=message_id, sender_id=sender, conversation_id=conversation_id,
+                    parent_id=parent.id if parent else None,
+                    depth=parent.depth + 1 if parent and len(members) > 2 else 0,
+                    subject=subject, message=self.random.choice(self.messages)[0])
+                thread.append(message)
+                deliveries.extend(Inbox(message_id=message_id, recipient_id=recipient,
+                                        is_read=self.random.random() < 0.8)
+                                  for recipient in members if recipient != sender)
+                message_id += 1
+            messages.extend(thread)
+        bulk_insert(PrivateMessage, messages)
+        bulk_insert(Inbox, deliveries)
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors:
+    - qweqwe
+"""
+import json
+import sys
+from optparse import make_option
+
+from django.contrib.auth.models import User, Group
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.utils.dateparse import parse_datetime
+
+from djtalks.djforum import avatars
+from djtalks.djforum import markup
+from djtalks.djforum import versions
+from djtalks.djforum.management.commands.dumpboard import FIELDS
+from djtalks.djforum.models import Forum, Topic, Post, Profile, PrivateMessage, Inbox
+from djtalks.djforum.utils import bulk_insert, explicit_timestamps
+
+
+def table(model):
+    return connection.ops.quote_name(model._meta.db_table)
+
+
+class Command(BaseCommand):
+    args = '<dump.jsonl>'
+    help = ("Loads a JSON Lines dump made by dumpboard with bulk inserts, keeping "
+            "the ids, and recomputes all the denormalized fields at the end. "
+            "Memory use doesn't depend on the size of the dump. Groups are matched "
+            "by name. The recomputation uses correlated UPDATEs that MySQL can't "
+            "run, so MySQL databases are refused.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size', default=1000,
+                    help="Number of objects inserted in a transaction"),
+    )
+
+    @transaction.commit_manually
+    def handle(self, *args, **options):
+        if len(args) > 1:
+            raise CommandError("Expected a single dump file")
+        if connection.vendor == 'mysql':
+            raise CommandError("MySQL can't update a table from a subquery of the same "
+                               "table, load the dump into SQLite or PostgreSQL")
+        input = open(args[0]) if args else sys.stdin
+        self.models = dict((name, (model, fields)) for name, model, fields in FIELDS)
+        self.chunk_size = options['chunk_size']
+        self.pending, self.deliveries = {}, []
+        #: dumped group id -> id of the group with the same name here
+        self.groups = {}
+        counts = {}
+        try:
+            # bulk inserts send no signals, so none of the counter hooks run
+            # and posts are rendered here instead of in Post.pre_save
+            with explicit_timestamps(Forum, Topic, Post):
+                for number, line in enumerate(input, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        obj = json.loads(line)
+                        name = obj.pop('model')
+                    except (ValueError, KeyError):
+                        raise CommandError("Line {} is not a dumped object".format(number))
+                    self.add(name, obj)
+                    counts[name] = counts.get(name, 0) + 1
+                self.flush()
+            self.reset_sequences()
+            self.recompute()
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+        finally:
+            if args:
+                input.close()
+        versions.bump('forums', 'tree', 'permissions')
+        self.stdout.write(', '.join('{} {}s'.format(count, name)
+                                    for name, count in sorted(counts.items())))
+        self.stdout.write(" loaded, run reindex to make them searchable\n")
+
+    def add(self, name, obj):
+        if name not in self.models:
+            raise CommandError("Unknown model {}".format(name))
+        model, fields = self.models[name]
+        if self.pending and name not in self.pending:
+            # dumps are ordered by model, so only one model is pending at a time
+            self.flush()
+        for field in model._meta.local_fields:
+            if field.get_internal_type() == 'DateTimeField' and obj.get(field.attname):
+                obj[field.attname] = parse_datetime(obj[field.attname])
+        if model is Group:
+            # the default group of new users may exist already
+            self.groups[obj['id']] = Group.objects.get_or_create(name=obj['name'])[0].id
+            return
+        if 'group_id' in fields:
+            # nothing refers to memberships and permissions, they are numbered
+            # here since rows of the existing groups may be in the tables
+            obj.pop('id', None)
+            if obj.get('group_id'):
+                obj['group_id'] = self.groups[obj['group_id']]
+        if model is PrivateMessage:
+            self.deliveries.extend(Inbox(message_id=obj['id'], recipient_id=recipient_id,
+                                         is_read=is_read)
+                                   for recipient_id, is_read in obj.pop('recipients', []))
+        instance = model(**dict((field, obj[field]) for field in fields if field in obj))
+        if model is Post:
+            instance.body_html = markup.render(instance.message)
+            instance.body_version = markup.RENDERER_VERSION
+            # dumps made before threading have no paths, their posts are roots
+            if not instance.path:
+                instance.path, instance.depth = Post.place(instance.id)
+        self.pending.setdefault(name, []).append(instance)
+        if len(self.pending[name]) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        for name, objects in self.pending.items():
+            bulk_insert(self.models[name][0], objects)
+        bulk_insert(Inbox, self.deliveries)
+        self.pending, self.deliveries = {}, []
+        transaction.commit()
+
+    def reset_sequences(self):
+        cursor = connection.cursor()
+        for sql in connection.ops.sequence_reset_sql(no_style(), [model for _, model, _
+                                                                  in FIELDS] + [Inbox]):
+            cursor.execute(sql)
+
+    def recompute(self):
+        """
+        Recomputes counters, last posts and `has_subforums` with one UPDATE
+        per table, subtrees are found by the materialized path. Avatar hashes
+        are computed in python.
+        """
+        cursor = connection.cursor()
+        params = dict(forum=table(Forum), topic=table(Topic), post=table(Post),
+                      profile=table(Profile), user=table(User))
+        cursor.execute("""
+            UPDATE {topic} SET
+                post_count = (SELECT COUNT(*) FROM {post} p WHERE p.topic_id = {topic}.id),
+                last_post_id = (SELECT p.id FROM {post} p WHERE p.topic_id = {topic}.id
+                                ORDER BY p.created DESC, p.id DESC LIMIT 1),
+                updated = COALESCE((SELECT MAX(p.created) FROM {post} p
+                                    WHERE p.topic_id = {topic}.id), {topic}.created)
+        """.format(**params))
+        # the subtree of the forum is the forum itself and the forums whose
+        # path starts with its path followed by its id
+        subtree = """
+            FROM {topic} t INNER JOIN {forum} f ON t.forum_id = f.id
+            WHERE f.id = {forum}.id OR f.path LIKE {forum}.path || {forum}.id || '.%%'
+        """.format(**params)
+        cursor.execute("""
+            UPDATE {forum} SET
+                topic_count = (SELECT COUNT(*) {subtree}),
+                post_count = (SELECT COALESCE(SUM(t.post_count), 0) {subtree}),
+                last_post_id = (SELECT t.last_post_id {subtree}
+                                ORDER BY t.updated DESC, t.last_post_id DESC LIMIT 1),
+                updated = COALESCE((SELECT MAX(t.updated) {subtree}), {forum}.updated),
+                has_subforums = EXISTS (SELECT 1 FROM {forum} c WHERE c.parent_id = {forum}.id)
+        """.format(subtree=subtree, **params))
+        cursor.execute("""
+            INSERT INTO {profile} (user_id, post_count, avatar_hash)
+            SELECT u.id, 0, '' FROM {user} u
+            WHERE NOT EXISTS (SELECT 1 FROM {profile} p WHERE p.user_id = u.id)
+        """.format(**params))
+        cursor.execute("""
+            UPDATE {profile} SET post_count = (SELECT COUNT(*) FROM {post} p
+                                               WHERE p.author_id = {profile}.user_id)
+        """.format(**params))
+        # SQLite has no md5()
+        profiles = Profile.objects.filter(avatar_hash='').values_list('id', 'user__email')
+        for profile_id, email in list(profiles):
+            Profile.objects.filter(pk=profile_id).update(avatar_hash=avatars.email_hash(email))
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors:
+    - qweqwe
+"""
+from collections import defaultdict
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from django.db.models import Count, Max
+
+from djtalks.djforum import avatars
+from djtalks.djforum.models import Forum, Topic, Post, Profile
+from djtalks.djforum.utils import chunks
+
+#: SQLite does not allow more than 999 variables in a single statement
+BATCH_SIZE = 500
+
+
+class Command(NoArgsCommand):
+    help = ("Recalculates denormalized post and topic counters, avatar hashes and "
+            "missing topic update times and fixes the drift")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help="Only report the rows that have drifted"),
+    )
+
+    def handle_noargs(self, **options):
+        self.dry_run = options['dry_run']
+        with transaction.commit_on_success():
+            self.fix('topics', Topic, 'post_count', self.topic_post_counts())
+            self.fill_topic_updated()
+            forum_posts, forum_topics = self.forum_counts()
+            self.fix('forums', Forum, 'post_count', forum_posts)
+            self.fix('forums', Forum, 'topic_count', forum_topics)
+            self.fix('profiles', Profile, 'post_count', self.profile_post_counts())
+            self.fix('profiles', Profile, 'avatar_hash', self.avatar_hashes())
+
+    def topic_post_counts(self):
+        counts = dict(Post.objects.values_list('topic').annotate(Count('id')).order_by())
+        return dict((topic_id, counts.get(topic_id, 0))
+                    for topic_id in Topic.objects.values_list('id', flat=True))
+
+    def fill_topic_updated(self):
+        """
+        Topics saved when `updated` could be NULL are skipped by the keyset
+        pagination of the forum, they get the time of their latest post
+        """
+        missing = list(Topic.objects.filter(updated=None).values_list('id', 'created'))
+        self.stdout.write("topics updated: {} drifted\n".format(len(missing)))
+        if self.dry_run:
+            return
+        for topic_id, created in missing:
+            latest = Post.objects.filter(topic=topic_id).aggregate(Max('created'))
+            Topic.objects.filter(pk=topic_id).update(updated=latest['created__max'] or created)
+
+    def forum_counts(self):
+        """
+        Counts posts and topics of every forum including all its subforums
+        """
+        direct_posts = dict(Post.objects.values_list('topic__forum')
+                                        .annotate(Count('id')).order_by())
+        direct_topics = dict(Topic.objects.values_list('forum')
+                                          .annotate(Count('id')).order_by())
+        posts, topics = defaultdict(int), defaultdict(int)
+        for forum_id, path in Forum.objects.values_list('id', 'path'):
+            for ancestor_id in Forum.path_to_lineage(path, forum_id):
+                posts[ancestor_id] += direct_posts.get(forum_id, 0)
+                topics[ancestor_id] += direct_topics.get(forum_id, 0)
+        return posts, topics
+
+    def profile_post_counts(self):
+        counts = dict(Post.objects.values_list('author').annotate(Count('id')).order_by())
+        existing = set(Profile.objects.values_list('user', flat=True))
+        missing = [user_id for user_id in counts if user_id not in existing]
+        if missing and not self.dry_run:
+            Profile.objects.bulk_create([Profile(user_id=user_id) for user_id in missing])
+        return dict((profile_id, counts.get(user_id, 0)) for profile_id, user_id
+                    in Profile.objects.values_list('id', 'user'))
+
+    def avatar_hashes(self):
+        return dict((profile_id, avatars.email_hash(email)) for profile_id, email
+                    in Profile.objects.values_list('id', 'user__email').iterator())
+
+    def fix(self, name, model, field, expected):
+        """
+        Updates all rows of the model whose `field` differs from expected
+        value. Rows that should get the same value are updated together.
+        """
+        drifted = defaultdict(list)
+        for pk, value in model.objects.values_list('id', field).iterator():
+            if value != expected.get(pk, 0):
+                drifted[expected.get(pk, 0)].append(pk)
+        total = sum(len(ids) for ids in drifted.values())
+        self.stdout.write("{} {}: {} drifted\n".format(name, field, total))
+        if self.dry_run:
+            return
+        for value, ids in drifted.items():
+            for chunk in chunks(ids, BATCH_SIZE):
+                model.objects.filter(id__in=chunk).update(**{field: value})
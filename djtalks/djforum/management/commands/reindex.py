@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors:
+    - qweqwe
+"""
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction, connection, DatabaseError
+
+from djtalks.djforum import search
+from djtalks.djforum.models import Topic, Post
+from djtalks.djforum.utils import queryset_chunks
+
+
+class Command(NoArgsCommand):
+    help = "Rebuilds the search index of topics and posts"
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size', default=1000,
+                    help="Number of documents indexed at once"),
+    )
+
+    @transaction.commit_manually
+    def handle_noargs(self, **options):
+        try:
+            backend = search.get_backend()
+            # databases created before the search was added have no FTS table
+            if search.BACKEND == 'auto' and connection.vendor == 'sqlite' and \
+                    not isinstance(backend, search.Fts5Backend):
+                try:
+                    search.Fts5Backend().create()
+                    backend = search._backend = search.Fts5Backend()
+                except DatabaseError:
+                    pass
+            backend.clear()
+            transaction.commit()
+
+            size = options['chunk_size']
+            topics = Topic.objects.values_list('id', 'forum_id', 'subject')
+            for chunk in queryset_chunks(topics, size):
+                backend.index([(-topic_id, topic_id, forum_id, subject, u'')
+                               for topic_id, forum_id, subject in chunk])
+                transaction.commit()
+            self.stdout.write("topics indexed\n")
+
+            total = 0
+            posts = Post.objects.values_list('id', 'topic_id', 'topic__forum_id', 'message')
+            for chunk in queryset_chunks(posts, size):
+                backend.index([(post_id, topic_id, forum_id, u'', message)
+                               for post_id, topic_id, forum_id, message in chunk])
+                transaction.commit()
+                total += len(chunk)
+                self.stdout.write("{} posts indexed\n".format(total))
+        except:
+            transaction.rollback()
+            raise
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors:
+    - qweqwe
+"""
+from multiprocessing import Pool, cpu_count
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from djtalks.djforum.markup import render, RENDERER_VERSION
+from djtalks.djforum.models import Post
+
+
+class Command(NoArgsCommand):
+    help = "Renders HTML of the posts rendered by the older versions of the renderer"
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--all', action='store_true', dest='all', default=False,
+                    help="Re-render all the posts"),
+        make_option('--processes', type='int', dest='processes', default=cpu_count(),
+                    help="Number of rendering processes"),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=1000,
+                    help="Number of posts fetched from the database at once"),
+    )
+
+    def handle_noargs(self, **options):
+        posts = Post.objects.all()
+        if not options['all']:
+            posts = posts.filter(body_version__lt=RENDERER_VERSION)
+        processes = options['processes']
+        pool = Pool(processes) if processes > 1 else None
+        mapper = pool.map if pool else map
+        last_id, total = 0, 0
+        try:
+            while True:
+                rows = list(posts.filter(id__gt=last_id).order_by('id')
+                                 .values_list('id', 'message')[:options['chunk_size']])
+                if not rows:
+                    break
+                htmls = mapper(render, [message for _, message in rows])
+                with transaction.commit_on_success():
+                    for (post_id, message), html in zip(rows, htmls):
+                        # posts edited meanwhile have been rendered when saved
+                        Post.objects.filter(pk=post_id, message=message)\
+                                    .update(body_html=html, body_version=RENDERER_VERSION)
+                last_id = rows[-1][0]
+                total += len(rows)
+                self.stdout.write("{} posts rendered\n".format(total))
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
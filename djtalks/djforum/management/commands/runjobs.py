@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors:
+    - qweqwe
+"""
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from djtalks.djforum import jobs
+from djtalks.djforum.models import Job
+
+
+class Command(NoArgsCommand):
+    help = ("Runs the jobs queued with DJFORUM_JOBS_MODE 'worker' or 'thread' until "
+            "interrupted, see djforum/jobs.py")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--threads', type='int', default=1,
+                    help="Number of threads running jobs"),
+        make_option('--once', action='store_true', default=False,
+                    help="Run the jobs that are due and exit"),
+        make_option('--retry-failed', action='store_true', dest='retry_failed', default=False,
+                    help="Queue the jobs that have failed too many times again"),
+    )
+
+    def handle_noargs(self, **options):
+        if options['retry_failed']:
+            with transaction.commit_on_success():
+                count = Job.objects.filter(failed=True).update(failed=False, attempts=0,
+                                                               locked_until=None)
+            self.stdout.write("{} failed jobs queued again\n".format(count))
+        if options['once']:
+            total = 0
+            while True:
+                ran = jobs.work()
+                total += ran
+                if not ran:
+                    break
+            self.stdout.write("{} jobs run\n".format(total))
+            return
+        pool = jobs.Pool(options['threads']).start()
+        try:
+            while True:
+                time.sleep(jobs.POLL_INTERVAL)
+        except KeyboardInterrupt:
+            pool.stop()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors:
+    - qweqwe
+
+Converts post messages written in a BBCode subset to HTML. Messages are
+rendered once when the post is saved and the result is stored in
+`Post.body_html` along with the version of the renderer, so the posts
+rendered by an older version can be found and re-rendered in bulk with the
+`rerender` command.
+
+Supported tags: [b], [i], [u], [s], [code], [quote], [quote=author],
+[url]link[/url] and [url=link]text[/url]. Everything else is escaped.
+"""
+import re
+
+from django.utils.encoding import force_unicode
+from django.utils.html import escape
+
+#: increase whenever output of the renderer changes
+RENDERER_VERSION = 1
+
+TAG_RE = re.compile(r'\[(/?)(b|i|u|s|code|quote|url)(?:=([^\]]*))?\]', re.I)
+URL_END_RE = re.compile(r'\[/url\]', re.I)
+URL_RE = re.compile(r'^(https?|ftp)://[^\s\[\]]+$|^mailto:[^\s\[\]]+$', re.I)
+
+SIMPLE_TAGS = dict(b='strong', i='em', u='u', s='del')
+CLOSING = dict([(tag, '</{}>'.format(html)) for tag, html in SIMPLE_TAGS.items()],
+               code='</code></pre>', quote='</blockquote>', url='</a>')
+
+
+def link(url, text):
+    return u'<a href="{}" rel="nofollow">{}'.format(url, text)
+
+
+def render_text(text, in_code):
+    if in_code:
+        return text
+    return text.replace('\n', '<br>\n')
+
+
+def render(message):
+    """
+    Renders message to HTML. Unbalanced closing tags are displayed as they
+    are and tags left open are closed at the end of the message.
+    """
+    text = force_unicode(escape(message)).replace('\r\n', '\n')
+    out, stack, pos = [], [], 0
+    for match in TAG_RE.finditer(text):
+        # the tag is inside [url]...[/url] that has been rendered already
+        if match.start() < pos:
+            continue
+        closing, name, arg = match.group(1), match.group(2).lower(), match.group(3)
+        in_code = 'code' in stack
+        if in_code and not (closing and name == 'code'):
+            continue
+        out.append(render_text(text[pos:match.start()], in_code))
+        pos = match.end()
+        tag = match.group(0)
+        if closing:
+            if name in stack:
+                while True:
+                    opened = stack.pop()
+                    out.append(CLOSING[opened])
+                    if opened == name:
+                        break
+            else:
+                out.append(tag)
+        elif name in SIMPLE_TAGS:
+            stack.append(name)
+            out.append(u'<{}>'.format(SIMPLE_TAGS[name]))
+        elif name == 'code':
+            stack.append(name)
+            out.append(u'<pre><code>')
+        elif name == 'quote':
+            stack.append(name)
+            out.append(u'<blockquote>')
+            if arg:
+                out.append(u'<cite>{} wrote:</cite>'.format(arg))
+        elif 'url' in stack:
+            out.append(tag)
+        elif arg is not None:
+            if URL_RE.match(arg):
+                stack.append(name)
+                out.append(link(arg, u''))
+            else:
+                out.append(tag)
+        else:
+            end = URL_END_RE.search(text, pos)
+            url = text[pos:end.start()] if end else None
+            if url and URL_RE.match(url):
+                out.append(link(url, url) + CLOSING['url'])
+                pos = end.end()
+            else:
+                out.append(tag)
+    out.append(render_text(text[pos:], 'code' in stack))
+    while stack:
+        out.append(CLOSING[stack.pop()])
+    return u''.join(out)
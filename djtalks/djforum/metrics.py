@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors:
+    - qweqwe
+
+Lightweight request instrumentation for production. For every view it
+records the number of SQL queries, time spent in the database, in
+template rendering and in the whole request into in-memory histograms,
+which :func:`djtalks.djforum.views.metrics` exports in the Prometheus
+text format.
+
+Views are labelled with their dotted path, the one used in `urls.py`.
+DJFORUM_QUERY_BUDGETS maps these paths to the most queries the view is
+expected to make, requests that go over the budget are logged, so N+1
+regressions show up right away:
+
+    DJFORUM_QUERY_BUDGETS = {'djtalks.djforum.views.inbox': 10}
+
+Histograms live in the memory of the process, every worker exports its
+own numbers.
+"""
+import bisect
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.template.base import Template
+
+QUERY_BUDGETS = getattr(settings, 'DJFORUM_QUERY_BUDGETS', {})
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERIES_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+logger = logging.getLogger('djtalks.djforum.metrics')
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # the last one counts observations above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        Returns (upper bound, number of observations <= bound) pairs, the
+        way Prometheus expects them
+        """
+        total, result = 0, []
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Registry(object):
+    #: name -> (help, buckets)
+    METRICS = (
+        ('djforum_request_seconds', 'Total time spent processing the request',
+         SECONDS_BUCKETS),
+        ('djforum_db_seconds', 'Time spent executing SQL queries', SECONDS_BUCKETS),
+        ('djforum_template_seconds', 'Time spent rendering templates', SECONDS_BUCKETS),
+        ('djforum_queries', 'Number of SQL queries', QUERIES_BUCKETS),
+    )
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.histograms = dict((name, {}) for name, _, _ in self.METRICS)
+            self.violations = {}
+
+    def observe(self, view, **values):
+        with self.lock:
+            for name, _, buckets in self.METRICS:
+                histograms = self.histograms[name]
+                if view not in histograms:
+                    histograms[view] = Histogram(buckets)
+                histograms[view].observe(values[name])
+
+    def violated(self, view):
+        with self.lock:
+            self.violations[view] = self.violations.get(view, 0) + 1
+
+    def export(self):
+        """
+        Renders all the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        with self.lock:
+            for name, help, _ in self.METRICS:
+                lines.append('# HELP {} {}'.format(name, help))
+                lines.append('# TYPE {} histogram'.format(name))
+                for view, histogram in sorted(self.histograms[name].items()):
+                    for bound, count in histogram.cumulative():
+                        lines.append('{}_bucket{{view="{}",le="{}"}} {}'
+                                     .format(name, view, bound, count))
+                    lines.append('{}_sum{{view="{}"}} {}'.format(name, view, histogram.sum))
+                    lines.append('{}_count{{view="{}"}} {}'
+                                 .format(name, view, histogram.count))
+            name = 'djforum_query_budget_violations_total'
+            lines.append('# HELP {} Requests that made more queries than the '
+                         'budget of the view'.format(name))
+            lines.append('# TYPE {} counter'.format(name))
+            for view, count in sorted(self.violations.items()):
+                lines.append('{}{{view="{}"}} {}'.format(name, view, count))
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+#: per-thread state of the request being processed
+local = threading.local()
+
+
+def instrument_templates():
+    """
+    Wraps `Template.render` to add the time spent in top level templates
+    to the current request, included templates are counted by the outer one
+    """
+    if getattr(Template.render, 'instrumented', False):
+        return
+    render = Template.render
+
+    def instrumented(self, context):
+        depth = getattr(local, 'depth', 0)
+        if depth or getattr(local, 'template_seconds', None) is None:
+            local.depth = depth + 1
+            try:
+                return render(self, context)
+            finally:
+                local.depth = depth
+        local.depth = 1
+        start = time.time()
+        try:
+            return render(self, context)
+        finally:
+            local.template_seconds += time.time() - start
+            local.depth = 0
+    instrumented.instrumented = True
+    Template.render = instrumented
+
+
+class MetricsMiddleware(object):
+    """
+    Should go first in MIDDLEWARE_CLASSES to include the time spent in
+    other middleware
+    """
+    def __init__(self):
+        instrument_templates()
+
+    def process_request(self, request):
+        request._metrics = dict(start=time.time(), view='unresolved', connections={})
+        for connection in connections.all():
+            # the debug cursor records every query with its time
+            request._metrics['connections'][connection.alias] = (
+                connection.use_debug_cursor, len(connection.queries))
+            connection.use_debug_cursor = True
+        local.template_seconds = 0
+        local.depth = 0
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if hasattr(request, '_metrics'):
+            request._metrics['view'] = '{}.{}'.format(view_func.__module__,
+                                                       view_func.__name__)
+
+    def process_response(self, request, response):
+        metrics = getattr(request, '_metrics', None)
+        if metrics is None:
+            return response
+        queries, db_seconds = 0, 0.0
+        for connection in connections.all():
+            debug, start = metrics['connections'].get(connection.alias, (None, 0))
+            executed = connection.queries[start:]
+            queries += len(executed)
+            db_seconds += sum(float(query['time']) for query in executed)
+            connection.use_debug_cursor = debug
+            # don't keep queries nobody else asked to record
+            if not (debug or settings.DEBUG):
+                del connection.queries[start:]
+        view = metrics['view']
+        registry.observe(view, djforum_request_seconds=time.time() - metrics['start'],
+                         djforum_db_seconds=db_seconds,
+                         djforum_template_seconds=local.template_seconds or 0,
+                         djforum_queries=queries)
+        local.template_seconds = None
+        budget = QUERY_BUDGETS.get(view)
+        if budget is not None and queries > budget:
+            registry.violated(view)
+            logger.warning('%s made %d queries, the budget is %d', view, queries, budget,
+                           extra=dict(request=request))
+        return response
@@ -1,18 +1,31 @@
 
+import base64
 import os
-from datetime import datetime
+import struct
 from hashlib import sha256
 
-from django.db import models
-from django.db.models import signals
+from django.db import models, connection
+from django.db.models import signals, F
 from django.db.models.query import QuerySet
+from django.db.backends.signals import connection_created
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.auth.models import User, Group
 
 import registration.signals
 
 from djtalks.djforum.fields import AutoOneToOneField
+from djtalks.djforum.pagination import encode_value
+from djtalks.djforum import avatars
+from djtalks.djforum import versions
+from djtalks.djforum import feed
+from djtalks.djforum import fragments
+from djtalks.djforum import jobs
+from djtalks.djforum import markup
+from djtalks.djforum import search
+from djtalks.djforum import sqlite
+from djtalks.djforum import writes
 from djtalks import settings
 
 
@@ -23,7 +36,7 @@ class ForumManager(models.Manager):
             """
             Finds all descendants of the forum
             """
-            query = dict(path__startswith=forum.path+str(forum.id))
+            query = dict(path__startswith=forum.subtree_path)
             if depth: query.update(dict(depth__lte=depth+forum.depth))
             return self.filter(**query)
 
@@ -32,13 +45,131 @@ class ForumManager(models.Manager):
     def get_query_set(self):
         return ForumManager.DescendantsQuerySet(self.model, using=self._db)
 
+    def propagate(self, lineage, posts=0, topics=0, last_post=None, updated=None):
+        """
+        Atomically shifts post and topic counters of every forum in the
+        lineage by the given deltas and sets their last post, with an UPDATE
+        for each regardless of the depth of the tree. The last post is only
+        set on forums that haven't got a newer one, count jobs may run out
+        of order.
+        """
+        if not lineage or not (posts or topics or last_post):
+            return
+        if posts or topics:
+            self.filter(id__in=lineage).update(post_count=F('post_count') + posts,
+                                               topic_count=F('topic_count') + topics)
+        if last_post:
+            updated = updated or timezone.now()
+            self.filter(id__in=lineage)\
+                .filter(models.Q(updated__isnull=True) | models.Q(updated__lte=updated))\
+                .update(last_post=last_post, updated=updated)
+        self.changed(lineage)
+
+    def update_last_post(self, forum_ids):
+        """
+        Sets the last post and `updated` of every forum to the latest post
+        of its subtree, for forums that have lost their last post or whose
+        subtree has changed
+        """
+        for forum in self.filter(id__in=forum_ids):
+            latest = Post.objects.filter(models.Q(topic__forum=forum.id) |
+                                         models.Q(topic__forum__path__startswith=forum.subtree_path))\
+                                 .order_by('-created', '-id').values_list('id', 'created')[:1]
+            if latest:
+                self.filter(pk=forum.id).update(last_post=latest[0][0], updated=latest[0][1])
+            else:
+                self.filter(pk=forum.id).update(last_post=None)
+        if forum_ids:
+            self.changed(forum_ids)
+
+    def changed(self, forum_ids):
+        """
+        Invalidates the cached forum lists and rows of the forums, once the
+        change is committed so that readers can't cache what they read
+        before it under the new versions
+        """
+        writes.after_commit(versions.bump, 'forums')
+        writes.after_commit(fragments.forums_changed, list(forum_ids))
+
+    def insert(self, forum, parent=None):
+        """
+        Saves the new forum as a child of the parent (or as a root forum)
+        """
+        forum.parent = parent
+        forum.path = parent.subtree_path if parent else ''
+        forum.depth = parent.depth + 1 if parent else 0
+        forum.save()
+        if parent and not parent.has_subforums:
+            self.filter(pk=parent.id).update(has_subforums=True)
+            parent.has_subforums = True
+        return forum
+
+    def move(self, forum, parent=None):
+        """
+        Moves the forum with all its descendants under the new parent (or to
+        the root). Paths and depths of the whole subtree are rewritten with
+        a single UPDATE.
+        """
+        forum = self.get(pk=forum.id)
+        if parent:
+            parent = self.get(pk=parent.id)
+            if forum.id in parent.lineage:
+                raise ValueError("Forum can't be moved into itself or its subforums")
+        if forum.parent_id == (parent.id if parent else None):
+            return forum
+        old_subtree_path, old_lineage = forum.subtree_path, forum.lineage
+        path = parent.subtree_path if parent else ''
+        depth = parent.depth + 1 if parent else 0
+
+        cursor = connection.cursor()
+        cursor.execute(
+            'UPDATE {} SET path = %s || substr(path, %s), depth = depth + %s '
+            'WHERE path LIKE %s'.format(connection.ops.quote_name(Forum._meta.db_table)),
+            [path + '{}.'.format(forum.id), len(old_subtree_path) + 1,
+             depth - forum.depth, old_subtree_path + '%'])
+        self.filter(pk=forum.id).update(parent=parent, path=path, depth=depth)
+
+        old_parent_id = forum.parent_id
+        forum.parent, forum.path, forum.depth = parent, path, depth
+        # common ancestors keep their counters
+        old_ancestors, new_ancestors = set(old_lineage[:-1]), set(forum.lineage[:-1])
+        self.propagate(old_ancestors - new_ancestors,
+                       posts=-forum.post_count, topics=-forum.topic_count)
+        self.propagate(new_ancestors - old_ancestors,
+                       posts=forum.post_count, topics=forum.topic_count)
+        self.update_last_post(list(old_ancestors ^ new_ancestors))
+        if parent:
+            self.filter(pk=parent.id).update(has_subforums=True)
+        if old_parent_id:
+            self.update_has_subforums(old_parent_id)
+        writes.after_commit(versions.bump, 'tree', 'forums')
+        return forum
+
+    def delete_subtree(self, forum):
+        """
+        Deletes the forum with all its descendants, their topics and posts
+        """
+        parent_id = forum.parent_id
+        self.filter(models.Q(pk=forum.id) | models.Q(path__startswith=forum.subtree_path))\
+            .delete()
+        if parent_id:
+            self.update_has_subforums(parent_id)
+
+    def update_has_subforums(self, forum_id):
+        has_subforums = self.filter(parent=forum_id).exists()
+        self.filter(pk=forum_id).update(has_subforums=has_subforums)
+
 class Forum(models.Model):
     name        = models.CharField(_('Name'), max_length=80)
     description = models.TextField(_('Description'), blank=True, default='')
     updated     = models.DateTimeField(_('Updated'), auto_now=True)
     post_count  = models.IntegerField(_('Post count'), blank=True, default=0)
     topic_count = models.IntegerField(_('Topic count'), blank=True, default=0)
-    last_post   = models.ForeignKey('Post', related_name='last_forum_post', blank=True, null=True)
+    # Django 1.4 merges SET_NULL updates of different fields of the same
+    # model into one UPDATE, which nullifies `parent` of unrelated forums,
+    # so the last post is replaced by Post.post_delete instead
+    last_post   = models.ForeignKey('Post', related_name='last_forum_post', blank=True, null=True,
+                                    on_delete=models.DO_NOTHING)
 
     parent      = models.ForeignKey('self', related_name='forums', verbose_name=_('Parent Board'), blank=True, null=True)
     path        = models.CharField(_('Path'), max_length=4096, blank=True, null=True, db_index=True)
@@ -52,6 +183,27 @@ class Forum(models.Model):
     def has_parent(self):
         return self.depth
 
+    @staticmethod
+    def path_to_lineage(path, forum_id):
+        """
+        Converts materialized path of the forum (e.g. "1.5.") to the list of
+        ids of all its ancestors and the forum itself: [1, 5, forum_id]
+        """
+        lineage = [int(i) for i in (path or '').split('.') if i]
+        lineage.append(forum_id)
+        return lineage
+
+    @property
+    def lineage(self):
+        return Forum.path_to_lineage(self.path, self.id)
+
+    @property
+    def subtree_path(self):
+        """
+        Path shared by all descendants of the forum and only by them
+        """
+        return '{}{}.'.format(self.path or '', self.id)
+
     @property
     def posts(self):
         return Post.objects.filter(topic__forum__id=self.id).select_related()
@@ -61,19 +213,14 @@ class Forum(models.Model):
         return Forum.objects.filter(parent=self)
 
     @staticmethod
-    def post_save(instance, **kwargs):
-        """
-        :type instance: :class:`~Forum`
-        """
+    def post_delete(instance, **kwargs):
         forum = instance
-        parent = forum.parent
-        if parent:
-            parent.updated = forum.updated
-            #todo all posts count
-            parent.post_count = parent.posts.count()
-            parent.last_post_id = forum.last_post_id
-            parent.save(force_update=True)
-
+        # if the parent is being deleted too then its own post_delete
+        # will subtract the counters of the whole subtree
+        if forum.parent_id and Forum.objects.filter(pk=forum.parent_id).exists():
+            Forum.objects.propagate(forum.lineage[:-1],
+                                    posts=-forum.post_count,
+                                    topics=-forum.topic_count)
 
     def __unicode__(self):
         return u'{}'.format(self.name)
@@ -83,23 +230,69 @@ class Topic(models.Model):
     forum   = models.ForeignKey(Forum, related_name='topics', verbose_name=_('Forum'))
     subject = models.CharField(_('Subject'), max_length=255)
     created = models.DateTimeField(_('Created'), auto_now_add=True)
-    updated = models.DateTimeField(_('Updated'), null=True)
+    updated = models.DateTimeField(_('Updated'), default=timezone.now)
     author  = models.ForeignKey(User, verbose_name=_('User'))
     views   = models.IntegerField(_('Views count'), blank=True, default=0)
     post_count = models.IntegerField(_('Post count'), blank=True, default=0)
-    last_post  = models.ForeignKey('Post', related_name='last_topic_post', blank=True, null=True)
+    last_post  = models.ForeignKey('Post', related_name='last_topic_post', blank=True, null=True,
+                                   on_delete=models.SET_NULL)
 
 
 
+    @staticmethod
+    def post_init(instance, **kwargs):
+        # remember the forum topic was loaded with to detect moves on save
+        instance._loaded_forum_id = instance.forum_id
+
     @staticmethod
     def post_save(instance, **kwargs):
         topic = instance
         forum = topic.forum
-        forum.topic_count = forum.topics.count()
-        forum.updated = topic.updated
-        forum.post_count = forum.posts.count()
-        forum.last_post_id = topic.last_post_id
-        forum.save(force_update=True)
+        if kwargs.get('created'):
+            jobs.defer('djforum.count_topic', topic.id)
+        elif topic._loaded_forum_id and topic._loaded_forum_id != topic.forum_id:
+            # topic has been moved, so its posts should be subtracted from
+            # the old branch and added to the new one. Common ancestors
+            # are left untouched.
+            old_forum = Forum.objects.get(pk=topic._loaded_forum_id)
+            old_lineage, new_lineage = set(old_forum.lineage), set(forum.lineage)
+            Forum.objects.propagate(old_lineage - new_lineage,
+                                    posts=-topic.post_count, topics=-1)
+            Forum.objects.propagate(new_lineage - old_lineage,
+                                    posts=topic.post_count, topics=1)
+            Forum.objects.update_last_post(list(old_lineage ^ new_lineage))
+            search.get_backend().move_topic(topic.id, topic.forum_id)
+        topic._loaded_forum_id = topic.forum_id
+        search.get_backend().index([search.topic_document(topic)])
+        # the subject is shown on the topic page and in the forum's list
+        writes.after_commit(fragments.topic_changed, topic.id)
+        writes.after_commit(fragments.forums_changed, [topic.forum_id])
+
+    @staticmethod
+    def count(topic_id):
+        """
+        Adds the new topic to the counters of its forums
+        """
+        topic = Topic.objects.filter(pk=topic_id).values_list('forum_id', 'forum__path')
+        # the topic has been deleted before the job ran
+        if topic:
+            forum_id, path = topic[0]
+            Forum.objects.propagate(Forum.path_to_lineage(path, forum_id), topics=1)
+
+    @staticmethod
+    def post_delete(instance, **kwargs):
+        topic = instance
+        search.get_backend().remove_topic(topic.id)
+        # the topic hasn't been counted yet if its job is still queued
+        counted = not jobs.cancel('djforum.count_topic', topic.id)
+        lineage = Forum.objects.filter(pk=topic.forum_id)\
+                               .values_list('path', flat=True)
+        # forum is being deleted too, it will fix the counters itself
+        if not lineage:
+            return
+        Forum.objects.propagate(
+            Forum.path_to_lineage(lineage[0], topic.forum_id),
+            posts=-topic.post_count, topics=-1 if counted else 0)
 
 class Post(models.Model):
     topic   = models.ForeignKey(Topic, related_name='posts', verbose_name=_('Topic'))
@@ -109,27 +302,155 @@ class Post(models.Model):
     updated_by = models.ForeignKey(User, verbose_name=_('Updated by'), blank=True, null=True)
     message    = models.TextField(_('Message'))
     body_html  = models.TextField(_('HTML version'))
+    body_version = models.SmallIntegerField(_('Renderer version'), default=0)
     user_ip    = models.IPAddressField(_('User IP'), blank=True, null=True)
+    reply_to   = models.ForeignKey('self', related_name='replies', verbose_name=_('Reply to'),
+                                   blank=True, null=True, on_delete=models.SET_NULL)
+    path       = models.CharField(_('Thread path'), max_length=255, blank=True, default='')
+    depth      = models.SmallIntegerField(_('Depth'), default=0)
+
+    #: unlike Forum.path, the path of a post ends with the post's own id, and
+    #: the ids are zero-padded, so ordering by path puts replies right after
+    #: the post they reply to
+    PATH_WIDTH = 10
+    #: replies to posts this deep are threaded as siblings of the post
+    MAX_DEPTH = 20
+
+    @staticmethod
+    def make_path(parent_path, post_id):
+        return '{}{:0{}d}.'.format(parent_path, post_id, Post.PATH_WIDTH)
+
+    @staticmethod
+    def place(post_id, parent_path='', parent_depth=-1):
+        """
+        Returns the path and depth of a post replying to the post with the
+        given path and depth, or of a top level post
+        """
+        depth = parent_depth + 1
+        if depth > Post.MAX_DEPTH:
+            parent_path, depth = parent_path[:-(Post.PATH_WIDTH + 1)], parent_depth
+        return Post.make_path(parent_path, post_id), depth
 
 
+    @staticmethod
+    def pre_save(instance, **kwargs):
+        post = instance
+        post.body_html = markup.render(post.message)
+        post.body_version = markup.RENDERER_VERSION
+
     @staticmethod
     def post_save(instance, **kwargs):
-        created = kwargs.get('created')
         post    = instance
         topic   = post.topic
+        search.get_backend().index([search.post_document(post, topic)])
+        writes.after_commit(fragments.topic_changed, post.topic_id)
+        if not kwargs.get('created'):
+            return
+
+        # the path needs the id of the post, so it's set after the insert
+        parent = post.reply_to
+        if parent is not None:
+            post.path, post.depth = Post.place(post.id, parent.path, parent.depth)
+        else:
+            post.path, post.depth = Post.place(post.id)
+        Post.objects.filter(pk=post.id).update(path=post.path, depth=post.depth)
+
+        topic.last_post = post
+        topic.post_count += 1
+        topic.updated = post.created
+        jobs.defer('djforum.count_post', post.id)
+        writes.after_commit(feed.post_added, topic.id, post.id)
+
+    @staticmethod
+    def count(post_id):
+        """
+        Adds the new post to the counters and last posts of its topic, forums
+        and author
+        """
+        post = Post.objects.filter(pk=post_id).values_list(
+            'topic_id', 'author_id', 'created', 'topic__forum_id', 'topic__forum__path')
+        # the post has been deleted before the job ran
+        if not post:
+            return
+        topic_id, author_id, created, forum_id, path = post[0]
+        Topic.objects.filter(pk=topic_id).update(post_count=F('post_count') + 1)
+        # jobs of later posts may have run already
+        Topic.objects.filter(pk=topic_id, updated__lte=created)\
+                     .update(last_post=post_id, updated=created)
+        Forum.objects.propagate(Forum.path_to_lineage(path, forum_id), posts=1,
+                                last_post=post_id, updated=created)
+        Profile.update_post_count(author_id, 1, post_id)
 
-        if created:
-            topic.last_post = post
-            topic.post_count = topic.posts.count()
-            topic.updated = datetime.now()
-            profile = post.author.forum_profile
-            profile.post_count = post.author.posts.count()
-            profile.save(force_update=True)
-        topic.save(force_update=True)
+    @staticmethod
+    def post_delete(instance, **kwargs):
+        post = instance
+        search.get_backend().remove([post.id])
+        writes.after_commit(fragments.topic_changed, post.topic_id)
+        # the post hasn't been added to any counter yet
+        if jobs.cancel('djforum.count_post', post.id):
+            return
+        Profile.update_post_count(post.author_id, -1)
+        Forum.objects.update_last_post(list(Forum.objects.filter(last_post=post.id)
+                                                         .values_list('id', flat=True)))
+        topic = Topic.objects.filter(pk=post.topic_id)\
+                             .values('forum_id', 'forum__path', 'last_post_id')
+        # topic is being deleted too, it will fix the counters itself
+        if not topic:
+            return
+        topic = topic[0]
+        changes = dict(post_count=F('post_count') - 1)
+        # last post of the topic has been nullified by the deletion
+        if topic['last_post_id'] is None:
+            latest = Post.objects.filter(topic=post.topic_id)\
+                                 .order_by('-created', '-id')\
+                                 .values_list('id', flat=True)[:1]
+            changes['last_post'] = latest[0] if latest else None
+        Topic.objects.filter(pk=post.topic_id).update(**changes)
+        Forum.objects.propagate(
+            Forum.path_to_lineage(topic['forum__path'], topic['forum_id']),
+            posts=-1)
 
 class Profile(models.Model):
     user = AutoOneToOneField(User, related_name='forum_profile', verbose_name=_('User'))
     post_count = models.IntegerField(_('Post count'), blank=True, default=0)
+    avatar_hash = models.CharField(_('Avatar hash'), max_length=32, blank=True, default='',
+                                   editable=False)
+
+    @staticmethod
+    def update_post_count(user_id, delta, post_id=None):
+        """
+        Shifts the post count of the user, counting the posts up to post_id
+        if the profile doesn't exist yet
+        """
+        updated = Profile.objects.filter(user=user_id)\
+                                 .update(post_count=F('post_count') + delta)
+        writes.after_commit(fragments.profile_changed, user_id)
+        if not updated:
+            # profile is created lazily, so we should count the posts once.
+            # Later posts may already exist when counting is deferred, they
+            # will be counted by their own jobs.
+            posts = Post.objects.filter(author=user_id)
+            if post_id is not None:
+                posts = posts.filter(id__lte=post_id)
+            Profile.objects.create(user_id=user_id, post_count=posts.count())
+
+    @staticmethod
+    def pre_save(instance, **kwargs):
+        profile = instance
+        if not profile.avatar_hash:
+            profile.avatar_hash = avatars.email_hash(profile.user.email)
+
+    @staticmethod
+    def user_saved(instance, **kwargs):
+        """
+        Updates the avatar hash when the email of the user changes
+        """
+        if kwargs.get('created') or kwargs.get('raw'):
+            return
+        avatar_hash = avatars.email_hash(instance.email)
+        if Profile.objects.filter(user=instance.id).exclude(avatar_hash=avatar_hash)\
+                          .update(avatar_hash=avatar_hash):
+            writes.after_commit(fragments.profile_changed, instance.id)
 
     @staticmethod
     def user_registered(sender, **kwargs):
@@ -138,12 +459,104 @@ class Profile(models.Model):
         user.save()
 
 
-random64bit = lambda: int(sha256(os.urandom(512)).hexdigest(), 16) % 2**64
+class ReadMarker(models.Model):
+    """
+    What the user has read in the forum: every topic updated before
+    `read_before` and the topics listed in `topics`, packed
+    (topic id, read at) pairs, at most DJFORUM_READ_MAX_TOPICS of them
+    """
+    user  = models.ForeignKey(User, related_name='read_markers', verbose_name=_('User'))
+    forum = models.ForeignKey(Forum, related_name='+', verbose_name=_('Forum'))
+    read_before = models.DateTimeField(_('Read before'))
+    topics = models.TextField(_('Read topics'), blank=True, default='')
+
+    MAX_TOPICS = getattr(settings, 'DJFORUM_READ_MAX_TOPICS', 200)
+    #: topic id and time it was read in microseconds
+    ENTRY = struct.Struct('<IQ')
+
+    class Meta:
+        unique_together = ('user', 'forum')
+
+    def read_topics(self):
+        """
+        Returns {topic id: read at in microseconds}
+        """
+        if not hasattr(self, '_read_topics'):
+            data = base64.b64decode(self.topics)
+            self._read_topics = dict(self.ENTRY.unpack_from(data, offset) for offset
+                                     in range(0, len(data), self.ENTRY.size))
+        return self._read_topics
+
+    def is_unread(self, topic):
+        if topic.updated is None:
+            return False
+        updated = int(encode_value(topic.updated))
+        return updated > max(int(encode_value(self.read_before)),
+                             self.read_topics().get(topic.id, 0))
+
+    def mark_read(self, topic_id, when=None):
+        """
+        Adds the topic to the read ones, the topics read longest ago are
+        dropped when there are too many of them
+        """
+        read_before = int(encode_value(self.read_before))
+        topics = self.read_topics()
+        topics[topic_id] = int(encode_value(when or timezone.now()))
+        entries = sorted((read_at, id) for id, read_at in topics.items()
+                         if read_at > read_before)[-self.MAX_TOPICS:]
+        self._read_topics = dict((id, read_at) for read_at, id in entries)
+        self.topics = base64.b64encode(''.join(self.ENTRY.pack(id, read_at)
+                                               for read_at, id in entries))
+
+    def mark_all_read(self, when=None):
+        self.read_before = when or timezone.now()
+        self.topics = ''
+        self._read_topics = {}
+
+    @property
+    def key(self):
+        """
+        Changes whenever the marker does, for cache keys and ETags
+        """
+        return sha256('{}:{}:{}'.format(self.user_id, encode_value(self.read_before),
+                                        self.topics)).hexdigest()[:16]
+
+
+class Job(models.Model):
+    """
+    Task queued by :func:`djtalks.djforum.jobs.defer`, the row is deleted
+    in the transaction that runs the task. (name, args) is indexed in
+    sql/job.sql for :func:`djtalks.djforum.jobs.cancel`.
+    """
+    name = models.CharField(_('Task'), max_length=100)
+    args = models.TextField(_('Arguments'))
+    attempts = models.SmallIntegerField(_('Attempts'), default=0)
+    run_after = models.DateTimeField(_('Run after'), default=timezone.now, db_index=True)
+    locked_until = models.DateTimeField(_('Locked until'), blank=True, null=True)
+    failed = models.BooleanField(_('Failed'), default=False)
+    error = models.TextField(_('Last error'), blank=True)
+    created = models.DateTimeField(_('Created'), auto_now_add=True)
+
+
+class SearchTerm(models.Model):
+    """
+    Entry of the inverted index used by the pure python search backend
+    """
+    term     = models.CharField(_('Term'), max_length=64, db_index=True)
+    document = models.IntegerField(_('Document'), db_index=True)
+    topic_id = models.IntegerField(_('Topic'), db_index=True)
+    forum_id = models.IntegerField(_('Forum'))
+    weight   = models.IntegerField(_('Weight'), default=1)
+
+
+# BigIntegerField is signed
+random64bit = lambda: int(sha256(os.urandom(512)).hexdigest(), 16) % 2**63
 
 class PrivateMessage(models.Model):
     sender  = models.ForeignKey(User, related_name='outgoing_pms', verbose_name=_('Recipient'))
     recipients = models.ManyToManyField(User, through='Inbox', related_name='pms')
-    conversation_id = models.BigIntegerField(_('Conversation id'), default=random64bit)
+    conversation_id = models.BigIntegerField(_('Conversation id'), default=random64bit,
+                                             db_index=True)
     parent  = models.ForeignKey('self', related_name='children', verbose_name=_('Recipient'), blank=True, null=True)
     depth   = models.SmallIntegerField(_('Depth'), default=0)
     subject = models.TextField(_('Subject'))
@@ -164,17 +577,58 @@ class Inbox(models.Model):
 
 
 
+signals.pre_save.connect(
+    Post.pre_save, sender=Post, dispatch_uid='djforum_post_pre_save')
+
 signals.post_save.connect(
     Post.post_save, sender=Post, dispatch_uid='djforum_post_save')
 
+signals.post_delete.connect(
+    Post.post_delete, sender=Post, dispatch_uid='djforum_post_delete')
+
+signals.post_init.connect(
+    Topic.post_init, sender=Topic, dispatch_uid='djforum_topic_init')
+
 signals.post_save.connect(
     Topic.post_save, sender=Topic, dispatch_uid='djforum_topic_save')
 
+signals.post_delete.connect(
+    Topic.post_delete, sender=Topic, dispatch_uid='djforum_topic_delete')
+
+signals.post_delete.connect(
+    Forum.post_delete, sender=Forum, dispatch_uid='djforum_forum_delete')
+
+signals.pre_save.connect(
+    Profile.pre_save, sender=Profile, dispatch_uid='djforum_profile_pre_save')
+
 signals.post_save.connect(
-    Forum.post_save, sender=Forum, dispatch_uid='djforum_forum_save')
+    Profile.user_saved, sender=User, dispatch_uid='djforum_user_save')
+
+# forums are added, moved and deleted rarely, counters are changed with
+# UPDATEs that don't send signals, so it's safe to rebuild the trees on save
+signals.post_save.connect(
+    versions.tree_changed, sender=Forum, dispatch_uid='djforum_tree_save')
+
+signals.post_delete.connect(
+    versions.tree_changed, sender=Forum, dispatch_uid='djforum_tree_delete')
+
+signals.m2m_changed.connect(
+    versions.permissions_changed, sender=User.groups.through,
+    dispatch_uid='djforum_user_groups_changed')
+
+signals.post_syncdb.connect(search.create_index, dispatch_uid='djforum_search_index')
+
+connection_created.connect(sqlite.configure, dispatch_uid='djforum_sqlite_pragmas')
+
+jobs.register('djforum.count_post', Post.count)
+jobs.register('djforum.count_topic', Topic.count)
 
 registration.signals.user_registered.connect(Profile.user_registered)
 
 from object_permissions import register
+from object_permissions.signals import granted, revoked
 register(['view', 'edit', 'destroy'], Forum)
-register(['view', 'edit', 'destroy'], Topic)
\ No newline at end of file
+register(['view', 'edit', 'destroy'], Topic)
+
+granted.connect(versions.permissions_changed, dispatch_uid='djforum_perm_granted')
+revoked.connect(versions.permissions_changed, dispatch_uid='djforum_perm_revoked')
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors:
+    - qweqwe
+
+Keyset (a.k.a. seek) pagination. Instead of OFFSET, which makes the database
+scan and throw away all the rows of the previous pages, every page is
+requested relative to the last row of the neighbouring page:
+
+    WHERE (updated < :updated) OR (updated = :updated AND id < :id)
+    ORDER BY updated DESC, id DESC LIMIT :per_page
+
+so the cost of the page 1000 is the same as the cost of the first one as
+long as there is an index on (filter columns, sort keys).
+
+Plain `?page=N` links are still supported for the first few pages.
+"""
+import base64
+import calendar
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Q
+from django.http import Http404
+from django.utils import timezone
+
+#: how many pages can be requested by their number
+OFFSET_PAGES = getattr(settings, 'DJFORUM_OFFSET_PAGES', 10)
+
+
+def encode_value(value):
+    if isinstance(value, datetime):
+        if timezone.is_aware(value):
+            value = timezone.make_naive(value, timezone.utc)
+        return str(calendar.timegm(value.timetuple()) * 10**6 + value.microsecond)
+    if isinstance(value, basestring):
+        # strings may contain the separator of the cursor components
+        return base64.urlsafe_b64encode(value.encode('utf-8'))
+    return str(value)
+
+
+def decode_value(value, sample):
+    """
+    Decodes cursor component back using the type of the sort key
+    """
+    if sample == 'datetime':
+        value = int(value)
+        value = datetime.utcfromtimestamp(value // 10**6)\
+                        .replace(microsecond=value % 10**6)
+        return timezone.make_aware(value, timezone.utc) if settings.USE_TZ else value
+    if sample == 'str':
+        try:
+            return base64.urlsafe_b64decode(value.encode('ascii')).decode('utf-8')
+        except TypeError:
+            raise ValueError(value)
+    return int(value)
+
+
+class Page(object):
+    """
+    Rows of the page are fetched on the first access, so a page rendered in
+    a cached template fragment costs no queries on a cache hit
+    """
+    def __init__(self, paginator, fetch, number=None):
+        self.paginator = paginator
+        self.fetch = fetch
+        self.number = number
+
+    def load(self):
+        if not hasattr(self, '_loaded'):
+            self._loaded = self.fetch()
+            if self.paginator.prepare is not None:
+                self.paginator.prepare(self._loaded[0])
+        return self._loaded
+
+    @property
+    def object_list(self):
+        return self.load()[0]
+
+    @property
+    def has_next(self):
+        return self.load()[1]
+
+    @property
+    def has_previous(self):
+        return self.load()[2]
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    @property
+    def next_cursor(self):
+        if self.has_next and self.object_list:
+            return self.paginator.cursor(self.object_list[-1])
+
+    @property
+    def previous_cursor(self):
+        if self.has_previous and self.object_list:
+            return self.paginator.cursor(self.object_list[0])
+
+
+class KeysetPaginator(object):
+    """
+    Paginates queryset ordered by `keys`, e.g. ('-updated', '-id'). The last
+    key must be unique, so that every row has a distinct position.
+
+    `prepare` is called with the rows of every page once they are fetched,
+    e.g. to load related objects in batch.
+    """
+    #: how values of the sort keys are encoded in cursors, by field type
+    TYPES = {'DateTimeField': 'datetime', 'CharField': 'str'}
+
+    def __init__(self, queryset, keys, per_page, count=None, prepare=None):
+        self.queryset = queryset
+        self.keys = keys
+        self.per_page = per_page
+        self.count = count
+        self.prepare = prepare
+        self.fields = [key.lstrip('-') for key in keys]
+        self.types = [self.TYPES.get(queryset.model._meta.get_field(field)
+                                                .get_internal_type(), 'int')
+                      for field in self.fields]
+
+    @property
+    def num_pages(self):
+        if self.count is None:
+            return None
+        return max(1, -(-self.count // self.per_page))
+
+    @property
+    def page_range(self):
+        """
+        Pages that can be linked directly by their number
+        """
+        last = OFFSET_PAGES if self.count is None else min(self.num_pages, OFFSET_PAGES)
+        return range(1, last + 1)
+
+    def cursor(self, obj):
+        return '.'.join(encode_value(getattr(obj, field)) for field in self.fields)
+
+    def seek(self, cursor, forward=True):
+        """
+        Builds the filter that selects rows that go after (or before) the
+        cursor in the pagination order
+        """
+        values = cursor.split('.')
+        if len(values) != len(self.keys):
+            raise Http404
+        try:
+            values = [decode_value(value, type) for value, type
+                      in zip(values, self.types)]
+        except (ValueError, OverflowError):
+            raise Http404
+        q, equal = Q(), {}
+        for key, field, value in zip(self.keys, self.fields, values):
+            descending = key.startswith('-') == forward
+            lookup = '{}__{}'.format(field, 'lt' if descending else 'gt')
+            q |= Q(**dict(equal, **{lookup: value}))
+            equal[field] = value
+        return q
+
+    def reversed_keys(self):
+        return [key[1:] if key.startswith('-') else '-' + key for key in self.keys]
+
+    def page(self, number):
+        if not 0 < number <= OFFSET_PAGES:
+            raise Http404
+        offset = (number - 1) * self.per_page
+        def fetch():
+            rows = list(self.queryset.order_by(*self.keys)[offset:offset + self.per_page + 1])
+            if not rows and number > 1:
+                raise Http404
+            return rows[:self.per_page], len(rows) > self.per_page, number > 1
+        return Page(self, fetch, number)
+
+    def after(self, cursor):
+        seek = self.seek(cursor)
+        def fetch():
+            rows = list(self.queryset.filter(seek)
+                                     .order_by(*self.keys)[:self.per_page + 1])
+            return rows[:self.per_page], len(rows) > self.per_page, True
+        return Page(self, fetch)
+
+    def before(self, cursor):
+        seek = self.seek(cursor, forward=False)
+        def fetch():
+            rows = list(self.queryset.filter(seek)
+                                     .order_by(*self.reversed_keys())[:self.per_page + 1])
+            return rows[:self.per_page][::-1], True, len(rows) > self.per_page
+        return Page(self, fetch)
+
+    def last(self):
+        def fetch():
+            rows = list(self.queryset.order_by(*self.reversed_keys())[:self.per_page + 1])
+            return rows[:self.per_page][::-1], False, len(rows) > self.per_page
+        return Page(self, fetch)
+
+    def page_from_request(self, request):
+        """
+        Picks the page using `after`, `before` or `page` GET parameters
+        """
+        if 'after' in request.GET:
+            return self.after(request.GET['after'])
+        if 'before' in request.GET:
+            return self.before(request.GET['before'])
+        number = request.GET.get('page', '1')
+        if number == 'last':
+            return self.last()
+        try:
+            return self.page(int(number))
+        except ValueError:
+            raise Http404
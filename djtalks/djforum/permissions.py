@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors:
+    - qweqwe
+
+Resolution of forum permissions. All forum permissions of a user (including
+the ones granted to user's groups) are loaded at once and kept as a dict of
+bitmasks keyed by forum id, so every check afterwards is a dict lookup.
+
+Permissions are inherited down the forum tree: a permission granted on the
+forum applies to all its subforums as well. Active superusers have every
+permission on every forum, like `user.has_perm` gives them.
+
+Resolved permissions are shared between processes through the cache. They
+are invalidated by bumping 'permissions' version on any grant, revoke or
+group membership change and 'tree' version when forums are added, moved or
+removed.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from object_permissions.registration import permission_map
+
+from djtalks.djforum.models import Forum
+from djtalks.djforum import versions
+
+PERMISSIONS_CACHE_TIMEOUT = getattr(settings, 'DJFORUM_PERMISSIONS_CACHE_TIMEOUT', 60 * 60)
+
+VIEW, EDIT, DESTROY = 1, 2, 4
+BITS = dict(view=VIEW, edit=EDIT, destroy=DESTROY)
+
+
+class ForumPermissions(object):
+    def __init__(self, user_id, grants, is_superuser=False):
+        """
+        :param grants: dict of {forum_id: bitmask} with inheritance applied
+        """
+        self.user_id = user_id
+        self.grants = grants
+        self.is_superuser = is_superuser
+        visible = sorted(forum_id for forum_id, bits in grants.items() if bits & VIEW)
+        #: identifies the set of visible forums, users seeing the same forums
+        #: share cached pages built for it. Superusers may do anything anywhere,
+        #: so they don't share pages with users that only see every forum.
+        self.key = hashlib.sha1('{}:{}'.format(
+            int(is_superuser), ','.join(str(i) for i in visible))).hexdigest()
+
+    def has_perm(self, perm, forum_id):
+        return bool(self.grants.get(forum_id, 0) & BITS[perm])
+
+    def can_view(self, forum_id):
+        return bool(self.grants.get(forum_id, 0) & VIEW)
+
+    @staticmethod
+    def load(user_id, is_superuser=False):
+        """
+        Loads permissions of the user from the database with two queries,
+        or with one for superusers
+        """
+        if is_superuser:
+            grants = dict((forum_id, VIEW | EDIT | DESTROY)
+                          for forum_id in Forum.objects.values_list('id', flat=True))
+            return ForumPermissions(user_id, grants, is_superuser=True)
+        own = {}
+        rows = permission_map[Forum].objects\
+                                    .filter(Q(user=user_id) | Q(group__user=user_id))\
+                                    .values_list('obj', *BITS.keys())
+        for row in rows:
+            bits = sum(BITS[perm] for perm, value in zip(BITS.keys(), row[1:]) if value)
+            own[row[0]] = own.get(row[0], 0) | bits
+        grants = {}
+        for forum_id, path in Forum.objects.values_list('id', 'path'):
+            bits = 0
+            for ancestor_id in Forum.path_to_lineage(path, forum_id):
+                bits |= own.get(ancestor_id, 0)
+            if bits:
+                grants[forum_id] = bits
+        return ForumPermissions(user_id, grants)
+
+    @staticmethod
+    def for_user(user_id, is_superuser=False):
+        """
+        :param is_superuser: whether the user is an active superuser, the
+            flag isn't versioned, so it's a part of the cache key
+        """
+        key = 'djforum:permissions:{}:{}:{}:{}'.format(
+            user_id, int(is_superuser), *versions.get('permissions', 'tree'))
+        permissions = cache.get(key)
+        if permissions is None:
+            permissions = ForumPermissions.load(user_id, is_superuser)
+            cache.set(key, permissions, PERMISSIONS_CACHE_TIMEOUT)
+        return permissions
+
+
+def get_permissions(request):
+    """
+    Returns forum permissions of the current user (or of the special anonymous
+    user model), they are resolved once per request
+    """
+    if not hasattr(request, '_forum_permissions'):
+        user = request.user
+        if user.is_authenticated():
+            request._forum_permissions = ForumPermissions.for_user(
+                user.id, user.is_active and user.is_superuser)
+        else:
+            request._forum_permissions = ForumPermissions.for_user(settings.ANONYMOUS_USER_ID)
+    return request._forum_permissions
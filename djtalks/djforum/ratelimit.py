@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors:
+    - qweqwe
+
+Flood control of the views that write. Every action has a token bucket per
+user and per address (REMOTE_ADDR) kept in the cache: a bucket holds up to
+`burst` tokens, a submission takes one and they are refilled at the rate
+of `burst` per `seconds`:
+
+    DJFORUM_RATE_LIMITS = {
+        'post': {'user': (5, 60), 'ip': (30, 60)},
+    }
+
+    @ratelimit.limit('post')
+    def topic(request, topic_id): ...
+
+A check is a cache get and set per bucket, the address is checked first,
+so floods from an address are turned away with 429 before the session and
+the user are loaded. Buckets are read and written without a lock, so
+concurrent submissions may get a token or two more than the limit.
+"""
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.handlers.wsgi import STATUS_CODE_TEXT
+from django.http import HttpResponse
+
+LIMITS = getattr(settings, 'DJFORUM_RATE_LIMITS', {})
+KEY = 'djforum:rate:{}:{}:{}'
+
+# Django 1.4 doesn't know the status
+STATUS_CODE_TEXT.setdefault(429, 'TOO MANY REQUESTS')
+
+
+class HttpResponseTooManyRequests(HttpResponse):
+    status_code = 429
+
+
+def take(key, burst, seconds, now=None):
+    """
+    Takes a token from the bucket, returns 0 if there was one or the number
+    of seconds until there is
+    """
+    now = time.time() if now is None else now
+    rate = float(burst) / seconds
+    tokens, stamp = cache.get(key) or (burst, now)
+    tokens = min(burst, tokens + (now - stamp) * rate)
+    if tokens < 1:
+        return (1 - tokens) / rate
+    # a bucket left alone for `seconds` is full again, so it can expire
+    cache.set(key, (tokens - 1, now), int(seconds) + 1)
+    return 0
+
+
+def check(request, action):
+    """
+    Returns 0 if the request may go on or the number of seconds the client
+    should wait
+    """
+    limits = LIMITS.get(action, {})
+    if 'ip' in limits:
+        address = request.META.get('REMOTE_ADDR', '')
+        retry_after = take(KEY.format(action, 'ip', address), *limits['ip'])
+        if retry_after:
+            return retry_after
+    if 'user' in limits and request.user.is_authenticated():
+        return take(KEY.format(action, 'user', request.user.id), *limits['user'])
+    return 0
+
+
+def limit(action):
+    """
+    Limits form submissions (POST requests) to the view
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method == 'POST':
+                retry_after = check(request, action)
+                if retry_after:
+                    response = HttpResponseTooManyRequests("Too many requests, try again later",
+                                                           content_type='text/plain')
+                    response['Retry-After'] = str(int(retry_after) + 1)
+                    return response
+            return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def disabled():
+    """
+    Turns the limits off, for the benchmarks
+    """
+    global LIMITS
+    limits, LIMITS = LIMITS, {}
+    try:
+        yield
+    finally:
+        LIMITS = limits
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors:
+    - qweqwe
+
+Read replicas. Within requests handled by :class:`ReplicaMiddleware` reads
+of djforum models go to one of DJFORUM_REPLICAS, the aliases of replica
+databases in DATABASES, picked once per request, and writes go to the
+primary ('default'):
+
+    DATABASE_ROUTERS = ['djtalks.djforum.routers.ReplicaRouter']
+    DJFORUM_REPLICAS = ['replica1', 'replica2']
+
+Replicas lag behind, so the user must read their own writes from the
+primary. A request that writes is pinned to the primary from the first
+write on, and the client is then pinned for DJFORUM_PIN_SECONDS with a
+cookie. Requests other than GET and HEAD are pinned from the start,
+since they read what they are going to change.
+
+Reads outside of requests (management commands, shell) always go to the
+primary.
+
+Locally replicas can be stood in for by copies of the SQLite file:
+
+    cp db.sqlite db-replica1.sqlite
+
+Connections are kept open between requests for DJFORUM_CONN_MAX_AGE
+seconds instead of being closed after every request, 0 keeps the default
+behaviour.
+"""
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core import signals
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.backends.signals import connection_created
+
+REPLICAS = getattr(settings, 'DJFORUM_REPLICAS', [])
+PIN_SECONDS = getattr(settings, 'DJFORUM_PIN_SECONDS', 10)
+PIN_COOKIE = 'djforum_primary'
+CONN_MAX_AGE = getattr(settings, 'DJFORUM_CONN_MAX_AGE', 0)
+
+#: routing state of the request being processed by the thread
+local = threading.local()
+
+
+def pin():
+    """
+    Sends the rest of the current request to the primary
+    """
+    local.pinned = True
+
+
+def is_pinned():
+    return getattr(local, 'pinned', False)
+
+
+class ReplicaRouter(object):
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label != 'djforum' or not REPLICAS:
+            return None
+        replica = getattr(local, 'replica', None)
+        if replica is None or is_pinned():
+            return DEFAULT_DB_ALIAS
+        return replica
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label != 'djforum' or not REPLICAS:
+            return None
+        local.wrote = True
+        pin()
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same rows as the primary
+        return True
+
+    def allow_syncdb(self, db, model):
+        if db in REPLICAS:
+            return False
+        return None
+
+
+class ReplicaMiddleware(object):
+    def __init__(self):
+        if CONN_MAX_AGE:
+            keep_connections()
+
+    def process_request(self, request):
+        local.replica = random.choice(REPLICAS) if REPLICAS else None
+        local.pinned = request.method not in ('GET', 'HEAD') or \
+                       PIN_COOKIE in request.COOKIES
+        local.wrote = False
+
+    def process_response(self, request, response):
+        if getattr(local, 'wrote', False) and REPLICAS:
+            response.set_cookie(PIN_COOKIE, '1', max_age=PIN_SECONDS, httponly=True)
+        local.replica = None
+        local.pinned = local.wrote = False
+        return response
+
+
+def connection_opened(sender, connection, **kwargs):
+    connection._djforum_opened = time.time()
+
+
+def close_old_connections(**kwargs):
+    """
+    Ends transactions left open by the request and closes connections that
+    are older than DJFORUM_CONN_MAX_AGE, the rest are reused by the next
+    request handled by the thread
+    """
+    for connection in connections.all():
+        if connection.connection is None:
+            continue
+        opened = getattr(connection, '_djforum_opened', 0)
+        if time.time() - opened >= CONN_MAX_AGE:
+            connection.close()
+            continue
+        try:
+            connection._rollback()
+        except Exception:
+            # the connection is broken, the next request opens a new one
+            connection.close()
+
+
+def keep_connections():
+    """
+    Replaces closing of the connections at the end of every request with
+    :func:`close_old_connections`
+    """
+    # django.db imports the router before it defines close_connection
+    from django.db import close_connection
+    connection_created.connect(connection_opened, dispatch_uid='djforum_connection_opened')
+    signals.request_finished.disconnect(close_connection)
+    signals.request_finished.connect(close_old_connections,
+                                     dispatch_uid='djforum_close_old_connections')
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors:
+    - qweqwe
+
+Full-text search over topic subjects and post messages.
+
+Every topic and every post is a document of the inverted index. Posts use
+their ids as document ids and topics use negated ids, so both kinds are
+ranked together. Each document also stores its topic and forum, so the
+results can be filtered by the permissions without touching other tables.
+
+There are two backends:
+
+* `Fts5Backend` keeps the index in an SQLite FTS5 virtual table and ranks
+  the results with bm25. It's used when the database is SQLite and FTS5 is
+  compiled in.
+* `PythonBackend` tokenizes the documents in Python and keeps (term,
+  document) pairs in the `SearchTerm` model, so it works on any database.
+
+The index is maintained from the post and topic signals; the `reindex`
+command rebuilds it from scratch.
+"""
+import re
+
+from django.conf import settings
+from django.db import connection, DatabaseError
+from django.db.models import Count, Sum
+
+#: 'auto', 'fts5' or 'python'
+BACKEND = getattr(settings, 'DJFORUM_SEARCH_BACKEND', 'auto')
+FTS_TABLE = 'djforum_search'
+#: subject matches weigh more than message matches
+SUBJECT_WEIGHT = 5
+#: ranked results are filtered by permissions in batches of this size
+BATCH_SIZE = 200
+
+TOKEN_RE = re.compile(r'\w{2,64}', re.U)
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower())
+
+
+class Fts5Backend(object):
+    def create(self):
+        # DDL commits the current transaction in SQLite, so it's issued only
+        # when it's really needed
+        if FTS_TABLE in connection.introspection.table_names():
+            return
+        cursor = connection.cursor()
+        cursor.execute('CREATE VIRTUAL TABLE {} USING fts5('
+                       'topic_id UNINDEXED, forum_id UNINDEXED, subject, message)'
+                       .format(FTS_TABLE))
+
+    def index(self, documents):
+        """
+        :param documents: list of (document_id, topic_id, forum_id, subject, message)
+        """
+        cursor = connection.cursor()
+        self.remove([document[0] for document in documents])
+        cursor.executemany('INSERT INTO {} (rowid, topic_id, forum_id, subject, message) '
+                           'VALUES (%s, %s, %s, %s, %s)'.format(FTS_TABLE), documents)
+
+    def remove(self, document_ids):
+        cursor = connection.cursor()
+        cursor.executemany('DELETE FROM {} WHERE rowid = %s'.format(FTS_TABLE),
+                           [(document_id,) for document_id in document_ids])
+
+    def remove_topic(self, topic_id):
+        connection.cursor().execute('DELETE FROM {} WHERE topic_id = %s'.format(FTS_TABLE),
+                                    [topic_id])
+
+    def move_topic(self, topic_id, forum_id):
+        connection.cursor().execute('UPDATE {} SET forum_id = %s WHERE topic_id = %s'
+                                    .format(FTS_TABLE), [forum_id, topic_id])
+
+    def clear(self):
+        connection.cursor().execute('DELETE FROM {}'.format(FTS_TABLE))
+
+    def query(self, terms, offset, limit):
+        cursor = connection.cursor()
+        cursor.execute('SELECT rowid, topic_id, forum_id FROM {0} WHERE {0} MATCH %s '
+                       'ORDER BY bm25({0}, 0, 0, {1}, 1) LIMIT %s OFFSET %s'
+                       .format(FTS_TABLE, float(SUBJECT_WEIGHT)),
+                       [' '.join('"{}"'.format(term) for term in terms), limit, offset])
+        return cursor.fetchall()
+
+
+class PythonBackend(object):
+    def create(self):
+        # the table is created by syncdb
+        pass
+
+    def index(self, documents):
+        from djtalks.djforum.models import SearchTerm
+        self.remove([document[0] for document in documents])
+        entries = []
+        for document_id, topic_id, forum_id, subject, message in documents:
+            weights = {}
+            for text, weight in ((subject, SUBJECT_WEIGHT), (message, 1)):
+                for term in tokenize(text):
+                    weights[term] = weights.get(term, 0) + weight
+            entries.extend(SearchTerm(term=term, document=document_id, topic_id=topic_id,
+                                      forum_id=forum_id, weight=weight)
+                           for term, weight in weights.items())
+        SearchTerm.objects.bulk_create(entries)
+
+    def remove(self, document_ids):
+        from djtalks.djforum.models import SearchTerm
+        SearchTerm.objects.filter(document__in=document_ids).delete()
+
+    def remove_topic(self, topic_id):
+        from djtalks.djforum.models import SearchTerm
+        SearchTerm.objects.filter(topic_id=topic_id).delete()
+
+    def move_topic(self, topic_id, forum_id):
+        from djtalks.djforum.models import SearchTerm
+        SearchTerm.objects.filter(topic_id=topic_id).update(forum_id=forum_id)
+
+    def clear(self):
+        from djtalks.djforum.models import SearchTerm
+        SearchTerm.objects.all().delete()
+
+    def query(self, terms, offset, limit):
+        from djtalks.djforum.models import SearchTerm
+        terms = set(terms)
+        rows = SearchTerm.objects.filter(term__in=terms)\
+                                 .values('document', 'topic_id', 'forum_id')\
+                                 .annotate(matched=Count('term'), score=Sum('weight'))\
+                                 .filter(matched=len(terms))\
+                                 .order_by('-score', '-document')[offset:offset + limit]
+        return [(row['document'], row['topic_id'], row['forum_id']) for row in rows]
+
+
+_backend = None
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        if BACKEND == 'fts5':
+            _backend = Fts5Backend()
+        elif BACKEND == 'python':
+            _backend = PythonBackend()
+        elif connection.vendor == 'sqlite' and \
+                FTS_TABLE in connection.introspection.table_names():
+            _backend = Fts5Backend()
+        else:
+            _backend = PythonBackend()
+    return _backend
+
+
+def create_index(created_models=(), **kwargs):
+    """
+    Creates FTS5 table if SQLite supports it, connected to post_syncdb
+    """
+    from djtalks.djforum.models import Post
+    if Post in created_models and connection.vendor == 'sqlite' and BACKEND != 'python':
+        try:
+            Fts5Backend().create()
+        except DatabaseError:
+            # SQLite has been compiled without FTS5
+            pass
+
+
+def post_document(post, topic):
+    return post.id, topic.id, topic.forum_id, u'', post.message
+
+
+def topic_document(topic):
+    return -topic.id, topic.id, topic.forum_id, topic.subject, u''
+
+
+def search(query, permissions, offset=0, limit=20):
+    """
+    Returns list of (post_id, topic_id) pairs of the documents matching all
+    the words of the query, best matches first. post_id is None for topics
+    matched by their subject. Only the forums that are visible with the
+    given :class:`~djtalks.djforum.permissions.ForumPermissions` are searched.
+    """
+    terms = tokenize(query)
+    if not terms:
+        return []
+    backend = get_backend()
+    results, skipped, position = [], 0, 0
+    while len(results) < limit:
+        batch = backend.query(terms, position, BATCH_SIZE)
+        for document_id, topic_id, forum_id in batch:
+            if not permissions.can_view(forum_id):
+                continue
+            if skipped < offset:
+                skipped += 1
+                continue
+            results.append((document_id if document_id > 0 else None, topic_id))
+            if len(results) == limit:
+                break
+        if len(batch) < BATCH_SIZE:
+            break
+        position += BATCH_SIZE
+    return results
@@ -0,0 +1,2 @@
+-- jobs.cancel looks pending jobs up by task and arguments on every delete
+CREATE INDEX IF NOT EXISTS djforum_job_name_args ON djforum_job (name, args);
@@ -0,0 +1,4 @@
+-- keyset pagination of the topic posts: topic_id = ? ORDER BY created, id
+CREATE INDEX IF NOT EXISTS djforum_post_topic_created_id ON djforum_post (topic_id, created, id);
+-- threaded display of the topic posts: topic_id = ? ORDER BY path
+CREATE INDEX IF NOT EXISTS djforum_post_topic_path ON djforum_post (topic_id, path);
@@ -0,0 +1,10 @@
+-- keyset pagination of the forum topic list: forum_id = ? ORDER BY updated DESC, id DESC
+CREATE INDEX IF NOT EXISTS djforum_topic_forum_updated_id ON djforum_topic (forum_id, updated, id);
+-- topics saved when `updated` could be NULL fall out of the keyset comparisons
+-- above, they get the time of their latest post. syncdb runs this file only
+-- when it creates the table, existing databases are upgraded with
+-- `manage.py sqlcustom djforum | manage.py dbshell`, every statement here
+-- is safe to run again
+UPDATE djforum_topic SET updated = COALESCE((SELECT MAX(created) FROM djforum_post
+                                             WHERE topic_id = djforum_topic.id), created)
+WHERE updated IS NULL;
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors:
+    - qweqwe
+
+Production settings of SQLite connections. WAL lets readers work while a
+writer is committing, `synchronous=NORMAL` is durable enough with WAL and
+saves an fsync on every commit, `busy_timeout` makes a writer wait for the
+lock instead of failing with "database is locked" right away:
+
+    DJFORUM_SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 256 * 1024 * 1024,
+        'busy_timeout': 5000,
+    }
+"""
+from django.conf import settings
+
+PRAGMAS = getattr(settings, 'DJFORUM_SQLITE_PRAGMAS', {})
+#: journal_mode has to be set first, the rest of the pragmas apply to it
+ORDER = ('journal_mode', 'synchronous', 'mmap_size', 'busy_timeout')
+
+
+def configure(sender, connection, **kwargs):
+    """
+    Applies DJFORUM_SQLITE_PRAGMAS to every new SQLite connection
+    """
+    if connection.vendor != 'sqlite' or not PRAGMAS:
+        return
+    names = sorted(PRAGMAS, key=lambda name: ORDER.index(name) if name in ORDER
+                                             else len(ORDER))
+    cursor = connection.connection.cursor()
+    for name in names:
+        cursor.execute('PRAGMA {} = {}'.format(name, PRAGMAS[name]))
+    cursor.close()
@@ -0,0 +1,37 @@
+/*
+ * Appends new posts to the last page of the topic as they are posted. Uses
+ * Server-Sent Events where the browser supports them and long polling
+ * otherwise.
+ */
+$(function () {
+    var $posts = $('#posts[data-updates]');
+    if (!$posts.length) {
+        return;
+    }
+    var url = $posts.data('updates');
+    var cursor = $posts.data('cursor');
+
+    function append(update) {
+        $posts.append(update.html);
+        cursor = update.cursor;
+    }
+
+    if (window.EventSource) {
+        var source = new EventSource(url + '?after=' + cursor);
+        source.addEventListener('posts', function (event) {
+            append(JSON.parse(event.data));
+        });
+        return;
+    }
+
+    (function poll() {
+        $.getJSON(url, {after: cursor})
+            .done(function (update) {
+                append(update);
+                poll();
+            })
+            .fail(function () {
+                setTimeout(poll, 5000);
+            });
+    })();
+});
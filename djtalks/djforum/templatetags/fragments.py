@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors:
+    - qweqwe
+
+    {% load fragments %}
+    {% fragment "topic_posts" topic request.GET.urlencode %}
+        ...
+    {% endfragment %}
+
+caches the enclosed block under the versions of the object (a forum or
+a topic) and any additional values it varies on. On a hit the block isn't
+evaluated at all, so lazy querysets and pages used in it aren't queried.
+"""
+from django import template
+
+from djtalks.djforum import fragments
+
+register = template.Library()
+
+
+class FragmentNode(template.Node):
+    def __init__(self, nodelist, name, obj, vary_on):
+        self.nodelist = nodelist
+        self.name = name
+        self.obj = obj
+        self.vary_on = vary_on
+
+    def render(self, context):
+        key = fragments.make_key(self.name.resolve(context),
+                                 self.obj.resolve(context),
+                                 [var.resolve(context) for var in self.vary_on])
+        content = fragments.get(key)
+        if content is None:
+            with fragments.recording() as depends:
+                content = self.nodelist.render(context)
+            fragments.set(key, content, depends)
+        return content
+
+
+@register.tag
+def fragment(parser, token):
+    bits = token.split_contents()
+    if len(bits) < 3:
+        raise template.TemplateSyntaxError(
+            "'{}' tag requires the name of the fragment and the object".format(bits[0]))
+    nodelist = parser.parse(('endfragment',))
+    parser.delete_first_token()
+    return FragmentNode(nodelist, *[parser.compile_filter(bit) for bit in bits[1:3]],
+                        vary_on=[parser.compile_filter(bit) for bit in bits[3:]])
@@ -3,15 +3,25 @@
 :Authors:
     - qweqwe
 """
-import urllib
-import hashlib
-
 from django import template
+from django.utils.html import escape
+
+from djtalks.djforum import avatars
 
 register = template.Library()
 
 @register.filter
 def gravatar_url(email):
-    gravatar_url = "http://www.gravatar.com/avatar/" + hashlib.md5(email.lower()).hexdigest() + "?"
-    gravatar_url += urllib.urlencode({'d':'mm', 's':str(48)})
-    return  gravatar_url
\ No newline at end of file
+    return avatars.url(avatars.email_hash(email))
+
+
+@register.simple_tag
+def avatar_url(user, size=avatars.SIZE, default=avatars.DEFAULT):
+    """
+    URL of the gravatar of the user or of the email:
+
+        {% avatar_url post.author 80 "identicon" %}
+    """
+    hash = avatars.email_hash(user) if isinstance(user, basestring) else avatars.user_hash(user)
+    # simple_tag output isn't escaped
+    return escape(avatars.url(hash, int(size), default))
@@ -5,12 +5,1653 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import time
+
+from django.db import connection
 from django.test import TestCase
 
 
+class measure(object):
+    """
+    Context manager that records the number of queries and wall time spent
+    inside the block
+    """
+    def __enter__(self):
+        self.use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        self.start_queries = len(connection.queries)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.time = time.time() - self.start
+        self.queries = len(connection.queries) - self.start_queries
+        connection.use_debug_cursor = self.use_debug_cursor
+
+
 class SimpleTest(TestCase):
     def test_basic_addition(self):
         """
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class ForumTestCase(TestCase):
+    """
+    Creates a small forum tree: root -> child -> grandchild and a sibling
+    of the child
+    """
+    def setUp(self):
+        from django.contrib.auth.models import User
+        from djtalks.djforum.models import Forum
+        self.user = User.objects.create_user('user', 'user@example.com', 'user')
+        self.root = Forum.objects.insert(Forum(name='root'))
+        self.child = Forum.objects.insert(Forum(name='child'), self.root)
+        self.grandchild = Forum.objects.insert(Forum(name='grandchild'), self.child)
+        self.sibling = Forum.objects.insert(Forum(name='sibling'), self.root)
+
+    def allow_anonymous(self, *forums):
+        from django.contrib.auth.models import User
+        from djtalks import settings
+        anonymous, _ = User.objects.get_or_create(pk=settings.ANONYMOUS_USER_ID,
+                                                  username='anonymous')
+        for forum in forums:
+            anonymous.grant('view', forum)
+        return anonymous
+
+    def reload(self, obj):
+        return obj.__class__.objects.get(pk=obj.pk)
+
+    def add_topic(self, forum, posts=1):
+        from djtalks.djforum.models import Topic, Post
+        topic = Topic.objects.create(forum=forum, subject='subject', author=self.user)
+        for i in range(posts):
+            Post.objects.create(topic=topic, author=self.user, message='message')
+        return topic
+
+
+class CountersTest(ForumTestCase):
+    def assertCounts(self, forum, posts, topics):
+        forum = self.reload(forum)
+        self.assertEqual((forum.post_count, forum.topic_count), (posts, topics))
+
+    def test_post_updates_whole_lineage(self):
+        topic = self.add_topic(self.grandchild, posts=3)
+        self.assertEqual(self.reload(topic).post_count, 3)
+        self.assertEqual(self.reload(topic).last_post_id, topic.posts.latest('id').id)
+        for forum in (self.root, self.child, self.grandchild):
+            self.assertCounts(forum, 3, 1)
+        self.assertCounts(self.sibling, 0, 0)
+        self.assertEqual(self.user.forum_profile.post_count, 3)
+
+    def test_post_delete(self):
+        topic = self.add_topic(self.grandchild, posts=2)
+        last_post = self.reload(topic).last_post
+        last_post.delete()
+        topic = self.reload(topic)
+        self.assertEqual(topic.post_count, 1)
+        self.assertEqual(topic.last_post_id, topic.posts.get().id)
+        self.assertCounts(self.root, 1, 1)
+        self.assertEqual(self.reload(self.user.forum_profile).post_count, 1)
+
+    def test_topic_delete(self):
+        self.add_topic(self.grandchild, posts=2)
+        topic = self.add_topic(self.grandchild, posts=2)
+        self.reload(topic).delete()
+        for forum in (self.root, self.child, self.grandchild):
+            self.assertCounts(forum, 2, 1)
+        self.assertEqual(self.reload(self.user.forum_profile).post_count, 2)
+
+    def test_topic_move(self):
+        topic = self.reload(self.add_topic(self.grandchild, posts=2))
+        topic.forum = self.sibling
+        topic.save()
+        self.assertCounts(self.root, 2, 1)
+        self.assertCounts(self.child, 0, 0)
+        self.assertCounts(self.grandchild, 0, 0)
+        self.assertCounts(self.sibling, 2, 1)
+
+    def test_recount(self):
+        from StringIO import StringIO
+        from django.core.management import call_command
+        from djtalks.djforum.models import Forum, Topic, Profile
+        topic = self.add_topic(self.grandchild, posts=2)
+        Forum.objects.update(post_count=42, topic_count=42)
+        Topic.objects.update(post_count=0)
+        Profile.objects.all().delete()
+        call_command('recount', stdout=StringIO())
+        for forum in (self.root, self.child, self.grandchild):
+            self.assertCounts(forum, 2, 1)
+        self.assertCounts(self.sibling, 0, 0)
+        self.assertEqual(self.reload(topic).post_count, 2)
+        self.assertEqual(Profile.objects.get(user=self.user).post_count, 2)
+
+
+class PropagationTest(ForumTestCase):
+    def make_branch(self, depth):
+        from djtalks.djforum.models import Forum
+        forum = self.root
+        for level in range(depth):
+            forum = Forum.objects.create(name='level', parent=forum, depth=level+1,
+                                         path='{}{}.'.format(forum.path, forum.id))
+        return forum
+
+    def test_last_post_reaches_all_ancestors(self):
+        topic = self.add_topic(self.grandchild)
+        last_post_id = self.reload(topic).last_post_id
+        for forum in (self.root, self.child, self.grandchild):
+            self.assertEqual(self.reload(forum).last_post_id, last_post_id)
+        self.assertEqual(self.reload(self.sibling).last_post_id, None)
+
+    def test_last_post_delete(self):
+        older = self.reload(self.add_topic(self.sibling)).last_post
+        previous = self.reload(self.add_topic(self.grandchild)).last_post
+        topic = self.add_topic(self.grandchild)
+        self.reload(topic).last_post.delete()
+        # every forum falls back to the latest post left in its subtree
+        self.assertEqual(self.reload(self.grandchild).last_post_id, previous.id)
+        self.assertEqual(self.reload(self.root).last_post_id, previous.id)
+        self.assertEqual(self.reload(self.sibling).last_post_id, older.id)
+        previous.topic.delete()
+        self.assertEqual(self.reload(self.child).last_post_id, None)
+        self.assertEqual(self.reload(self.root).last_post_id, older.id)
+
+    def test_last_post_topic_move(self):
+        older = self.reload(self.add_topic(self.sibling)).last_post
+        topic = self.reload(self.add_topic(self.grandchild))
+        last_post = topic.last_post
+        topic.forum = self.sibling
+        topic.save()
+        # the branch the topic has left falls back to what is left in it
+        for forum in (self.child, self.grandchild):
+            self.assertEqual(self.reload(forum).last_post_id, None)
+        self.assertEqual(self.reload(self.sibling).last_post_id, last_post.id)
+        self.assertEqual(self.reload(self.sibling).updated, last_post.created)
+        self.assertEqual(self.reload(self.root).last_post_id, last_post.id)
+        topic.forum = self.grandchild
+        topic.save()
+        self.assertEqual(self.reload(self.sibling).last_post_id, older.id)
+        self.assertEqual(self.reload(self.sibling).updated, older.created)
+        self.assertEqual(self.reload(self.child).last_post_id, last_post.id)
+
+    def test_write_cost_is_flat(self):
+        from djtalks.djforum.models import Post
+        costs = []
+        for depth in (1, 8, 32):
+            topic = self.add_topic(self.make_branch(depth))
+            with measure() as m:
+                for i in range(10):
+                    Post.objects.create(topic=topic, author=self.user, message='message')
+            costs.append(m.queries)
+        self.assertEqual(len(set(costs)), 1, costs)
+
+
+class KeysetPaginationTest(ForumTestCase):
+    def setUp(self):
+        super(KeysetPaginationTest, self).setUp()
+        from django.utils import timezone
+        from djtalks.djforum.models import Post
+        self.topic = self.add_topic(self.child, posts=25)
+        # half of the posts share the timestamp, so the id decides the order
+        Post.objects.filter(id__lte=self.topic.posts.order_by('id')[12].id)\
+                    .update(created=timezone.now())
+        self.expected = list(self.topic.posts.order_by('created', 'id'))
+
+    def paginator(self):
+        from djtalks.djforum.pagination import KeysetPaginator
+        return KeysetPaginator(self.topic.posts.all(), ('created', 'id'), 10,
+                               count=len(self.expected))
+
+    def request(self, **params):
+        from django.test.client import RequestFactory
+        return RequestFactory().get('/', params)
+
+    def test_walk_forward_and_back(self):
+        paginator = self.paginator()
+        page = paginator.page_from_request(self.request())
+        seen = list(page)
+        while page.has_next:
+            page = paginator.page_from_request(self.request(after=page.next_cursor))
+            seen.extend(page)
+        self.assertEqual(seen, self.expected)
+        self.assertFalse(page.has_next)
+        page = paginator.page_from_request(self.request(before=page.previous_cursor))
+        self.assertEqual(list(page), self.expected[10:20])
+
+    def test_offset_and_last_pages(self):
+        paginator = self.paginator()
+        self.assertEqual(paginator.page_range, [1, 2, 3])
+        self.assertEqual(list(paginator.page_from_request(self.request(page=2))),
+                         self.expected[10:20])
+        last = paginator.page_from_request(self.request(page='last'))
+        self.assertEqual(list(last), self.expected[15:])
+        self.assertTrue(last.has_previous)
+
+    def test_views(self):
+        self.allow_anonymous(self.root, self.child)
+        response = self.client.get('/topic/{}/'.format(self.topic.id), dict(page=2))
+        self.assertEqual(list(response.context['posts']), self.expected[20:])
+        response = self.client.get('/forum/{}/'.format(self.child.id))
+        self.assertEqual(list(response.context['topics']), [self.topic])
+        self.assertEqual(response.context['topics'].paginator.count, 1)
+
+    def test_bad_requests(self):
+        from django.http import Http404
+        paginator = self.paginator()
+        for params in (dict(page=1000), dict(page='x'), dict(after='1.2.3'),
+                       dict(before='garbage')):
+            self.assertRaises(Http404, paginator.page_from_request, self.request(**params))
+
+
+class ForumTreeTest(ForumTestCase):
+    def setUp(self):
+        super(ForumTreeTest, self).setUp()
+        from django.core.cache import cache
+        cache.clear()
+
+    def test_make_forum_tree(self):
+        from djtalks.djforum.models import Forum
+        from djtalks.djforum.tree import make_forum_tree
+        forums = list(Forum.objects.order_by('-id'))
+        tree = make_forum_tree(None, forums)
+        self.assertEqual(tree.keys(), [self.root])
+        self.assertEqual(set(tree[self.root]), set([self.child, self.sibling]))
+        self.assertEqual(tree[self.root][self.child].keys(), [self.grandchild])
+        # forums whose parent is missing are left out
+        forums.remove(self.child)
+        self.assertEqual(make_forum_tree(None, forums)[self.root].keys(), [self.sibling])
+        self.assertEqual(make_forum_tree(self.child.id, list(Forum.objects.all())).keys(),
+                         [self.grandchild])
+
+    def test_index_is_cached(self):
+        self.allow_anonymous(self.root)
+        self.client.get('/')
+        with measure() as m:
+            response = self.client.get('/')
+        self.assertEqual(m.queries, 0)
+        self.assertEqual(response.context['forums'].keys(), [self.root])
+        self.assertEqual(set(response.context['forums'][self.root]),
+                         set([self.child, self.sibling]))
+
+    def test_invalidation(self):
+        from djtalks.djforum.models import Forum
+        anonymous = self.allow_anonymous(self.root)
+        self.assertEqual(self.client.get('/').context['forums'].keys(), [self.root])
+        other = Forum.objects.create(name='other', path='')
+        anonymous.grant('view', other)
+        self.assertEqual(self.client.get('/').context['forums'].keys(), [self.root, other])
+        added = Forum.objects.create(name='added', parent=other, path='{}.'.format(other.id),
+                                     depth=1)
+        forums = self.client.get('/').context['forums']
+        self.assertEqual(forums[other].keys(), [added])
+        topic = self.add_topic(added)
+        forums = self.client.get('/').context['forums']
+        self.assertEqual(forums.keys()[1].last_post_id, self.reload(topic).last_post_id)
+
+    def test_versions_outlive_default_timeout(self):
+        from django.core.cache import cache
+        from django.core.cache.backends import locmem
+        from djtalks.djforum import versions
+        versions.get('tree', 'forums')
+
+        class later(object):
+            @staticmethod
+            def time():
+                return time.time() + cache.default_timeout + 1
+        locmem.time = later
+        try:
+            # an expired version would start again from the current time
+            self.assertEqual(len(cache.get_many([versions.KEY.format('tree'),
+                                                 versions.KEY.format('forums')])), 2)
+        finally:
+            locmem.time = time
+
+
+class PermissionsTest(ForumTestCase):
+    def setUp(self):
+        super(PermissionsTest, self).setUp()
+        from django.core.cache import cache
+        cache.clear()
+
+    def permissions(self, user):
+        from djtalks.djforum.permissions import ForumPermissions
+        return ForumPermissions.for_user(user.id)
+
+    def test_inheritance(self):
+        self.user.grant('view', self.child)
+        self.user.grant('edit', self.grandchild)
+        permissions = self.permissions(self.user)
+        self.assertFalse(permissions.can_view(self.root.id))
+        self.assertFalse(permissions.can_view(self.sibling.id))
+        self.assertTrue(permissions.can_view(self.child.id))
+        self.assertTrue(permissions.can_view(self.grandchild.id))
+        self.assertFalse(permissions.has_perm('edit', self.child.id))
+        self.assertTrue(permissions.has_perm('edit', self.grandchild.id))
+
+    def test_superuser(self):
+        from django.contrib.auth.models import User
+        self.allow_anonymous(self.root)
+        topic = self.add_topic(self.sibling)
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        # no grants, like user.has_perm the superuser may see everything
+        self.assertEqual(self.client.get('/forum/{}/'.format(self.child.id)).status_code, 200)
+        self.assertEqual(self.client.get('/topic/{}/'.format(topic.id)).status_code, 200)
+        # an inactive one is a regular user
+        User.objects.filter(username='admin').update(is_active=False)
+        self.assertEqual(self.client.get('/topic/{}/'.format(topic.id)).status_code, 404)
+
+    def test_groups_and_invalidation(self):
+        from django.contrib.auth.models import Group
+        group = Group.objects.create(name='group')
+        group.grant('view', self.sibling)
+        self.assertFalse(self.permissions(self.user).can_view(self.sibling.id))
+        self.user.groups.add(group)
+        self.assertTrue(self.permissions(self.user).can_view(self.sibling.id))
+        with measure() as m:
+            self.permissions(self.user)
+        self.assertEqual(m.queries, 0)
+        group.revoke('view', self.sibling)
+        self.assertFalse(self.permissions(self.user).can_view(self.sibling.id))
+
+    def test_views(self):
+        self.allow_anonymous(self.child)
+        topic = self.add_topic(self.grandchild)
+        self.assertEqual(self.client.get('/forum/{}/'.format(self.root.id)).status_code, 404)
+        self.assertEqual(self.client.get('/forum/{}/'.format(self.child.id)).status_code, 200)
+        self.assertEqual(self.client.get('/topic/{}/'.format(topic.id)).status_code, 200)
+
+    def test_process_local_cache_warning(self):
+        import warnings
+        from django.conf import settings
+        from djtalks.djforum import versions
+        debug = settings.DEBUG
+        try:
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                settings.DEBUG = True
+                versions.check_backend()
+                self.assertEqual(caught, [])
+                settings.DEBUG = False
+                versions.check_backend()
+                self.assertEqual([w.category for w in caught], [RuntimeWarning])
+        finally:
+            settings.DEBUG = debug
+
+
+class MarkupTest(TestCase):
+    def assertRenders(self, message, html):
+        from djtalks.djforum.markup import render
+        self.assertEqual(render(message), html)
+
+    def test_tags(self):
+        self.assertRenders(u'[b]bold[/b] [i]it[/I]\nline',
+                           u'<strong>bold</strong> <em>it</em><br>\nline')
+        self.assertRenders(u'[quote=bob]hi[/quote]',
+                           u'<blockquote><cite>bob wrote:</cite>hi</blockquote>')
+        self.assertRenders(u'[code][b]x\n[/b][/code]',
+                           u'<pre><code>[b]x\n[/b]</code></pre>')
+
+    def test_links(self):
+        self.assertRenders(u'[url]http://a.com/?a=1&b=2[/url]',
+                           u'<a href="http://a.com/?a=1&amp;b=2" rel="nofollow">'
+                           u'http://a.com/?a=1&amp;b=2</a>')
+        self.assertRenders(u'[url=http://a.com]a [b]b[/b][/url]',
+                           u'<a href="http://a.com" rel="nofollow">a <strong>b</strong></a>')
+        self.assertRenders(u'[url=javascript:alert(1)]x[/url]',
+                           u'[url=javascript:alert(1)]x[/url]')
+
+    def test_escaping_and_balancing(self):
+        self.assertRenders(u'<script>[/i]', u'&lt;script&gt;[/i]')
+        self.assertRenders(u'[b][i]x[/b] y', u'<strong><em>x</em></strong> y')
+        self.assertRenders(u'[quote]open', u'<blockquote>open</blockquote>')
+
+
+class RerenderTest(ForumTestCase):
+    def test_post_is_rendered_on_save(self):
+        from djtalks.djforum.markup import RENDERER_VERSION
+        post = self.add_topic(self.child).posts.get()
+        post.message = '[b]edited[/b]'
+        post.save()
+        post = self.reload(post)
+        self.assertEqual(post.body_html, '<strong>edited</strong>')
+        self.assertEqual(post.body_version, RENDERER_VERSION)
+
+    def test_rerender_stale_posts(self):
+        from StringIO import StringIO
+        from django.core.management import call_command
+        from djtalks.djforum.markup import RENDERER_VERSION
+        from djtalks.djforum.models import Post
+        topic = self.add_topic(self.child, posts=5)
+        Post.objects.filter(id__in=topic.posts.values_list('id', flat=True)[:3])\
+                    .update(body_html='', body_version=0)
+        call_command('rerender', processes=1, chunk_size=2, stdout=StringIO())
+        self.assertEqual(set(topic.posts.values_list('body_html', 'body_version')),
+                         set([('message', RENDERER_VERSION)]))
+
+
+    def test_rerender_keeps_edits(self):
+        from StringIO import StringIO
+        from django.core.management import call_command
+        from djtalks.djforum import markup
+        from djtalks.djforum.management.commands import rerender
+        post = self.add_topic(self.child).posts.get()
+
+        def render(message):
+            # the post is edited while the old message is being rendered
+            edited = self.reload(post)
+            edited.message = '[b]edited[/b]'
+            edited.save()
+            return markup.render(message)
+
+        rerender.render = render
+        try:
+            call_command('rerender', all=True, processes=1, stdout=StringIO())
+        finally:
+            rerender.render = markup.render
+        self.assertEqual(self.reload(post).body_html, '<strong>edited</strong>')
+
+
+class ViewCounterTest(ForumTestCase):
+    def test_flush(self):
+        from djtalks.djforum.viewcounts import ViewCounter
+        first, second = self.add_topic(self.child), self.add_topic(self.child)
+        counter = ViewCounter(flush_interval=3600, max_buffered=5, background=False)
+        with measure() as m:
+            for topic in (first, second, first, first, second):
+                counter.hit(topic.id)
+        # hits never write, the flusher thread does
+        self.assertEqual(m.queries, 0)
+        self.assertTrue(counter.event.is_set())
+        with measure() as m:
+            counter.flush()
+        self.assertEqual(m.queries, 1)
+        self.assertEqual((self.reload(first).views, self.reload(second).views), (3, 2))
+        counter.hit(first.id)
+        counter.flush()
+        self.assertEqual(self.reload(first).views, 4)
+
+    def test_failed_flush_keeps_hits(self):
+        from django.db import DatabaseError
+        from djtalks.djforum import viewcounts
+        topic = self.add_topic(self.child)
+        counter = viewcounts.ViewCounter(background=False)
+        counter.hit(topic.id)
+        counter.hit(topic.id)
+
+        def fail(hits):
+            raise DatabaseError('disk I/O error')
+        counter.write = fail
+        viewcounts.logger.disabled = True
+        try:
+            counter.flush()
+        finally:
+            viewcounts.logger.disabled = False
+        self.assertEqual((counter.hits, counter.buffered), ({topic.id: 2}, 2))
+        del counter.write
+        counter.flush()
+        self.assertEqual(self.reload(topic).views, 2)
+
+    def test_topic_view(self):
+        from djtalks.djforum import viewcounts
+        # drop the hits left by the other tests
+        viewcounts.counter.take()
+        self.allow_anonymous(self.root)
+        topic = self.add_topic(self.child)
+        self.client.get('/topic/{}/'.format(topic.id))
+        self.client.get('/topic/{}/'.format(topic.id))
+        viewcounts.counter.flush()
+        self.assertEqual(self.reload(topic).views, 2)
+
+
+class Fts5SearchTest(ForumTestCase):
+    backend = 'fts5'
+
+    def setUp(self):
+        from django.core.cache import cache
+        from djtalks.djforum import search
+        cache.clear()
+        search.BACKEND, search._backend = self.backend, None
+        super(Fts5SearchTest, self).setUp()
+        from djtalks.djforum.models import Topic, Post
+        self.topic = Topic.objects.create(forum=self.grandchild, author=self.user,
+                                          subject='Mining hardware')
+        self.post = Post.objects.create(topic=self.topic, author=self.user,
+                                        message='Which GPU is the best for mining?')
+        self.hidden = Topic.objects.create(forum=self.sibling, author=self.user,
+                                           subject='Secret mining')
+
+    def tearDown(self):
+        from djtalks.djforum import search
+        search.BACKEND, search._backend = 'auto', None
+
+    def search(self, query, *forums, **kwargs):
+        from djtalks.djforum.permissions import ForumPermissions
+        from djtalks.djforum.search import search
+        grants = dict((forum.id, 1) for forum in forums)
+        return search(query, ForumPermissions(self.user.id, grants), **kwargs)
+
+    def test_ranking_and_permissions(self):
+        self.assertEqual(self.search('mining', self.grandchild),
+                         [(None, self.topic.id), (self.post.id, self.topic.id)])
+        self.assertEqual(self.search('GPU mining', self.grandchild),
+                         [(self.post.id, self.topic.id)])
+        self.assertEqual(len(self.search('mining', self.grandchild, self.sibling)), 3)
+        self.assertEqual(self.search('mining', self.grandchild, offset=1, limit=1),
+                         [(self.post.id, self.topic.id)])
+        self.assertEqual(self.search('', self.grandchild), [])
+
+    def test_maintenance(self):
+        self.post.message = 'ASIC'
+        self.post.save()
+        self.assertEqual(self.search('GPU', self.grandchild), [])
+        self.assertEqual(self.search('asic', self.grandchild), [(self.post.id, self.topic.id)])
+        self.topic.forum = self.sibling
+        self.topic.save()
+        self.assertEqual(self.search('asic', self.grandchild), [])
+        self.assertEqual(self.search('asic', self.sibling), [(self.post.id, self.topic.id)])
+        self.topic.delete()
+        self.assertEqual(self.search('asic hardware', self.sibling), [])
+
+    def test_reindex(self):
+        from StringIO import StringIO
+        from django.core.management import call_command
+        from djtalks.djforum import search
+        search.get_backend().clear()
+        self.assertEqual(self.search('mining', self.grandchild), [])
+        call_command('reindex', chunk_size=1, stdout=StringIO())
+        self.assertEqual(len(self.search('mining', self.grandchild)), 2)
+
+    def test_view(self):
+        self.allow_anonymous(self.child)
+        response = self.client.get('/search/', dict(q='mining'))
+        self.assertEqual([(result['topic'], result['post']) for result in response.context['results']],
+                         [(self.topic, None), (self.topic, self.post)])
+
+
+class PythonSearchTest(Fts5SearchTest):
+    backend = 'python'
+
+
+class ConversationTest(TestCase):
+    def setUp(self):
+        from django.contrib.auth.models import User
+        from djtalks.djforum.models import PrivateMessage, Inbox
+        self.alice, self.bob, self.eve = [User.objects.create_user(name, name + '@example.com', name)
+                                          for name in ('alice', 'bob', 'eve')]
+        self.first = PrivateMessage.objects.create(sender=self.alice, subject='hi', message='1')
+        self.reply = PrivateMessage.objects.create(sender=self.bob, subject='re', message='2',
+                                                   parent=self.first,
+                                                   conversation_id=self.first.conversation_id)
+        self.second = PrivateMessage.objects.create(sender=self.alice, subject='hi', message='3',
+                                                    parent=self.first,
+                                                    conversation_id=self.first.conversation_id)
+        self.nested = PrivateMessage.objects.create(sender=self.alice, subject='re', message='4',
+                                                    parent=self.reply,
+                                                    conversation_id=self.first.conversation_id)
+        Inbox.objects.bulk_create([Inbox(message=self.first, recipient=self.bob),
+                                   Inbox(message=self.second, recipient=self.bob),
+                                   Inbox(message=self.nested, recipient=self.bob),
+                                   Inbox(message=self.reply, recipient=self.alice)])
+
+    def url(self):
+        return '/inbox/conversation/{}/'.format(self.first.conversation_id)
+
+    def test_tree_and_read_marking(self):
+        from djtalks.djforum.models import Inbox
+        self.client.login(username='bob', password='bob')
+        response = self.client.get(self.url())
+        self.assertEqual(response.context['messages'],
+                         [self.first, self.reply, self.nested, self.second])
+        self.assertEqual([message.unread for message in response.context['messages']],
+                         [1, 0, 1, 1])
+        self.assertFalse(Inbox.objects.filter(recipient=self.bob, is_read=False).exists())
+        self.assertTrue(Inbox.objects.filter(recipient=self.alice, is_read=False).exists())
+
+    def test_outsiders_are_not_allowed(self):
+        self.client.login(username='eve', password='eve')
+        self.assertEqual(self.client.get(self.url()).status_code, 404)
+
+    def test_inbox_summary(self):
+        from django.core.cache import cache
+        from djtalks.djforum import inbox
+        cache.clear()
+        self.assertEqual(inbox.summary(self.bob.id).unread, 3)
+        self.assertEqual([c['conversation_id'] for c in inbox.conversations(self.bob.id)],
+                         [self.first.conversation_id])
+        self.client.login(username='alice', password='alice')
+        response = self.client.post('/inbox/new/', dict(recipients='bob', subject='new',
+                                                        message='new conversation'))
+        self.assertEqual(response.status_code, 302)
+        with measure() as m:
+            summary = inbox.summary(self.bob.id)
+        self.assertEqual(m.queries, 0)
+        self.assertEqual(summary.unread, 4)
+        # the delivery has dropped the cached conversations of both users
+        conversations = inbox.conversations(self.bob.id)
+        self.assertEqual(len(conversations), 2)
+        self.assertEqual(conversations[1]['conversation_id'], self.first.conversation_id)
+        with measure() as m:
+            self.assertEqual(inbox.conversations(self.bob.id), conversations)
+        self.assertEqual(m.queries, 0)
+        self.client.login(username='bob', password='bob')
+        self.client.get(self.url())
+        self.assertEqual(inbox.summary(self.bob.id).unread, 1)
+
+    def test_retried_delivery(self):
+        from django.core.cache import cache
+        from django.db import DatabaseError, transaction
+        from djtalks.djforum import inbox, writes
+        cache.clear()
+        self.assertEqual(inbox.summary(self.bob.id).unread, 3)
+        commit, attempts = transaction.commit, []
+
+        def locked_once(using=None):
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise DatabaseError('database is locked')
+            return commit(using=using)
+
+        transaction.commit = locked_once
+        backoff, writes.BACKOFF = writes.BACKOFF, 0
+        try:
+            self.client.login(username='alice', password='alice')
+            response = self.client.post('/inbox/new/', dict(recipients='bob', subject='new',
+                                                            message='new conversation'))
+        finally:
+            writes.BACKOFF = backoff
+            transaction.commit = commit
+        self.assertEqual(response.status_code, 302)
+        # only the write was retried, the cached summary is updated once
+        self.assertEqual(inbox.summary(self.bob.id).unread, 4)
+
+    def test_inbox_listing(self):
+        from djtalks.djforum.models import PrivateMessage, Inbox
+        other = PrivateMessage.objects.create(sender=self.eve, subject='spam', message='5')
+        Inbox.objects.create(message=other, recipient=self.bob)
+        self.client.login(username='bob', password='bob')
+        conversations = self.client.get('/inbox/').context['conversations']
+        self.assertEqual([(c['last'], c['unread']) for c in conversations],
+                         [(other, 1), (self.nested, 3)])
+
+
+class TreeMutationTest(ForumTestCase):
+    def assertConsistent(self):
+        """
+        Checks that path, depth and has_subforums of every forum agree with
+        the parent links
+        """
+        from djtalks.djforum.models import Forum
+        forums = dict((forum.id, forum) for forum in Forum.objects.all())
+        parents = set(forum.parent_id for forum in forums.values())
+        for forum in forums.values():
+            parent = forums.get(forum.parent_id)
+            self.assertEqual(forum.path, parent.subtree_path if parent else '')
+            self.assertEqual(forum.depth, parent.depth + 1 if parent else 0)
+            self.assertEqual(forum.has_subforums, forum.id in parents)
+
+    def test_insert_move_delete(self):
+        from djtalks.djforum.models import Forum
+        leaf = Forum.objects.insert(Forum(name='leaf'), self.grandchild)
+        self.add_topic(leaf, posts=2)
+        self.assertConsistent()
+
+        Forum.objects.move(self.child, self.sibling)
+        self.assertConsistent()
+        self.assertEqual(self.reload(leaf).depth, 4)
+        self.assertEqual(self.reload(self.sibling).post_count, 2)
+        self.assertEqual(self.reload(self.root).post_count, 2)
+
+        Forum.objects.move(self.grandchild)
+        self.assertConsistent()
+        self.assertEqual(self.reload(self.sibling).post_count, 0)
+        self.assertEqual(self.reload(self.root).post_count, 0)
+        self.assertEqual(self.reload(self.grandchild).post_count, 2)
+        self.assertRaises(ValueError, Forum.objects.move, self.grandchild, leaf)
+
+        Forum.objects.delete_subtree(self.grandchild)
+        self.assertFalse(Forum.objects.filter(pk__in=[self.grandchild.id, leaf.id]).exists())
+        self.assertEqual(self.reload(self.user.forum_profile).post_count, 0)
+        self.assertConsistent()
+
+    def test_move_last_post(self):
+        from djtalks.djforum import versions, writes
+        from djtalks.djforum.models import Forum
+        older = self.reload(self.add_topic(self.sibling)).last_post
+        last_post = self.reload(self.add_topic(self.grandchild)).last_post
+        before = versions.get('tree', 'forums')
+        writes.local.queue = []
+        try:
+            Forum.objects.move(self.grandchild, self.sibling)
+            # the move hasn't committed yet
+            self.assertEqual(versions.get('tree', 'forums'), before)
+            queue = writes.local.queue
+        finally:
+            writes.local.queue = None
+        for func, args, kwargs in queue:
+            writes.run(writes.apply, func, args, kwargs)
+        self.assertNotEqual(versions.get('tree', 'forums'), before)
+        self.assertEqual(self.reload(self.child).last_post_id, None)
+        self.assertEqual(self.reload(self.sibling).last_post_id, last_post.id)
+        self.assertEqual(self.reload(self.root).last_post_id, last_post.id)
+        Forum.objects.move(self.grandchild, self.child)
+        self.assertEqual(self.reload(self.sibling).last_post_id, older.id)
+        self.assertEqual(self.reload(self.sibling).updated, older.created)
+        self.assertEqual(self.reload(self.child).last_post_id, last_post.id)
+
+    def test_move_large_subtree(self):
+        from djtalks.djforum.models import Forum
+        from djtalks.djforum.utils import chunks
+        # 10k forums hanging from the child, 10 children per forum
+        forums, parents = [], [self.child]
+        while len(forums) < 10000:
+            parent = parents.pop(0)
+            for i in range(10):
+                forum = Forum(id=1000 + len(forums), name='forum', parent_id=parent.id,
+                              path=parent.subtree_path, depth=parent.depth + 1)
+                forums.append(forum)
+                parents.append(forum)
+        parent_ids = set(forum.parent_id for forum in forums)
+        for forum in forums:
+            forum.has_subforums = forum.id in parent_ids
+        for chunk in chunks(forums, 50):
+            Forum.objects.bulk_create(chunk)
+        self.assertConsistent()
+
+        with measure() as m:
+            Forum.objects.move(self.child, self.sibling)
+        self.assertLess(m.queries, 15)
+        self.assertConsistent()
+        self.assertEqual(Forum.objects.all().descendants(self.sibling).count(), 10002)
+
+    def test_admin_keeps_counters(self):
+        from django.contrib import admin
+        from django.contrib.auth.models import User
+        from django.test.client import RequestFactory
+        from djtalks.djforum.admin import ForumAdmin
+        from djtalks.djforum.models import Forum
+        request = RequestFactory().post('/')
+        request.user = User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        model_admin = ForumAdmin(Forum, admin.site)
+        # the form is loaded before the topic is posted
+        stale = self.reload(self.child)
+        self.add_topic(self.grandchild, posts=2)
+        data = dict(name='renamed', description='', parent=self.sibling.id)
+        form = model_admin.get_form(request, stale)(data, instance=stale)
+        self.assertTrue(form.is_valid(), form.errors)
+        model_admin.save_model(request, form.save(commit=False), form, True)
+        child = self.reload(self.child)
+        self.assertEqual((child.name, child.parent_id), ('renamed', self.sibling.id))
+        self.assertEqual((child.post_count, child.topic_count), (2, 1))
+        self.assertEqual(child.path, self.reload(self.sibling).subtree_path)
+        self.assertEqual(self.reload(self.sibling).post_count, 2)
+
+
+class FragmentCacheTest(ForumTestCase):
+    def setUp(self):
+        super(FragmentCacheTest, self).setUp()
+        from django.core.cache import cache
+        cache.clear()
+        self.allow_anonymous(self.root)
+        self.topic = self.add_topic(self.child, posts=3)
+        self.other = self.add_topic(self.sibling, posts=1)
+
+    def test_hit_skips_queries(self):
+        url = '/topic/{}/'.format(self.topic.id)
+        with measure() as cold:
+            self.client.get(url)
+        with measure() as warm:
+            response = self.client.get(url)
+        # the page of posts isn't fetched on a hit
+        self.assertLess(warm.queries, cold.queries)
+        self.assertContains(response, '<td>message<br>', count=3)
+
+    def test_post_invalidates_its_topic_and_lineage(self):
+        from djtalks.djforum import fragments, versions
+        from djtalks.djforum.models import Post
+        names = [fragments.topic_version(self.topic.id),
+                 fragments.topic_version(self.other.id)] + \
+                [fragments.forum_version(forum.id) for forum in
+                 (self.root, self.child, self.grandchild, self.sibling)]
+        before = versions.get(*names)
+        Post.objects.create(topic=self.topic, author=self.user, message='new')
+        changed = [a != b for a, b in zip(before, versions.get(*names))]
+        self.assertEqual(changed, [True, False, True, True, False, False])
+
+        self.client.get('/topic/{}/'.format(self.topic.id))
+        Post.objects.create(topic=self.topic, author=self.user, message='newest')
+        self.assertContains(self.client.get('/topic/{}/'.format(self.topic.id)),
+                            'newest')
+        self.assertContains(self.client.get('/forum/{}/'.format(self.child.id)),
+                            '<td>5</td>')
+
+    def test_author_post_counts(self):
+        from djtalks.djforum.models import Post
+        url = '/topic/{}/'.format(self.topic.id)
+        self.assertContains(self.client.get(url), '4 posts', count=3)
+        with measure() as hit:
+            self.client.get(url)
+        # a post elsewhere leaves the topic alone, but not its author
+        Post.objects.create(topic=self.other, author=self.user, message='elsewhere')
+        self.assertContains(self.client.get(url), '5 posts', count=3)
+        with measure() as m:
+            self.client.get(url)
+        self.assertEqual(m.queries, hit.queries)
+
+    def test_bump_after_commit(self):
+        from djtalks.djforum import fragments, versions, writes
+        name = fragments.topic_version(self.topic.id)
+        before = versions.get(name)
+        writes.local.queue = []
+        try:
+            self.add_topic(self.child)
+            self.reload(self.topic).posts.create(author=self.user, message='new')
+            # the view's transaction hasn't committed yet
+            self.assertEqual(versions.get(name), before)
+            queue = writes.local.queue
+        finally:
+            writes.local.queue = None
+        for func, args, kwargs in queue:
+            writes.run(writes.apply, func, args, kwargs)
+        self.assertNotEqual(versions.get(name), before)
+
+
+class ConditionalGetTest(ForumTestCase):
+    def setUp(self):
+        super(ConditionalGetTest, self).setUp()
+        from django.core.cache import cache
+        cache.clear()
+        self.allow_anonymous(self.root)
+        self.topic = self.add_topic(self.child, posts=2)
+
+    def revalidate(self, url, response, **headers):
+        if response.has_header('ETag'):
+            headers.setdefault('HTTP_IF_NONE_MATCH', response['ETag'])
+        if response.has_header('Last-Modified'):
+            headers.setdefault('HTTP_IF_MODIFIED_SINCE', response['Last-Modified'])
+        return self.client.get(url, **headers)
+
+    def test_not_modified(self):
+        for url in ('/', '/forum/{}/'.format(self.child.id),
+                    '/topic/{}/'.format(self.topic.id)):
+            response = self.client.get(url)
+            self.assertTrue(response.has_header('ETag'))
+            self.assertTrue(response.has_header('Last-Modified'))
+            with measure() as m:
+                self.assertEqual(self.revalidate(url, response).status_code, 304)
+            self.assertLessEqual(m.queries, 1)
+
+    def test_changes_and_permissions(self):
+        from djtalks.djforum.models import Post
+        url = '/topic/{}/'.format(self.topic.id)
+        response = self.client.get(url)
+        Post.objects.create(topic=self.topic, author=self.user, message='new')
+        self.assertEqual(self.revalidate(url, response).status_code, 200)
+
+        # the same page seen by another user has a different validator
+        response = self.client.get(url)
+        self.user.grant('view', self.root)
+        self.client.login(username='user', password='user')
+        logged_in = self.client.get(url)
+        self.assertNotEqual(logged_in['ETag'], response['ETag'])
+        self.assertFalse(logged_in.has_header('Last-Modified'))
+        self.assertEqual(self.revalidate(url, response).status_code, 200)
+        self.assertEqual(self.revalidate(url, logged_in).status_code, 304)
+
+
+    def test_author_changes(self):
+        url = '/topic/{}/'.format(self.topic.id)
+        response = self.client.get(url)
+        self.assertEqual(self.revalidate(url, response, HTTP_IF_MODIFIED_SINCE='').status_code,
+                         304)
+        # the post count of the author shown on the page goes up
+        self.add_topic(self.sibling)
+        self.assertEqual(self.revalidate(url, response, HTTP_IF_MODIFIED_SINCE='').status_code,
+                         200)
+
+
+class MetricsTest(ForumTestCase):
+    def setUp(self):
+        super(MetricsTest, self).setUp()
+        from djtalks.djforum import metrics
+        self.allow_anonymous(self.root)
+        self.budgets = metrics.QUERY_BUDGETS
+        metrics.registry.clear()
+
+    def tearDown(self):
+        from djtalks.djforum import metrics
+        metrics.QUERY_BUDGETS = self.budgets
+
+    def test_histograms_and_budgets(self):
+        from djtalks.djforum import metrics
+        view = 'djtalks.djforum.views.forum'
+        metrics.QUERY_BUDGETS = {view: 0}
+        # the violations are counted below
+        metrics.logger.disabled = True
+        try:
+            self.client.get('/forum/{}/'.format(self.child.id))
+            self.client.get('/forum/{}/'.format(self.child.id))
+        finally:
+            metrics.logger.disabled = False
+        histograms = metrics.registry.histograms
+        self.assertEqual(histograms['djforum_request_seconds'][view].count, 2)
+        self.assertGreater(histograms['djforum_queries'][view].sum, 0)
+        self.assertGreater(histograms['djforum_template_seconds'][view].sum, 0)
+        self.assertEqual(metrics.registry.violations, {view: 2})
+
+    def test_export(self):
+        self.client.get('/forum/{}/'.format(self.child.id))
+        self.assertEqual(self.client.get('/metrics/', REMOTE_ADDR='10.0.0.1').status_code, 404)
+        response = self.client.get('/metrics/')
+        self.assertContains(response, 'djforum_queries_count{view="djtalks.djforum.views.forum"} 1')
+        self.assertContains(response,
+            'djforum_request_seconds_bucket{view="djtalks.djforum.views.forum",le="+Inf"} 1')
+
+
+class GenerateTest(TestCase):
+    def test_generate_and_benchmark(self):
+        import json
+        from StringIO import StringIO
+        from django.core.cache import cache
+        from django.core.management import call_command
+        from djtalks.djforum import metrics
+        from djtalks.djforum.models import Forum, Topic, Post, PrivateMessage
+        cache.clear()
+        call_command('generate', forums=40, depth=5, users=20, topics=60, posts=500,
+                     conversations=10, stdout=StringIO())
+        self.assertEqual(Forum.objects.count(), 40)
+        self.assertEqual(Topic.objects.count(), 60)
+        self.assertEqual(Post.objects.count(), sum(Topic.objects.values_list('post_count',
+                                                                             flat=True)))
+        self.assertTrue(PrivateMessage.objects.exists())
+        self.assertTrue(Forum.objects.filter(depth=4).exists())
+        # replies are threaded under the post they reply to
+        self.assertFalse(Post.objects.filter(path='').exists())
+        replies = Post.objects.filter(reply_to__isnull=False).select_related('reply_to')
+        self.assertTrue(replies.exists())
+        for reply in replies:
+            self.assertEqual(reply.path, Post.make_path(reply.reply_to.path, reply.id))
+            self.assertEqual(reply.depth, reply.reply_to.depth + 1)
+        # counters are consistent with the rows
+        output = StringIO()
+        call_command('recount', dry_run=True, stdout=output)
+        self.assertEqual(output.getvalue().count(': 0 drifted'), 6)
+
+        metrics.registry.clear()
+        output = StringIO()
+        call_command('benchmark', repeat=2, stdout=output, stderr=StringIO())
+        report = json.loads(output.getvalue())
+        # no view goes over its query budget, cold caches included
+        self.assertEqual(metrics.registry.violations, {})
+        self.assertEqual(set(report['scenarios']),
+                         set(['index', 'forum', 'forum_last_page', 'topic',
+                              'topic_last_page', 'inbox', 'post', 'new_pm']))
+        self.assertGreater(report['scenarios']['topic']['cold_queries'], 0)
+        self.assertEqual(report['dataset']['djforum_topic'], 60)
+
+
+class DumpLoadTest(ForumTestCase):
+    def test_roundtrip(self):
+        import os
+        import tempfile
+        from StringIO import StringIO
+        from django.contrib.auth.models import User, Group
+        from django.core.management import call_command
+        from djtalks.djforum.models import Forum, Topic, Post, Profile, PrivateMessage, Inbox
+        from djtalks.djforum.permissions import ForumPermissions
+        from object_permissions.registration import permission_map
+        other = User.objects.create_user('other', 'other@example.com', 'other')
+        topic = self.add_topic(self.grandchild, posts=3)
+        self.add_topic(self.sibling, posts=2)
+        Post.objects.create(topic=topic, author=other, message='[b]bold[/b]')
+        message = PrivateMessage.objects.create(sender=self.user, subject='hi', message='hi')
+        Inbox.objects.create(message=message, recipient=other)
+        group = Group.objects.create(name='group')
+        group.grant('view', self.root)
+        self.user.groups.add(group)
+        other.grant('view', self.sibling)
+        other.grant('edit', topic)
+        # `updated` of topics is recomputed from the posts, it's set a bit
+        # later than the creation time of the post by the hooks
+        def rows(model):
+            return [dict(row, updated=None) for row in model.objects.order_by('id').values()]
+        forums, topics, posts = rows(Forum), rows(Topic), list(Post.objects.order_by('id').values())
+        grants = [ForumPermissions.load(user.id).grants for user in (self.user, other)]
+        # as in dumps made before threading
+        Post.objects.update(path='', depth=0)
+
+        fd, path = tempfile.mkstemp(suffix='.jsonl')
+        os.close(fd)
+        try:
+            call_command('dumpboard', output=path)
+            for model in (Inbox, PrivateMessage, Post, Topic, Forum, Profile, User, Group):
+                model.objects.all().delete()
+            # the default group of new users is there already, under another id
+            Group.objects.create(name='unrelated')
+            Group.objects.create(name='group')
+            with measure() as m:
+                call_command('loadboard', path, chunk_size=2, stdout=StringIO())
+        finally:
+            os.remove(path)
+        self.assertEqual(rows(Forum), forums)
+        self.assertEqual(rows(Topic), topics)
+        self.assertEqual(list(Post.objects.order_by('id').values()), posts)
+        self.assertEqual(Profile.objects.get(user=other).post_count, 1)
+        self.assertEqual(Profile.objects.get(user=self.user).post_count, 5)
+        self.assertEqual(Inbox.objects.get(message=message.id).recipient_id, other.id)
+        self.assertEqual([ForumPermissions.load(user.id).grants for user in (self.user, other)],
+                         grants)
+        self.assertTrue(permission_map[Topic].objects.filter(user=other, obj=topic.id,
+                                                             edit=True).exists())
+        # inserts plus a handful of statements, no per-row signal cascade
+        self.assertLess(m.queries, 30)
+
+
+class ReplicaRouterTest(ForumTestCase):
+    def setUp(self):
+        super(ReplicaRouterTest, self).setUp()
+        from djtalks.djforum import routers
+        self.replicas = routers.REPLICAS
+        routers.REPLICAS = ['replica']
+        self.allow_anonymous(self.root)
+        self.topic = self.add_topic(self.child)
+
+    def tearDown(self):
+        from djtalks.djforum import routers
+        routers.REPLICAS = self.replicas
+        routers.local.__dict__.clear()
+
+    def request(self, method='GET', **cookies):
+        from django.http import HttpResponse
+        from django.test.client import RequestFactory
+        from djtalks.djforum.routers import ReplicaMiddleware
+        request = getattr(RequestFactory(), method.lower())('/')
+        request.COOKIES.update(cookies)
+        middleware = ReplicaMiddleware()
+        middleware.process_request(request)
+        return lambda: middleware.process_response(request, HttpResponse())
+
+    def test_routing(self):
+        from django.contrib.auth.models import User
+        from djtalks.djforum.models import Post, Topic
+        from djtalks.djforum.routers import ReplicaRouter, PIN_COOKIE
+        router = ReplicaRouter()
+        # outside of requests everything goes to the primary
+        self.assertEqual(router.db_for_read(Topic), 'default')
+
+        finish = self.request()
+        self.assertEqual(router.db_for_read(Topic), 'replica')
+        self.assertEqual(router.db_for_read(User), None)
+        self.assertEqual(router.db_for_write(Post), 'default')
+        # the request has written, so it reads its own writes
+        self.assertEqual(router.db_for_read(Topic), 'default')
+        self.assertTrue(PIN_COOKIE in finish().cookies)
+
+        finish = self.request()
+        self.assertEqual(router.db_for_read(Topic), 'replica')
+        self.assertFalse(PIN_COOKIE in finish().cookies)
+
+        # pinned clients and unsafe requests read from the primary
+        for finish in (self.request(**{PIN_COOKIE: '1'}), self.request('POST')):
+            self.assertEqual(router.db_for_read(Topic), 'default')
+            finish()
+
+    def test_pin_after_post(self):
+        from djtalks.djforum import routers
+        from djtalks.djforum.routers import PIN_COOKIE
+        # the test database has no replicas, the primary stands in for one
+        routers.REPLICAS = ['default']
+        url = '/topic/{}/'.format(self.topic.id)
+        self.assertFalse(PIN_COOKIE in self.client.get(url).cookies)
+        self.client.login(username='user', password='user')
+        self.user.grant('view', self.root)
+        response = self.client.post(url, dict(message='reply'))
+        self.assertTrue(PIN_COOKIE in response.cookies)
+
+
+class WritesTest(ForumTestCase):
+    def test_pragmas(self):
+        import os
+        import tempfile
+        from django.db import connection
+        from django.db.backends.sqlite3.base import DatabaseWrapper
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'test.sqlite')
+        db = DatabaseWrapper(dict(connection.settings_dict, NAME=path))
+        try:
+            cursor = db.cursor()
+            cursor.execute('PRAGMA journal_mode')
+            self.assertEqual(cursor.fetchone()[0], 'wal')
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)
+        finally:
+            db.close()
+            for name in os.listdir(directory):
+                os.remove(os.path.join(directory, name))
+            os.rmdir(directory)
+
+    def test_deferred_counters(self):
+        from django.http import HttpResponse
+        from django.test.client import RequestFactory
+        from djtalks.djforum import writes
+        from djtalks.djforum.models import Post
+        topic = self.add_topic(self.child)
+        request = RequestFactory().post('/')
+        middleware = writes.WriteMiddleware()
+        defer, writes.DEFER = writes.DEFER, True
+        try:
+            middleware.process_request(request)
+            Post.objects.create(topic=topic, author=self.user, message='reply')
+            self.assertEqual(self.reload(topic).post_count, 1)
+            self.assertEqual(self.reload(self.root).post_count, 1)
+            middleware.process_response(request, HttpResponse())
+        finally:
+            writes.DEFER = defer
+        self.assertEqual(self.reload(topic).post_count, 2)
+        self.assertEqual(self.reload(self.root).post_count, 2)
+        self.assertEqual(self.reload(self.user.forum_profile).post_count, 2)
+
+    def test_retry_when_locked(self):
+        from django.db import DatabaseError
+        from djtalks.djforum import writes
+        attempts = []
+
+        def write():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise DatabaseError('database is locked')
+            return 'done'
+
+        backoff, writes.BACKOFF = writes.BACKOFF, 0
+        try:
+            self.assertEqual(writes.run(write), 'done')
+            self.assertEqual(len(attempts), 3)
+            del attempts[:]
+            writes.RETRIES, retries = 1, writes.RETRIES
+            try:
+                self.assertRaises(DatabaseError, writes.run, write)
+            finally:
+                writes.RETRIES = retries
+        finally:
+            writes.BACKOFF = backoff
+
+    def test_reply_through_view(self):
+        self.allow_anonymous(self.root)
+        self.user.grant('view', self.root)
+        topic = self.add_topic(self.child)
+        self.client.login(username='user', password='user')
+        response = self.client.post('/topic/{}/'.format(topic.id), dict(message='reply'))
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response['Location'].endswith('/topic/{}/?page=last'.format(topic.id)))
+        self.assertEqual(self.reload(topic).post_count, 2)
+        self.assertEqual(self.reload(self.root).post_count, 2)
+
+
+class AvatarTest(ForumTestCase):
+    def test_profile_hash(self):
+        from hashlib import md5
+        profile = self.user.forum_profile
+        self.assertEqual(profile.avatar_hash, md5('user@example.com').hexdigest())
+        self.user.email = ' New@Example.com'
+        self.user.save()
+        self.assertEqual(self.reload(profile).avatar_hash, md5('new@example.com').hexdigest())
+
+    def test_memoize(self):
+        from djtalks.djforum.avatars import memoize
+        calls = []
+
+        @memoize(2)
+        def double(value):
+            calls.append(value)
+            return value * 2
+
+        self.assertEqual([double(1), double(2), double(1), double(3)], [2, 4, 2, 6])
+        # 2 was the least recently used
+        double(1), double(2)
+        self.assertEqual(calls, [1, 2, 3, 2])
+
+    def test_tag(self):
+        from django.template import Template, Context
+        from djtalks.djforum.models import Post
+        self.add_topic(self.child)
+        post = Post.objects.prefetch_related('author__forum_profile').get()
+        template = Template('{% load gravatar %}{% avatar_url post.author %}|'
+                            '{% avatar_url post.author 80 "identicon" %}|'
+                            '{{ post.author.email|gravatar_url }}')
+        with self.assertNumQueries(0):
+            small, large, filtered = template.render(Context(dict(post=post))).split('|')
+        hash = self.user.forum_profile.avatar_hash
+        self.assertEqual(small, 'http://www.gravatar.com/avatar/{}?d=mm&amp;s=48'.format(hash))
+        self.assertEqual(large, 'http://www.gravatar.com/avatar/{}?d=identicon&amp;s=80'
+                                .format(hash))
+        self.assertEqual(filtered, 'http://www.gravatar.com/avatar/{}?d=mm&amp;s=48'.format(hash))
+
+
+class AuthorLoaderTest(ForumTestCase):
+    def test_load(self):
+        from django.contrib.auth.models import User
+        from djtalks.djforum import authors
+        from djtalks.djforum.models import Post, Profile
+        topic = self.add_topic(self.child)
+        for name in ('first', 'second', 'third'):
+            user = User.objects.create_user(name, name + '@example.com', name)
+            Post.objects.create(topic=topic, author=user, message='reply')
+        Profile.objects.filter(user__username__in=('second', 'third')).delete()
+        posts = list(topic.posts.order_by('id'))
+        # users, profiles, post counts of the missing profiles and their insert
+        # and the created profiles
+        with self.assertNumQueries(5):
+            authors.load(posts)
+        with self.assertNumQueries(0):
+            counts = [post.author.forum_profile.post_count for post in posts]
+            hashes = [post.author.forum_profile.avatar_hash for post in posts]
+        self.assertEqual(counts, [1, 1, 1, 1])
+        self.assertTrue(all(hashes))
+        self.assertEqual(Profile.objects.count(), 4)
+        posts = list(topic.posts.all())
+        with self.assertNumQueries(2):
+            authors.load(posts)
+
+    def test_concurrent_create(self):
+        from django.contrib.auth.models import User
+        from djtalks.djforum import authors
+        from djtalks.djforum.models import Profile
+        users = [User.objects.create_user(name, name + '@example.com', name)
+                 for name in ('first', 'second')]
+        Profile.objects.filter(user=users[1]).delete()
+        # the profile of the first user has been created by another request
+        profiles = authors.create_profiles(users)
+        self.assertEqual(sorted(profiles), [user.id for user in users])
+        self.assertEqual(Profile.objects.filter(user__in=users).count(), 2)
+
+    def test_topic_page(self):
+        from django.contrib.auth.models import User
+        from djtalks.djforum.models import Post, Profile
+        self.allow_anonymous(self.root)
+        topic = self.add_topic(self.child)
+        for number in range(5):
+            user = User.objects.create_user('user{}'.format(number), '', 'password')
+            Post.objects.create(topic=topic, author=user, message='reply')
+        Profile.objects.exclude(user=self.user).delete()
+        response = self.client.get('/topic/{}/'.format(topic.id))
+        self.assertContains(response, '1 posts', count=6)
+        self.assertEqual(Profile.objects.count(), 6)
+
+
+class ReadTrackingTest(ForumTestCase):
+    def setUp(self):
+        super(ReadTrackingTest, self).setUp()
+        from datetime import timedelta
+        self.user.grant('view', self.root)
+        # topics are posted after the user has joined
+        self.user.date_joined -= timedelta(days=1)
+        self.user.save()
+        self.first = self.add_topic(self.child)
+        self.second = self.add_topic(self.child)
+        self.client.login(username='user', password='user')
+
+    def unread(self):
+        response = self.client.get('/forum/{}/'.format(self.child.id))
+        return [topic.id for topic in response.context['topics'] if topic.unread]
+
+    def test_unread(self):
+        from djtalks.djforum.models import Post, ReadMarker
+        self.assertEqual(sorted(self.unread()), sorted([self.first.id, self.second.id]))
+        self.client.get('/topic/{}/'.format(self.first.id))
+        self.assertEqual(self.unread(), [self.second.id])
+        # a reply makes the topic unread again
+        Post.objects.create(topic=self.first, author=self.user, message='reply')
+        self.assertEqual(sorted(self.unread()), sorted([self.first.id, self.second.id]))
+        self.client.post('/forum/{}/read/'.format(self.child.id))
+        self.assertEqual(self.unread(), [])
+        marker = ReadMarker.objects.get()
+        self.assertEqual(marker.read_topics(), {})
+
+    def test_reading_writes_once(self):
+        from djtalks.djforum.models import ReadMarker
+        url = '/topic/{}/'.format(self.first.id)
+        self.client.get(url)
+        marker = ReadMarker.objects.get()
+        self.client.get(url + '?page=1')
+        # the topic hasn't changed, so the marker wasn't written again with
+        # the new read time
+        self.assertEqual(self.reload(marker).topics, marker.topics)
+
+    def test_bounded(self):
+        from django.utils import timezone
+        from djtalks.djforum.models import ReadMarker
+        marker = ReadMarker(user=self.user, forum=self.child, read_before=self.user.date_joined)
+        marker.MAX_TOPICS = 3
+        for topic_id in range(1, 6):
+            marker.mark_read(topic_id)
+        marker.save()
+        self.assertEqual(sorted(self.reload(marker).read_topics()), [3, 4, 5])
+        marker.mark_all_read(timezone.now())
+        self.assertEqual(marker.topics, '')
+
+    def test_concurrent_marker(self):
+        from djtalks.djforum import tracking
+        from djtalks.djforum.models import ReadMarker
+        marker = ReadMarker(user=self.user, forum=self.child, read_before=self.user.date_joined)
+        # another request of the user has created the marker meanwhile
+        ReadMarker.objects.create(user=self.user, forum=self.child,
+                                  read_before=self.user.date_joined)
+        marker.mark_read(self.first.id)
+        tracking.save(marker)
+        self.assertEqual(ReadMarker.objects.get().topics, '')
+
+    def test_anonymous(self):
+        self.client.logout()
+        self.allow_anonymous(self.root)
+        self.assertEqual(self.unread(), [])
+
+
+class JobQueueTest(ForumTestCase):
+    def setUp(self):
+        super(JobQueueTest, self).setUp()
+        from djtalks.djforum import jobs
+        self.mode, jobs.MODE = jobs.MODE, 'worker'
+
+    def tearDown(self):
+        from djtalks.djforum import jobs
+        jobs.MODE = self.mode
+        jobs.tasks.pop('test.fail', None)
+
+    def test_queued_until_worker_runs(self):
+        from StringIO import StringIO
+        from django.core.management import call_command
+        from djtalks.djforum.models import Job
+        topic = self.add_topic(self.grandchild, posts=2)
+        self.assertEqual(Job.objects.count(), 3)
+        self.assertEqual(self.reload(topic).post_count, 0)
+        self.assertEqual(self.reload(self.root).topic_count, 0)
+        output = StringIO()
+        call_command('runjobs', once=True, stdout=output)
+        self.assertEqual(output.getvalue(), "3 jobs run\n")
+        self.assertEqual(Job.objects.count(), 0)
+        topic = self.reload(topic)
+        self.assertEqual(topic.post_count, 2)
+        self.assertEqual(topic.last_post_id, topic.posts.latest('id').id)
+        for forum in (self.root, self.child, self.grandchild):
+            forum = self.reload(forum)
+            self.assertEqual((forum.post_count, forum.topic_count), (2, 1))
+        self.assertEqual(self.reload(self.user.forum_profile).post_count, 2)
+
+    def test_deleted_before_worker_runs(self):
+        from djtalks.djforum import jobs
+        from djtalks.djforum.models import Job, Post
+        topic = self.add_topic(self.child)
+        jobs.work()
+        reply = Post.objects.create(topic=topic, author=self.user, message='reply')
+        reply.delete()
+        self.reload(self.add_topic(self.child, posts=2)).delete()
+        self.assertEqual(Job.objects.count(), 0)
+        jobs.work()
+        self.assertEqual(self.reload(topic).post_count, 1)
+        for forum in (self.root, self.child):
+            forum = self.reload(forum)
+            self.assertEqual((forum.post_count, forum.topic_count), (1, 1))
+        self.assertEqual(self.reload(self.user.forum_profile).post_count, 1)
+
+    def test_out_of_order(self):
+        from datetime import timedelta
+        from djtalks.djforum import jobs
+        from djtalks.djforum.models import Job, Post
+        topic = self.add_topic(self.child)
+        jobs.work()
+        first = Post.objects.create(topic=topic, author=self.user, message='first')
+        second = Post.objects.create(topic=topic, author=self.user, message='second')
+        Post.objects.filter(pk=second.pk).update(created=first.created + timedelta(seconds=1))
+        # the job of the first post is retried after the second one has run
+        Job.objects.filter(args='[{}]'.format(first.id))\
+                   .update(run_after=first.created + timedelta(hours=1))
+        jobs.work()
+        Job.objects.update(run_after=first.created)
+        jobs.work()
+        self.assertEqual(self.reload(topic).post_count, 3)
+        self.assertEqual(self.reload(topic).last_post_id, second.id)
+        for forum in (self.root, self.child):
+            forum = self.reload(forum)
+            self.assertEqual((forum.post_count, forum.last_post_id), (3, second.id))
+
+    def test_cancel_index(self):
+        from django.db import connection
+        cursor = connection.cursor()
+        # a pragma or an EXPLAIN would commit the transaction of the test
+        cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = %s",
+                       ['djforum_job'])
+        self.assertTrue(any('(name, args)' in (row[0] or '') for row in cursor.fetchall()))
+
+    def test_retry(self):
+        from djtalks.djforum import jobs
+        from djtalks.djforum.models import Job
+        calls = []
+
+        def fail(value):
+            calls.append(value)
+            raise ValueError(value)
+
+        jobs.register('test.fail', fail)
+        jobs.defer('test.fail', 42)
+        jobs.logger.disabled = True
+        try:
+            self.assertEqual(jobs.work(), 1)
+        finally:
+            jobs.logger.disabled = False
+        job = Job.objects.get()
+        self.assertEqual((job.attempts, job.failed, job.locked_until), (1, False, None))
+        self.assertTrue('ValueError' in job.error)
+        # the next attempt is delayed
+        self.assertEqual(jobs.work(), 0)
+        Job.objects.update(run_after=job.created)
+        max_attempts, jobs.MAX_ATTEMPTS = jobs.MAX_ATTEMPTS, 2
+        jobs.logger.disabled = True
+        try:
+            self.assertEqual(jobs.work(), 1)
+        finally:
+            jobs.MAX_ATTEMPTS = max_attempts
+            jobs.logger.disabled = False
+        self.assertTrue(Job.objects.get().failed)
+        self.assertEqual(calls, [42, 42])
+
+    def test_claimed_once(self):
+        from djtalks.djforum import jobs
+        self.add_topic(self.child)
+        claimed = jobs.claim()
+        self.assertEqual(len(claimed), 2)
+        # the lease hasn't expired yet
+        self.assertEqual(jobs.claim(), [])
+
+
+class FeedTest(ForumTestCase):
+    def setUp(self):
+        super(FeedTest, self).setUp()
+        from django.core.cache import cache
+        from djtalks.djforum import feed
+        cache.clear()
+        self.allow_anonymous(self.root)
+        self.topic = self.add_topic(self.child)
+        self.first = self.topic.posts.get()
+        self.settings = feed.TIMEOUT, feed.STREAM_TIMEOUT, feed.POLL_INTERVAL
+        feed.TIMEOUT, feed.STREAM_TIMEOUT, feed.POLL_INTERVAL = 0.1, 0.3, 0.05
+        self.url = '/topic/{}/updates/'.format(self.topic.id)
+
+    def tearDown(self):
+        from djtalks.djforum import feed
+        feed.TIMEOUT, feed.STREAM_TIMEOUT, feed.POLL_INTERVAL = self.settings
+
+    def test_sequence(self):
+        from django.core.cache import cache
+        from djtalks.djforum import feed
+        from djtalks.djforum.models import Post
+        self.assertEqual(feed.sequence(self.topic.id), self.first.id)
+        post = Post.objects.create(topic=self.topic, author=self.user, message='reply')
+        self.assertEqual(feed.sequence(self.topic.id), post.id)
+        # an older post never moves the sequence back
+        feed.post_added(self.topic.id, self.first.id)
+        self.assertEqual(feed.sequence(self.topic.id), post.id)
+        cache.clear()
+        self.assertEqual(feed.sequence(self.topic.id), post.id)
+
+    def test_long_poll(self):
+        import json
+        from djtalks.djforum.models import Post
+        update = json.loads(self.client.get(self.url, dict(after=self.first.id)).content)
+        self.assertEqual(update, dict(cursor=self.first.id, html=''))
+        post = Post.objects.create(topic=self.topic, author=self.user, message='new reply')
+        update = json.loads(self.client.get(self.url, dict(after=self.first.id)).content)
+        self.assertEqual(update['cursor'], post.id)
+        self.assertTrue('new reply' in update['html'])
+        self.assertFalse('<td>message<br>' in update['html'])
+        self.assertEqual(self.client.get(self.url, dict(after='x')).status_code, 400)
+
+    def test_event_stream(self):
+        from djtalks.djforum.models import Post
+        post = Post.objects.create(topic=self.topic, author=self.user, message='new reply')
+        response = self.client.get(self.url, HTTP_ACCEPT='text/event-stream',
+                                   HTTP_LAST_EVENT_ID=str(self.first.id))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = response.content.split('\n\n')
+        self.assertTrue(events[0].startswith('retry: '))
+        self.assertTrue(events[1].startswith('id: {}\nevent: posts\ndata: '.format(post.id)))
+        self.assertTrue('new reply' in events[1])
+        self.assertTrue(': keepalive' in events[2:])
+
+    def test_private_topic(self):
+        from djtalks.djforum.models import Forum, Topic
+        private = Forum.objects.insert(Forum(name='private'))
+        topic = Topic.objects.create(forum=private, subject='subject', author=self.user)
+        self.client.logout()
+        response = self.client.get('/topic/{}/updates/'.format(topic.id))
+        self.assertEqual(response.status_code, 404)
+
+
+class ThreadingTest(ForumTestCase):
+    def setUp(self):
+        super(ThreadingTest, self).setUp()
+        from djtalks.djforum.models import Post
+        self.allow_anonymous(self.root)
+        self.topic = self.add_topic(self.child)
+        self.first = self.topic.posts.get()
+        self.second = Post.objects.create(topic=self.topic, author=self.user, message='second')
+        self.reply = Post.objects.create(topic=self.topic, author=self.user, message='reply',
+                                         reply_to=self.first)
+        self.nested = Post.objects.create(topic=self.topic, author=self.user, message='nested',
+                                          reply_to=self.reply)
+
+    def test_paths(self):
+        self.assertEqual(self.reload(self.first).path, '{:010d}.'.format(self.first.id))
+        nested = self.reload(self.nested)
+        self.assertEqual(nested.path, '{:010d}.{:010d}.{:010d}.'.format(
+            self.first.id, self.reply.id, self.nested.id))
+        self.assertEqual(nested.depth, 2)
+
+    def test_max_depth(self):
+        from djtalks.djforum.models import Post
+        max_depth, Post.MAX_DEPTH = Post.MAX_DEPTH, 2
+        try:
+            deeper = Post.objects.create(topic=self.topic, author=self.user, message='deeper',
+                                         reply_to=self.reload(self.nested))
+        finally:
+            Post.MAX_DEPTH = max_depth
+        deeper = self.reload(deeper)
+        self.assertEqual(deeper.reply_to_id, self.nested.id)
+        # threaded as a sibling of the post it replies to
+        self.assertEqual(deeper.depth, 2)
+        self.assertTrue(deeper.path.startswith(self.reload(self.reply).path))
+
+    def test_threaded_view(self):
+        url = '/topic/{}/'.format(self.topic.id)
+        flat = [post.id for post in self.client.get(url).context['posts']]
+        self.assertEqual(flat, [self.first.id, self.second.id, self.reply.id, self.nested.id])
+        response = self.client.get(url, dict(view='threaded'))
+        threaded = [post.id for post in response.context['posts']]
+        self.assertEqual(threaded, [self.first.id, self.reply.id, self.nested.id,
+                                    self.second.id])
+        self.assertContains(response, 'padding-left: 40px')
+
+    def test_threaded_pages(self):
+        from djtalks.djforum.models import Post
+        from djtalks.djforum.pagination import KeysetPaginator
+        paginator = KeysetPaginator(self.topic.posts.all(), ('path',), 2)
+        first = paginator.page(1)
+        self.assertEqual([post.id for post in first], [self.first.id, self.reply.id])
+        second = paginator.after(first.next_cursor)
+        self.assertEqual([post.id for post in second], [self.nested.id, self.second.id])
+        previous = paginator.before(second.previous_cursor)
+        self.assertEqual([post.id for post in previous], [self.first.id, self.reply.id])
+
+    def test_reply_through_view(self):
+        from djtalks.djforum.models import Post, Topic
+        self.user.grant('view', self.root)
+        self.client.login(username='user', password='user')
+        url = '/topic/{}/'.format(self.topic.id)
+        self.client.post(url, dict(message='answer', reply_to=self.second.id))
+        self.assertEqual(Post.objects.get(message='answer').reply_to_id, self.second.id)
+        # replies to posts of other topics are rejected
+        other = Topic.objects.create(forum=self.child, subject='other', author=self.user)
+        response = self.client.post('/topic/{}/'.format(other.id),
+                                    dict(message='stray', reply_to=self.second.id))
+        self.assertFalse(Post.objects.filter(message='stray').exists())
+        self.assertTrue(response.context['form'].errors)
+
+
+class RateLimitTest(ForumTestCase):
+    def setUp(self):
+        super(RateLimitTest, self).setUp()
+        from django.core.cache import cache
+        from djtalks.djforum import ratelimit
+        cache.clear()
+        self.limits = ratelimit.LIMITS
+        ratelimit.LIMITS = {'post': {'user': (2, 60), 'ip': (3, 60)}}
+        self.user.grant('view', self.root)
+        self.topic = self.add_topic(self.child)
+        self.url = '/topic/{}/'.format(self.topic.id)
+
+    def tearDown(self):
+        from django.core.cache import cache
+        from djtalks.djforum import ratelimit
+        ratelimit.LIMITS = self.limits
+        cache.clear()
+
+    def test_bucket(self):
+        from djtalks.djforum.ratelimit import take
+        self.assertEqual([take('bucket', 2, 60, now=100) for _ in range(2)], [0, 0])
+        self.assertEqual(take('bucket', 2, 60, now=100), 30)
+        # a token is refilled every 30 seconds
+        self.assertEqual(take('bucket', 2, 60, now=115), 15)
+        self.assertEqual(take('bucket', 2, 60, now=130), 0)
+        self.assertEqual(take('bucket', 2, 60, now=130), 30)
+
+    def test_post(self):
+        from djtalks.djforum.models import Post
+        self.client.login(username='user', password='user')
+        statuses = [self.client.post(self.url, dict(message='reply')).status_code
+                    for _ in range(3)]
+        self.assertEqual(statuses, [302, 302, 429])
+        self.assertEqual(Post.objects.count(), 3)
+
+    def test_rejected_without_queries(self):
+        from djtalks.djforum import ratelimit
+        from djtalks.djforum.models import Post
+        ratelimit.LIMITS = {'post': {'user': (5, 60), 'ip': (2, 60)}}
+        self.client.login(username='user', password='user')
+        self.client.post(self.url, dict(message='reply'))
+        self.client.post(self.url, dict(message='reply'))
+        # the address runs out of tokens before the user does and is turned
+        # away before the session is loaded
+        with self.assertNumQueries(0):
+            response = self.client.post(self.url, dict(message='reply'))
+        self.assertEqual(response.status_code, 429)
+        self.assertTrue(25 <= int(response['Retry-After']) <= 31)
+        self.assertEqual(Post.objects.count(), 3)
+        # other addresses are not affected
+        response = self.client.post(self.url, dict(message='reply'), REMOTE_ADDR='192.0.2.2')
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Post.objects.count(), 4)
+
+    def test_get_not_limited(self):
+        self.allow_anonymous(self.root)
+        statuses = set(self.client.get(self.url).status_code for _ in range(5))
+        self.assertEqual(statuses, set([200]))
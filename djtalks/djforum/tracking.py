@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors:
+    - qweqwe
+
+Unread topics. Instead of a row per user and topic, a user has one
+:class:`~djtalks.djforum.models.ReadMarker` per forum: a time before which
+everything is read plus a bounded set of topics read after it. The marker
+is fetched once per request, unread flags of a page of topics are then
+computed in memory against `Topic.updated`:
+
+    marker = tracking.get_marker(request, forum.id)
+    paginator = KeysetPaginator(..., prepare=lambda topics: tracking.annotate(marker, topics))
+
+Opening a topic writes the marker only if the topic was unread, so paging
+through a thread or reloading it doesn't write anything.
+"""
+from django.db import transaction, IntegrityError
+
+from djtalks.djforum import writes
+from djtalks.djforum.models import ReadMarker
+
+
+def get_marker(request, forum_id):
+    """
+    Returns the marker of the user in the forum, a new unsaved one if they
+    haven't read anything there yet, or None for anonymous users. The marker
+    is fetched once per request.
+    """
+    user = request.user
+    if not user.is_authenticated():
+        return None
+    if not hasattr(request, '_read_markers'):
+        request._read_markers = {}
+    cache = request._read_markers
+    forum_id = int(forum_id)
+    if forum_id not in cache:
+        markers = list(ReadMarker.objects.filter(user=user.id, forum=forum_id)[:1])
+        # everything posted before the user joined counts as read
+        cache[forum_id] = markers[0] if markers else \
+            ReadMarker(user_id=user.id, forum_id=forum_id, read_before=user.date_joined)
+    return cache[forum_id]
+
+
+def key(marker):
+    return marker.key if marker is not None else ''
+
+
+def annotate(marker, topics):
+    """
+    Sets `unread` of every topic
+    """
+    for topic in topics:
+        topic.unread = marker is not None and marker.is_unread(topic)
+
+
+def save(marker):
+    def write():
+        with transaction.commit_on_success():
+            sid = transaction.savepoint()
+            try:
+                marker.save()
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                # a concurrent request of the user has created the marker, losing
+                # this change only makes the topic look unread once more
+                transaction.savepoint_rollback(sid)
+    writes.run(write)
+
+
+def topic_read(request, topic):
+    marker = get_marker(request, topic.forum_id)
+    if marker is not None and marker.is_unread(topic):
+        marker.mark_read(topic.id)
+        save(marker)
+
+
+def forum_read(request, forum_id):
+    marker = get_marker(request, forum_id)
+    if marker is not None:
+        marker.mark_all_read()
+        save(marker)
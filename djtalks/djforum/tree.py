@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors:
+    - qweqwe
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.datastructures import SortedDict
+
+from djtalks.djforum.models import Forum
+from djtalks.djforum import versions
+
+TREE_CACHE_TIMEOUT = getattr(settings, 'DJFORUM_TREE_CACHE_TIMEOUT', 60 * 60)
+#: how many levels below the root are displayed
+TREE_DEPTH = 3
+
+
+def make_forum_tree(parent_id, forums):
+    """
+    Builds nested {forum: {subforum: {...}}} tree of the forums hanging from
+    the `parent_id` in a single pass over the list. Forums whose parent is
+    not in the list are left out.
+    """
+    children = {parent_id: SortedDict()}
+    for forum in forums:
+        children.setdefault(forum.id, SortedDict())
+    for forum in forums:
+        if forum.parent_id in children:
+            children[forum.parent_id][forum] = children[forum.id]
+    return children[parent_id]
+
+
+def forum_tree(permissions, parent=None):
+    """
+    Returns the tree of forums below the parent (or the whole board) that
+    are visible with given :class:`~djtalks.djforum.permissions.ForumPermissions`.
+    Users that see the same forums share the cached tree.
+    """
+    key = 'djforum:tree:{}:{}:{}:{}'.format(
+        permissions.key, parent.id if parent else 'root',
+        *versions.get('forums', 'tree'))
+    tree = cache.get(key)
+    if tree is None:
+        if parent:
+            forums = Forum.objects.all().descendants(parent, depth=TREE_DEPTH)
+        else:
+            forums = Forum.objects.filter(depth__lte=TREE_DEPTH)
+        forums = forums.select_related('last_post__topic', 'last_post__author')\
+                       .order_by('depth', 'id')
+        forums = [forum for forum in forums if permissions.can_view(forum.id)]
+        tree = make_forum_tree(parent.id if parent else None, forums)
+        cache.set(key, tree, TREE_CACHE_TIMEOUT)
+    return tree
@@ -10,8 +10,12 @@ from django.conf.urls import patterns, include, url
 urlpatterns = patterns('',
     (r'^$', 'djtalks.djforum.views.index'),
     url(r'^forum/(\d+)/$', 'djtalks.djforum.views.forum'),
+    url(r'^forum/(\d+)/read/$', 'djtalks.djforum.views.mark_read'),
     url(r'^topic/(\d+)/$', 'djtalks.djforum.views.topic'),
+    url(r'^topic/(\d+)/updates/$', 'djtalks.djforum.views.topic_updates'),
+    url(r'^search/$', 'djtalks.djforum.views.search'),
     url(r'^inbox/?$', 'djtalks.djforum.views.inbox'),
     url(r'^inbox/new/?$', 'djtalks.djforum.views.new_pm'),
     url(r'^inbox/conversation/(\d+)/$', 'djtalks.djforum.views.conversation'),
+    url(r'^metrics/$', 'djtalks.djforum.views.metrics'),
 )
\ No newline at end of file
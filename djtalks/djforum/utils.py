@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors:
+    - qweqwe
+"""
+from contextlib import contextmanager
+from itertools import islice
+
+
+def chunks(iterable, size):
+    """
+    Splits iterable into lists of at most `size` items without loading the
+    whole iterable into memory
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def queryset_chunks(queryset, size):
+    """
+    Iterates over the queryset in lists of at most `size` rows ordered by the
+    primary key. Every chunk is fetched with `pk > last seen pk`, so memory
+    use and the cost of a chunk stay constant however large the table is.
+    Rows are either model instances or `values_list` tuples starting with pk.
+    """
+    last = None
+    while True:
+        chunk = queryset.order_by('pk')
+        if last is not None:
+            chunk = chunk.filter(pk__gt=last)
+        chunk = list(chunk[:size])
+        if not chunk:
+            return
+        yield chunk
+        last = chunk[-1][0] if isinstance(chunk[-1], tuple) else chunk[-1].pk
+
+
+#: SQLite allows at most 999 variables and 500 compound SELECTs in a statement
+MAX_VARIABLES = 999
+MAX_ROWS = 500
+
+
+def bulk_insert(model, objects):
+    """
+    Inserts objects with `bulk_create` in batches small enough for one
+    statement each, so any number of objects can be streamed in
+    """
+    size = max(1, min(MAX_ROWS, MAX_VARIABLES // len(model._meta.local_fields)))
+    total = 0
+    for chunk in chunks(objects, size):
+        model.objects.bulk_create(chunk)
+        total += len(chunk)
+    return total
+
+
+@contextmanager
+def explicit_timestamps(*models):
+    """
+    Lets (bulk) inserts of the models keep the values of their auto_now and
+    auto_now_add fields instead of overwriting them with the current time
+    """
+    fields = [field for model in models for field in model._meta.local_fields
+              if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False)]
+    saved = [(field, field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in saved:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
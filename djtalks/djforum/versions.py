@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors:
+    - qweqwe
+
+Version counters for cache invalidation. Cached values include versions of
+the data they were built from in their keys, so bumping a version makes
+all those keys unreachable at once and they expire on their own.
+"""
+import time
+import warnings
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+
+from djtalks.djforum import writes
+
+KEY = 'djforum:version:{}'
+#: the longest timeout memcached allows, default timeout would make all the
+#: versions (and everything cached with them) expire every few minutes
+TIMEOUT = 30 * 24 * 60 * 60
+
+
+def initial():
+    # versions start from the current time, so a counter that has been evicted
+    # from the cache never repeats numbers used before
+    return int(time.time() * 1000)
+
+
+def get(*names):
+    """
+    Returns the list of current versions of the given names
+    """
+    keys = [KEY.format(name) for name in names]
+    versions = cache.get_many(keys)
+    missing = dict((key, initial()) for key in keys if key not in versions)
+    if missing:
+        for key, version in missing.items():
+            # someone might have initialized the version in the meantime
+            if not cache.add(key, version, TIMEOUT):
+                missing[key] = cache.get(key, version)
+        versions.update(missing)
+    return [versions[key] for key in keys]
+
+
+def bump(*names):
+    for name in names:
+        key = KEY.format(name)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, initial(), TIMEOUT)
+
+
+def check_backend():
+    """
+    Warns when the cache lives in the memory of the process: versions bumped
+    by one process are not seen by the others, which keep serving stale
+    trees and permissions until the entries expire
+    """
+    if isinstance(cache, LocMemCache) and not settings.DEBUG:
+        warnings.warn("djforum needs a cache shared by all the processes, e.g. memcached, "
+                      "the local memory cache only works with a single process",
+                      RuntimeWarning)
+
+
+def forums_changed(**kwargs):
+    bump('forums')
+
+
+def tree_changed(**kwargs):
+    # readers of the transaction that is saving the forum still see the
+    # old tree, they must not cache it under the new version
+    writes.after_commit(bump, 'tree', 'forums')
+
+
+def permissions_changed(**kwargs):
+    bump('permissions')
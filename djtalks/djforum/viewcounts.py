@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors:
+    - qweqwe
+
+Buffered topic view counter. Hits are aggregated in the memory of the
+process and written to `Topic.views` in batches, one
+`UPDATE ... SET views = views + CASE id WHEN ... END` statement per batch,
+instead of an UPDATE of the hot topic row on every page view.
+
+Pages only add hits to the buffer. A flusher thread of the process writes
+it every DJFORUM_VIEWS_FLUSH_INTERVAL seconds, or as soon as it holds
+DJFORUM_VIEWS_MAX_BUFFERED hits, so this is the most that can be lost when
+the process crashes. A flush is a short transaction of its own that goes
+through the single writer (see :mod:`djtalks.djforum.writes`), and the hits
+of a flush that fails are put back into the buffer. The buffer is also
+flushed when the process exits normally.
+"""
+import atexit
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from djtalks.djforum.models import Topic
+from djtalks.djforum.utils import chunks
+from djtalks.djforum import writes
+
+FLUSH_INTERVAL = getattr(settings, 'DJFORUM_VIEWS_FLUSH_INTERVAL', 30)
+MAX_BUFFERED = getattr(settings, 'DJFORUM_VIEWS_MAX_BUFFERED', 1000)
+#: every topic takes 3 variables, SQLite allows 999 per statement
+BATCH_SIZE = 300
+
+logger = logging.getLogger(__name__)
+
+
+class ViewCounter(object):
+    def __init__(self, flush_interval=FLUSH_INTERVAL, max_buffered=MAX_BUFFERED,
+                 background=True):
+        """
+        :param background: whether the flusher thread is started with the
+            first hit, otherwise the buffer is written by calling flush()
+        """
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self.background = background
+        self.lock = threading.Lock()
+        self.hits = {}
+        self.buffered = 0
+        self.event = threading.Event()
+        self.thread = None
+        self.stopped = False
+
+    def hit(self, topic_id):
+        with self.lock:
+            self.hits[topic_id] = self.hits.get(topic_id, 0) + 1
+            self.buffered += 1
+            full = self.buffered >= self.max_buffered
+            if self.background and self.thread is None:
+                self.thread = threading.Thread(target=self.loop, name='djforum-viewcounts')
+                self.thread.daemon = True
+                self.thread.start()
+        if full:
+            self.event.set()
+
+    def take(self):
+        with self.lock:
+            hits, self.hits, self.buffered = self.hits, {}, 0
+        return hits
+
+    def restore(self, hits):
+        with self.lock:
+            for topic_id, count in hits.items():
+                self.hits[topic_id] = self.hits.get(topic_id, 0) + count
+                self.buffered += count
+
+    def write(self, hits):
+        table = connection.ops.quote_name(Topic._meta.db_table)
+        with transaction.commit_on_success():
+            cursor = connection.cursor()
+            for batch in chunks(hits.items(), BATCH_SIZE):
+                cases = ' '.join(['WHEN %s THEN %s'] * len(batch))
+                ids = ', '.join(['%s'] * len(batch))
+                params = [value for item in batch for value in item]
+                params.extend(topic_id for topic_id, _ in batch)
+                cursor.execute('UPDATE {0} SET views = views + CASE id {1} END '
+                               'WHERE id IN ({2})'.format(table, cases, ids), params)
+
+    def flush(self):
+        hits = self.take()
+        if not hits:
+            return
+        try:
+            writes.run(self.write, hits)
+        except Exception:
+            logger.exception("Can't write views of %d topics", len(hits))
+            # they are written with the next flush
+            self.restore(hits)
+
+    def loop(self):
+        try:
+            while not self.stopped:
+                self.event.wait(self.flush_interval)
+                self.event.clear()
+                if not self.stopped:
+                    self.flush()
+        finally:
+            # the thread has its own connection
+            connection.close()
+
+    def stop(self):
+        """
+        Stops the flusher thread and writes what is left in the buffer
+        """
+        self.stopped = True
+        self.event.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+
+
+counter = ViewCounter()
+atexit.register(counter.stop)
@@ -1,113 +1,224 @@
 # Create your views here.
+import json
 from collections import defaultdict
+from django.utils.datastructures import SortedDict
 from django.core.urlresolvers import reverse
 from django.shortcuts import  render, get_object_or_404, redirect
-from django.http import Http404
+from django.template import RequestContext
+from django.template.loader import render_to_string
+from django.http import Http404, HttpResponse, HttpResponseBadRequest
 from django.db import transaction
-from django.db.models import Q
+from django.db.models import Q, Count
 from django.contrib.auth.decorators import login_required
+from django.views.decorators.http import condition, require_POST
 from djtalks.djforum.models import *
 from djtalks.djforum import forms
+from djtalks.djforum.pagination import KeysetPaginator
+from djtalks.djforum.tree import forum_tree
+from djtalks.djforum.permissions import get_permissions
+from djtalks.djforum import viewcounts
+from djtalks.djforum import search as fulltext
+from djtalks.djforum import inbox as summaries
+from djtalks.djforum import authors
+from djtalks.djforum import conditional
+from djtalks.djforum import feed
+from djtalks.djforum import ratelimit
+from djtalks.djforum import tracking
+from djtalks.djforum import writes
+from djtalks.djforum import metrics as instrumentation
 
 
-def make_forum_tree(parent, forums):
-    children = {}
-    # take a copy of a list and iterate over it
-    for forum in forums[:]:
-        if not forum.parent_id or parent and forum.parent_id == parent.id:
-            forums.remove(forum)
-            children[forum] = {}
-    for forum in children:
-        children[forum] = make_forum_tree(forum, forums)
-    return children
+TOPICS_PER_PAGE = getattr(settings, 'DJFORUM_TOPICS_PER_PAGE', 30)
+POSTS_PER_PAGE  = getattr(settings, 'DJFORUM_POSTS_PER_PAGE', 20)
+RESULTS_PER_PAGE = getattr(settings, 'DJFORUM_SEARCH_RESULTS_PER_PAGE', 20)
+CONVERSATIONS_PER_PAGE = getattr(settings, 'DJFORUM_CONVERSATIONS_PER_PAGE', 20)
 
+
+@condition(etag_func=conditional.index_etag,
+           last_modified_func=conditional.index_last_modified)
 def index(request):
-    # if user is not authenticated then request.user will be instance of the
-    # AnonymousUser, not the User. Therefore it will not have `get_objects_any_perms`
-    # method, so we check if user is authenticated and if he isn't we manually query
-    # for the special anonymous user model
-    user = request.user if request.user.is_authenticated() \
-                        else User.objects.get(pk=settings.ANONYMOUS_USER_ID)
-#    # select all the top level forums that current user has access to
-#    _forums = user.get_objects_any_perms(Forum).filter(depth=0)
-#    top_forums = [forum for forum in _forums]
-#    top_forums_ids = [forum.id for forum in top_forums]
-#    # create query to select all forums that user has access to
-#    q = reduce(lambda acc, f: acc|Q(path__startswith=f.id),
-#               top_forums, Q(id__in=top_forums_ids))
-#    _forums = Forum.objects.filter(q).select_related('last_post__topic',
-#                                                     'last_post__author')
-
-    # selecting all forums that current user has access to
-    _forums = user.get_objects_any_perms(Forum, perms=['view'])\
-                  .filter(depth__lte=3)\
-                  .select_related('last_post__topic', 'last_post__author')
-    # make forum tree
-    forums = make_forum_tree(None, list(_forums))
-    context = dict(forums=forums)
+    permissions = get_permissions(request)
+    # rows of the forums are cached per set of visible subforums
+    context = dict(forums=forum_tree(permissions), permissions=permissions)
     return render(request, 'djforum/index.html', context)
 
+@condition(etag_func=conditional.forum_etag,
+           last_modified_func=conditional.forum_last_modified)
+@ratelimit.limit('topic')
 @transaction.commit_on_success
 def forum(request, forum_id):
-
-    user = request.user if \
-        request.user.is_authenticated()\
-    else \
-        User.objects.get(pk=settings.ANONYMOUS_USER_ID)
-
-    forum = get_object_or_404(Forum, pk=forum_id)
-    if not user.has_perm('view', forum):
+    permissions = get_permissions(request)
+    if not permissions.can_view(int(forum_id)):
         raise Http404
+    forum = get_object_or_404(Forum, pk=forum_id)
 
     form  = forms.AddTopicForm(request.POST or None)
     if form.is_valid_on_submit(request):
-        topic = Topic(forum=forum, subject=form.cleaned_data['subject'],
-                      author=request.user)
-        topic.save()
-        post = Post(topic=topic, author=request.user,
-                    message=form.cleaned_data['message'],
-                    user_ip=request.META.get('REMOTE_ADDR', None))
-        post.save()
-
-    topics = forum.topics.order_by('-updated')\
-                         .select_related('author','last_post','last_post__author')
-    subforums = user.get_objects_any_perms(Forum, perms=['view'])\
-                    .descendants(forum, depth=3)\
-                    .select_related('last_post__topic', 'last_post__author')
-
-    context = dict(forum=forum, topics=topics, form=form,
-                   subforums=make_forum_tree(forum, list(subforums)))
+        def add_topic():
+            with transaction.commit_on_success():
+                topic = Topic(forum=forum, subject=form.cleaned_data['subject'],
+                              author=request.user)
+                topic.save()
+                post = Post(topic=topic, author=request.user,
+                            message=form.cleaned_data['message'],
+                            user_ip=request.META.get('REMOTE_ADDR', None))
+                post.save()
+            return topic
+        return redirect(reverse('djtalks.djforum.views.topic', args=[writes.run(add_topic).id]))
+
+    topics = forum.topics.select_related('author','last_post','last_post__author')
+    # forum counters include topics of the subforums, so subtract them to get
+    # the number of the forum's own topics without COUNT(*)
+    subforum_topics = Forum.objects.filter(parent=forum)\
+                                   .values_list('topic_count', flat=True)
+    marker = tracking.get_marker(request, forum.id)
+    paginator = KeysetPaginator(topics, ('-updated', '-id'), TOPICS_PER_PAGE,
+                                count=forum.topic_count - sum(subforum_topics),
+                                prepare=lambda topics: tracking.annotate(marker, topics))
+
+    context = dict(forum=forum, topics=paginator.page_from_request(request), form=form,
+                   subforums=forum_tree(permissions, forum), permissions=permissions,
+                   query=request.GET.urlencode(), read_key=tracking.key(marker))
 
     return render(request, 'djforum/forum.html', context)
 
+@condition(etag_func=conditional.topic_etag,
+           last_modified_func=conditional.topic_last_modified)
+@ratelimit.limit('post')
 @transaction.commit_on_success
 def topic(request, topic_id):
-    form  = forms.AddPostForm(request.POST or None)
     topic = get_object_or_404(Topic, pk=topic_id)
-    user = request.user if\
-        request.user.is_authenticated()\
-    else\
-        User.objects.get(pk=settings.ANONYMOUS_USER_ID)
-    if not user.has_perm('view', topic.forum):
+    form  = forms.AddPostForm(request.POST or None, topic=topic,
+                              initial=dict(reply_to=request.GET.get('reply_to')))
+    if not get_permissions(request).can_view(topic.forum_id):
         raise Http404
-    posts = topic.posts.prefetch_related('author')
+    # the threaded view orders posts by their materialized path, so replies
+    # follow the post they reply to
+    threaded = request.GET.get('view') == 'threaded'
     if form.is_valid_on_submit(request):
-        post = Post(topic=topic, author=request.user,
-                    message=form.cleaned_data['message'],
-                    user_ip=request.META.get('REMOTE_ADDR', None))
-        post.save()
-    payload = dict(topic=topic, posts=posts, form=form)
+        def add_post():
+            with transaction.commit_on_success():
+                Post(topic=topic, author=request.user,
+                     message=form.cleaned_data['message'],
+                     reply_to=form.cleaned_data['reply_to'],
+                     user_ip=request.META.get('REMOTE_ADDR', None)).save()
+        writes.run(add_post)
+        return redirect('{}?page=last{}'.format(reverse('djtalks.djforum.views.topic',
+                                                        args=[topic.id]),
+                                                '&view=threaded' if threaded else ''))
+    viewcounts.counter.hit(topic.id)
+    tracking.topic_read(request, topic)
+    paginator = KeysetPaginator(topic.posts.all(),
+                                ('path', 'id') if threaded else ('created', 'id'),
+                                POSTS_PER_PAGE, count=topic.post_count, prepare=authors.load)
+    posts = paginator.page_from_request(request)
+    payload = dict(topic=topic, posts=posts, form=form, query=request.GET.urlencode(),
+                   threaded=threaded, params='&view=threaded' if threaded else '')
     return render(request, 'djforum/topic.html', payload)
 
 
+def topic_updates(request, topic_id):
+    """
+    New posts of the topic after the `after` cursor, rendered. Waits for
+    them when there are none yet, streams them as Server-Sent Events to
+    clients that accept text/event-stream.
+    """
+    topic = get_object_or_404(Topic, pk=topic_id)
+    if not get_permissions(request).can_view(topic.forum_id):
+        raise Http404
+    try:
+        # browsers reconnecting to the stream send the last event id they got
+        after = int(request.META.get('HTTP_LAST_EVENT_ID') or request.GET.get('after') or 0)
+    except ValueError:
+        return HttpResponseBadRequest()
+
+    def render_posts(posts):
+        if not posts:
+            return dict(cursor=after, html='')
+        authors.load(posts)
+        html = render_to_string('djforum/_posts.html', dict(posts=posts),
+                                RequestContext(request))
+        return dict(cursor=posts[-1].id, html=html)
+
+    if 'text/event-stream' in request.META.get('HTTP_ACCEPT', ''):
+        response = HttpResponse(feed.stream(topic.id, after, render_posts),
+                                content_type='text/event-stream')
+    else:
+        response = HttpResponse(json.dumps(render_posts(feed.wait(topic.id, after))),
+                                content_type='application/json')
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+@require_POST
+@transaction.commit_on_success
+@login_required
+def mark_read(request, forum_id):
+    if not get_permissions(request).can_view(int(forum_id)):
+        raise Http404
+    tracking.forum_read(request, forum_id)
+    return redirect(forum, forum_id)
+
+
+def search(request):
+    form = forms.SearchForm(request.GET or None)
+    payload = dict(form=form, results=[])
+    if form.is_valid():
+        try:
+            page = max(1, int(request.GET.get('page', 1)))
+        except ValueError:
+            raise Http404
+        # one more result tells whether there is the next page
+        found = fulltext.search(form.cleaned_data['q'], get_permissions(request),
+                                offset=(page - 1) * RESULTS_PER_PAGE,
+                                limit=RESULTS_PER_PAGE + 1)
+        has_next = len(found) > RESULTS_PER_PAGE
+        found = found[:RESULTS_PER_PAGE]
+        topics = Topic.objects.in_bulk([topic_id for _, topic_id in found])
+        posts = Post.objects.select_related('author')\
+                            .in_bulk([post_id for post_id, _ in found if post_id])
+        query = request.GET.copy()
+        query['page'] = page + 1
+        next_query = query.urlencode()
+        query['page'] = page - 1
+        payload.update(page=page, has_next=has_next, next_query=next_query,
+                       previous_query=query.urlencode(),
+                       results=[dict(topic=topics[topic_id], post=posts.get(post_id))
+                                for post_id, topic_id in found if topic_id in topics])
+    return render(request, 'djforum/search.html', payload)
+
+
 @login_required
 def inbox(request):
-    incoming = request.user.incoming_pms.select_related()
-    outgoing = request.user.outgoing_pms.select_related().prefetch_related('recipients')
-    payload = dict(incoming=incoming, outgoing=outgoing)
+    """
+    Lists conversations of the user, the latest first
+    """
+    user = request.user
+    try:
+        page = max(1, int(request.GET.get('page', 1)))
+    except ValueError:
+        raise Http404
+    offset = (page - 1) * CONVERSATIONS_PER_PAGE
+    # copies, the values are updated below
+    conversations = [dict(c) for c in summaries.conversations(user.id)
+                     [offset:offset + CONVERSATIONS_PER_PAGE + 1]]
+    has_next = len(conversations) > CONVERSATIONS_PER_PAGE
+    conversations = conversations[:CONVERSATIONS_PER_PAGE]
+    last = PrivateMessage.objects.select_related('sender').prefetch_related('recipients')\
+                                 .in_bulk([c['last_id'] for c in conversations])
+    unread = dict(Inbox.objects.filter(recipient=user, is_read=False,
+                                       message__conversation_id__in=[
+                                           c['conversation_id'] for c in conversations])
+                               .values_list('message__conversation_id')
+                               .annotate(Count('id')).order_by())
+    for conversation in conversations:
+        conversation.update(last=last[conversation['last_id']],
+                            unread=unread.get(conversation['conversation_id'], 0))
+    payload = dict(conversations=conversations, page=page, has_next=has_next)
     return render(request, 'djforum/inbox.html', payload)
 
 
+@ratelimit.limit('pm')
 @transaction.commit_on_success
 @login_required
 def new_pm(request):
@@ -119,7 +230,8 @@ def new_pm(request):
     """
     #TODO: make sure that user cannot include himself in recipients
     #TODO: restrict depth to 0 when only two users are participating in the conversation
-    form = forms.NewMessageForm(request.POST or None, user=request.user)
+    form = forms.NewMessageForm(request.POST or None, user=request.user,
+                                initial=dict(parent=request.GET.get('parent')))
     if form.is_valid_on_submit(request):
         parent = form.cleaned_data['parent']
         pm = PrivateMessage(sender=request.user,
@@ -137,33 +249,77 @@ def new_pm(request):
                 pm.depth = parent.depth + 1
         else:
             recipients = form.cleaned_data['recipients']
-        pm.save()
-        # deliver message to users
-        Inbox.objects.bulk_create([
-            Inbox(message=pm, recipient=recipient) for recipient in recipients
-        ])
+        def deliver():
+            with transaction.commit_on_success():
+                pm.save()
+                # deliver message to users
+                Inbox.objects.bulk_create([
+                    Inbox(message=pm, recipient=recipient) for recipient in recipients
+                ])
+        writes.run(deliver)
+        # the cached summaries aren't rolled back, so they are updated once
+        writes.after_commit(summaries.delivered, pm, recipients)
         return redirect(reverse(conversation, args=[pm.conversation_id]))
     payload = dict(form=form)
     return render(request, 'djforum/new_pm.html', payload)
 
+def make_message_tree(messages):
+    """
+    Orders messages of the conversation so that replies follow their parent
+    message, building the tree in a single pass over the list. Messages
+    must be ordered by id, so parents always go before their replies.
+    """
+    children = defaultdict(list)
+    ids = set(message.id for message in messages)
+    roots = []
+    for message in messages:
+        if message.parent_id in ids:
+            children[message.parent_id].append(message)
+        else:
+            roots.append(message)
+    ordered, stack = [], roots[::-1]
+    while stack:
+        message = stack.pop()
+        ordered.append(message)
+        stack.extend(reversed(children[message.id]))
+    return ordered
+
+
+@transaction.commit_on_success
 @login_required
 def conversation(request, conversation_id):
-    def make_message_tree(outgoing, incoming):
-        def make_tree(parent, messages):
-            children = defaultdict(list)
-            for message in messages:
-                if message.parent_id == parent.id:
-                    children[parent].apend(message)
-        messages = list(outgoing)
-        messages.extend([message.message for message in incoming])
-
-
-#        for message in outgoing:
-#            print message, message.parent_id, message.depth
-#        for message in incoming:
-#            print message, message.message.message, message.message.parent_id, message.message.depth
-    outgoing = request.user.outgoing_pms.filter(conversation_id=conversation_id).prefetch_related('recipients')
-    incoming = request.user.incoming_pms.filter(message__conversation_id=conversation_id).select_related()
-    print outgoing, incoming
-    make_message_tree(outgoing, incoming)
+    user = request.user
+    # flags whether the message has been delivered to the user and whether
+    # it's unread are selected in the same query as the messages
+    delivered = 'SELECT COUNT(*) FROM {} WHERE message_id = {}.id AND recipient_id = %s'\
+                .format(Inbox._meta.db_table, PrivateMessage._meta.db_table)
+    select = SortedDict([('received', delivered),
+                         ('unread', delivered + ' AND is_read = %s')])
+    messages = list(
+        PrivateMessage.objects.filter(conversation_id=conversation_id)
+                              .select_related('sender')
+                              .extra(select=select, select_params=[user.id, user.id, False])
+                              .order_by('id'))
+    if not any(message.sender_id == user.id or message.received for message in messages):
+        raise Http404
+    if any(message.unread for message in messages):
+        def mark_read():
+            with transaction.commit_on_success():
+                return Inbox.objects.filter(recipient=user, is_read=False,
+                                            message__conversation_id=conversation_id)\
+                                    .update(is_read=True)
+        writes.after_commit(summaries.marked_read, user.id, writes.run(mark_read))
+    payload = dict(messages=make_message_tree(messages), conversation_id=conversation_id)
+    return render(request, 'djforum/conversation.html', payload)
 
+
+def metrics(request):
+    """
+    Exports request metrics of this process for Prometheus, only to the
+    internal addresses and staff
+    """
+    if request.META.get('REMOTE_ADDR') not in settings.INTERNAL_IPS \
+            and not request.user.is_staff:
+        raise Http404
+    return HttpResponse(instrumentation.registry.export(),
+                        content_type='text/plain; version=0.0.4')
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors:
+    - qweqwe
+
+Short write transactions for SQLite, where a writer locks the whole
+database until it commits.
+
+Writes of a process go through a single writer, a lock that queues the
+threads, so they don't compete for the database lock. A write that still
+fails with "database is locked", because a writer of another process held
+the lock for longer than `busy_timeout`, is retried from the start, so
+only the block that writes goes through :func:`run`, in a transaction of
+its own, and caches are updated with :func:`after_commit`:
+
+    def add_post():
+        with transaction.commit_on_success():
+            post.save()
+    writes.run(add_post)
+
+Updates of the denormalized counters are moved out of the transaction
+that writes the post: :func:`after_commit` queues them while a request
+handled by :class:`WriteMiddleware` is running, and they are applied
+in their own short transactions once the view has committed. If the process
+dies in between, `recount` fixes the counters. Outside of requests and of
+:func:`apply` the functions are called right away.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction, DatabaseError
+
+DEFER = getattr(settings, 'DJFORUM_DEFER_COUNTERS', False)
+RETRIES = getattr(settings, 'DJFORUM_WRITE_RETRIES', 5)
+#: delay before the first retry, it doubles with every next one
+BACKOFF = 0.05
+
+#: the single writer of the process
+lock = threading.RLock()
+local = threading.local()
+
+
+def is_locked_error(error):
+    return 'locked' in str(error) or 'busy' in str(error)
+
+
+def run(func, *args, **kwargs):
+    """
+    Calls func holding the writer lock and retries it when the database is
+    locked. func must commit or roll back its own transaction.
+    """
+    queue = getattr(local, 'queue', None)
+    queued = len(queue) if queue is not None else 0
+    for attempt in range(RETRIES + 1):
+        try:
+            with lock:
+                return func(*args, **kwargs)
+        except DatabaseError as e:
+            if attempt == RETRIES or not is_locked_error(e):
+                raise
+            if queue is not None:
+                # writes queued by the failed attempt will be queued again
+                del queue[queued:]
+        time.sleep(BACKOFF * 2 ** attempt)
+
+
+def after_commit(func, *args, **kwargs):
+    queue = getattr(local, 'queue', None)
+    if queue is None:
+        func(*args, **kwargs)
+    else:
+        queue.append((func, args, kwargs))
+
+
+def cancel(func, *args, **kwargs):
+    """
+    Drops func queued with :func:`after_commit`, returns True if it was
+    still queued
+    """
+    queue = getattr(local, 'queue', None)
+    if queue and (func, args, kwargs) in queue:
+        queue.remove((func, args, kwargs))
+        return True
+    return False
+
+
+def apply(func, args, kwargs):
+    """
+    Calls func in a transaction of its own, functions it passes to
+    :func:`after_commit` are called once that transaction has committed
+    """
+    outer, local.queue = getattr(local, 'queue', None), []
+    try:
+        with transaction.commit_on_success():
+            func(*args, **kwargs)
+        queue = local.queue
+    finally:
+        local.queue = outer
+    for func, args, kwargs in queue:
+        after_commit(func, *args, **kwargs)
+
+
+class WriteMiddleware(object):
+    """
+    Applies the writes queued with :func:`after_commit` once the view has
+    returned, should go after middleware that routes queries
+    """
+    def process_request(self, request):
+        local.queue = [] if DEFER else None
+
+    def process_exception(self, request, exception):
+        # the transaction of the view has been rolled back
+        local.queue = None
+
+    def process_response(self, request, response):
+        queue, local.queue = getattr(local, 'queue', None), None
+        for func, args, kwargs in queue or ():
+            run(apply, func, args, kwargs)
+        return response
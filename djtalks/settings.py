@@ -11,6 +11,65 @@ ACCOUNT_ACTIVATION_DAYS = 7
 ANONYMOUS_USER_ID = 0
 REGISTRATION_DEFAULT_GROUP_NAME='members'
 
+#: djforum settings
+DJFORUM_TOPICS_PER_PAGE = 30
+DJFORUM_POSTS_PER_PAGE = 20
+#: pages after this one are reachable only through keyset cursors
+DJFORUM_OFFSET_PAGES = 10
+#: forum trees are invalidated on change, the timeout only bounds memory use
+DJFORUM_TREE_CACHE_TIMEOUT = 60 * 60
+DJFORUM_PERMISSIONS_CACHE_TIMEOUT = 60 * 60
+#: topic views are buffered in memory and written at least this often (seconds)
+DJFORUM_VIEWS_FLUSH_INTERVAL = 30
+#: ...or when this many views are buffered, it's the most a crash can lose
+DJFORUM_VIEWS_MAX_BUFFERED = 1000
+#: 'auto' uses SQLite FTS5 when it's available, 'fts5' or 'python' force the backend
+DJFORUM_SEARCH_BACKEND = 'auto'
+DJFORUM_SEARCH_RESULTS_PER_PAGE = 20
+DJFORUM_CONVERSATIONS_PER_PAGE = 20
+DJFORUM_INBOX_CACHE_TIMEOUT = 24 * 60 * 60
+#: fragments are invalidated on change, except for topic views that are
+#: only refreshed when the fragment expires
+DJFORUM_FRAGMENT_CACHE_TIMEOUT = 10 * 60
+#: aliases in DATABASES that djforum reads go to, see djforum/routers.py
+DJFORUM_REPLICAS = []
+#: clients read from the primary for this long after they have written
+DJFORUM_PIN_SECONDS = 10
+#: connections are reused between requests for this long, 0 closes them
+DJFORUM_CONN_MAX_AGE = 0
+#: applied to every SQLite connection, see djforum/sqlite.py
+DJFORUM_SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'busy_timeout': 5000,
+}
+#: counters are updated after the transaction that writes the post commits
+DJFORUM_DEFER_COUNTERS = True
+#: how many times a write that found the database locked is retried
+DJFORUM_WRITE_RETRIES = 5
+#: where deferred side effects of writes run: 'immediate', 'worker' or 'thread',
+#: see djforum/jobs.py
+DJFORUM_JOBS_MODE = 'immediate'
+DJFORUM_JOBS_THREADS = 2
+DJFORUM_JOBS_MAX_ATTEMPTS = 5
+#: token buckets of the form submissions: (burst, seconds to refill it) per user
+#: and per address, see djforum/ratelimit.py
+DJFORUM_RATE_LIMITS = {
+    'post': {'user': (5, 60), 'ip': (30, 60)},
+    'topic': {'user': (3, 10 * 60), 'ip': (10, 10 * 60)},
+    'pm': {'user': (5, 5 * 60), 'ip': (20, 5 * 60)},
+}
+#: views making more queries than this are logged by the metrics middleware
+DJFORUM_QUERY_BUDGETS = {
+    'djtalks.djforum.views.index': 10,
+    'djtalks.djforum.views.forum': 15,
+    'djtalks.djforum.views.topic': 20,
+    'djtalks.djforum.views.search': 10,
+    'djtalks.djforum.views.inbox': 10,
+    'djtalks.djforum.views.conversation': 10,
+}
+
 DEBUG = True
 TEMPLATE_DEBUG = DEBUG
 
@@ -31,6 +90,22 @@ DATABASES = {
     }
 }
 
+DATABASE_ROUTERS = ['djtalks.djforum.routers.ReplicaRouter']
+
+# djforum shares permissions, cache versions, inbox summaries and rate limits
+# between the processes through the cache, so production needs a shared
+# backend such as memcached. The local memory cache is only good for a single
+# process, djtalks/wsgi.py warns about it when DEBUG is off.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # 'default': {
+    #     'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+    #     'LOCATION': '127.0.0.1:11211',
+    # },
+}
+
 # Local time zone for this installation. Choices can be found here:
 # http://en.wikipedia.org/wiki/List_of_tz_zones_by_name
 # although not all choices may be available on all operating systems.
@@ -101,7 +176,21 @@ TEMPLATE_LOADERS = (
 #     'django.template.loaders.eggs.Loader',
 )
 
+TEMPLATE_CONTEXT_PROCESSORS = (
+    'django.contrib.auth.context_processors.auth',
+    'django.core.context_processors.debug',
+    'django.core.context_processors.i18n',
+    'django.core.context_processors.media',
+    'django.core.context_processors.static',
+    'django.core.context_processors.tz',
+    'django.contrib.messages.context_processors.messages',
+    'djtalks.djforum.context_processors.inbox_summary',
+)
+
 MIDDLEWARE_CLASSES = (
+    'djtalks.djforum.metrics.MetricsMiddleware',
+    'djtalks.djforum.routers.ReplicaMiddleware',
+    'djtalks.djforum.writes.WriteMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -160,6 +249,10 @@ LOGGING = {
         }
     },
     'handlers': {
+        'console': {
+            'level': 'WARNING',
+            'class': 'logging.StreamHandler',
+        },
         'mail_admins': {
             'level': 'ERROR',
             'filters': ['require_debug_false'],
@@ -172,5 +265,17 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': True,
         },
+        'djtalks.djforum.metrics': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+        },
+        'djtalks.djforum.jobs': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+        },
+        'djtalks.djforum.viewcounts': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+        },
     }
 }
@@ -23,6 +23,10 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "djtalks.settings")
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
 
+# processes serving the board must share the cache
+from djtalks.djforum import versions
+versions.check_backend()
+
 # Apply WSGI middleware here.
 # from helloworld.wsgi import HelloWorldApplication
 # application = HelloWorldApplication(application)